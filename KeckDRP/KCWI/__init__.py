@@ -35,6 +35,18 @@ class Conf(_config.ConfigNamespace):
         20,
         'Pixel buffer to exclude at edges of overscan'
     )
+    FLOAT32 = _config.ConfigItem(
+        False,
+        'Use single precision for CCD image arithmetic'
+    )
+    NTHREADS = _config.ConfigItem(
+        4,
+        'Thread pool size for per-amplifier and per-slice processing'
+    )
+    NPROCS = _config.ConfigItem(
+        4,
+        'Process pool size for geometry fits, cube resampling and arc bars'
+    )
     MINIMUM_NUMBER_OF_BIASES = _config.ConfigItem(
         7,
         'Minimum number of biases'
@@ -47,10 +59,30 @@ class Conf(_config.ConfigNamespace):
         6,
         'Minimum number of flats'
     )
+    STACK_INCREMENTAL = _config.ConfigItem(
+        True,
+        'Update master biases and darks incrementally as frames arrive'
+    )
+    STACK_TOPK = _config.ConfigItem(
+        2,
+        'Largest values kept per pixel for incremental sigma clipping'
+    )
+    STACK_EXACT = _config.ConfigItem(
+        False,
+        'Restack from disk when a finished stack may be clipped inexactly'
+    )
+    CUBE_METHOD = _config.ConfigItem(
+        'interp',
+        'Cube resampling: interp (cubic spline) or drizzle (flux conserving)'
+    )
     TAPERFRAC = _config.ConfigItem(
         0.2,
         'Taper fraction for atlas cross-correlation'
     )
+    XCORR_SUBPIXEL = _config.ConfigItem(
+        False,
+        'Refine cross-correlation offsets to a fraction of a pixel'
+    )
     PIXSCALE = _config.ConfigItem(
         0.00004048,
         'Degrees per unbinned pixel'
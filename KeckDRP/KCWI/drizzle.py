@@ -0,0 +1,163 @@
+"""Flux-conserving resampling of slices into a cube, as sparse matrices
+
+Each input pixel of a slice is projected into the output slice
+(position, wavelength) grid as a rectangle centred on its transformed
+centre, with sides given by the local scale of the transform along each
+axis.  The fraction of the rectangle falling in each output pixel is
+separable, the product of the overlaps along x and y, and makes up one
+column of a CSR matrix W (output pixels by input pixels).  The columns
+sum to one wherever the footprint lies inside the output, so W . data
+conserves flux, (W * W) . variance propagates the variance of
+independent pixels and (W > 0) . 1 counts the input pixels contributing
+to each output pixel.
+
+W only depends on the geometry, so it is built once per arc solution
+and reused by every cube made with it, as are W * W and the coverage.
+"""
+import os
+import tempfile
+
+import numpy as np
+from scipy import sparse
+
+# slice operators read or built in this process, by file path, geometry
+# time and image rows
+open_matrices = {}
+
+
+def overlaps(center, half, n):
+    """Overlap of 1-D footprints with a grid of unit pixels
+
+    Args:
+    -----
+        center (array): footprint centres, in output pixels
+        half (array): footprint half widths
+        n (int): number of output pixels, centred on 0 .. n-1
+
+    Returns:
+    --------
+        list: (index, fraction) array pairs, one per output pixel a
+            footprint may touch; fraction is 0 outside the grid
+    """
+    lo = center - half
+    hi = center + half
+    k0 = np.floor(lo + 0.5).astype(np.int64)
+    # widest footprint that reaches the grid
+    inside = (hi > -0.5) & (lo < n - 0.5)
+    span = int(np.ceil(2. * half[inside].max())) + 1 if inside.any() else 0
+    result = []
+    for d in range(span):
+        k = k0 + d
+        frac = (np.minimum(hi, k + 0.5) - np.maximum(lo, k - 0.5)) / \
+            (2. * half)
+        frac[~((k >= 0) & (k < n) & (frac > 0.))] = 0.
+        result.append((k, frac))
+    return result
+
+
+def drizzle_matrix(xpos, ypos, xsize, ysize):
+    """Sparse matrix resampling a slice image into an output slice
+
+    Args:
+    -----
+        xpos, ypos (array): output (slice position, wavelength) pixel
+            coordinates of every input pixel, shape (ny, nx)
+        xsize, ysize (int): output slice shape is (ysize, xsize)
+
+    Returns:
+    --------
+        csr_matrix: (ysize * xsize, ny * nx) overlap fractions
+    """
+    # footprint sides from the local scale of the transform
+    xhalf = np.maximum(np.abs(np.gradient(xpos, axis=1)), 1.e-6) / 2.
+    yhalf = np.maximum(np.abs(np.gradient(ypos, axis=0)), 1.e-6) / 2.
+    good = np.isfinite(xpos) & np.isfinite(ypos)
+    xpos = np.where(good, xpos, -1.e6).ravel()
+    ypos = np.where(good, ypos, -1.e6).ravel()
+    xov = overlaps(xpos, xhalf.ravel(), xsize)
+    yov = overlaps(ypos, yhalf.ravel(), ysize)
+    pixels = np.arange(xpos.size)
+    rows, cols, vals = [], [], []
+    for ky, fy in yov:
+        for kx, fx in xov:
+            frac = fy * fx
+            use = frac > 0.
+            rows.append(ky[use] * xsize + kx[use])
+            cols.append(pixels[use])
+            vals.append(frac[use].astype(np.float32))
+    return sparse.csr_matrix(
+        (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(ysize * xsize, xpos.size))
+
+
+def slice_operators(matrix):
+    """What drizzle_slice() applies for a drizzle matrix W
+
+    W * W and the coverage only depend on the geometry, like W, so are
+    made once with it rather than for every frame.
+
+    Returns:
+    --------
+        tuple: W, W * W and the number of input pixels in each output
+            pixel
+    """
+    squared = matrix.multiply(matrix).tocsr()
+    # stored entries are the nonzero fractions
+    coverage = np.diff(matrix.indptr).astype(np.float64)
+    return matrix, squared, coverage
+
+
+def drizzle_slice(operators, data, variance=None, shape=None):
+    """Resample one slice image with its drizzle matrix
+
+    Args:
+    -----
+        operators (tuple): from slice_operators()
+
+    Returns:
+    --------
+        array: output slice
+        array: output variance, or None if variance is None
+        array: number of input pixels in each output pixel
+    """
+    matrix, squared, coverage = operators
+    out = matrix.dot(data.ravel())
+    if variance is not None:
+        var = squared.dot(variance.ravel())
+    else:
+        var = None
+    coverage = coverage.copy()
+    if shape is not None:
+        out = out.reshape(shape)
+        coverage = coverage.reshape(shape)
+        if var is not None:
+            var = var.reshape(shape)
+    return out, var, coverage
+
+
+def save_matrices(path, matrices):
+    """Write a list of CSR matrices to one npz file, atomically"""
+    arrays = {}
+    for i, matrix in enumerate(matrices):
+        arrays['data%d' % i] = matrix.data
+        arrays['indices%d' % i] = matrix.indices
+        arrays['indptr%d' % i] = matrix.indptr
+        arrays['shape%d' % i] = np.array(matrix.shape)
+    fd, tmp = tempfile.mkstemp(suffix='.npz',
+                               dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            np.savez(out, nmat=len(matrices), **arrays)
+        os.replace(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def load_matrices(path):
+    """Read the CSR matrices written by save_matrices()"""
+    with np.load(path, allow_pickle=False) as npz:
+        return [sparse.csr_matrix((npz['data%d' % i], npz['indices%d' % i],
+                                   npz['indptr%d' % i]),
+                                  shape=tuple(npz['shape%d' % i]))
+                for i in range(int(npz['nmat']))]
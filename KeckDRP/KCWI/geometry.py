@@ -0,0 +1,120 @@
+"""Versioned FITS storage of the IFU geometry solved from an arc
+
+A geometry file (<arc>_geom.fits) holds:
+
+    primary header  scalar geometry parameters, the schema version
+                    (GEOMVER) and a SHA-256 hash of the content (GEOMHASH)
+    SLICES          binary table, one row per slice: image column limits
+                    and the coefficients of the slice to image (TFORM)
+                    and image to slice (INVTF) polynomial transforms
+    COORDS          optional image, the resampling coordinates of every
+                    output slice pixel, (nslices, 2, ysize, xsize)
+
+Unlike pickled transforms it does not depend on the skimage version and
+reading it runs no code.  The COORDS image is memory mapped, so it is
+only read as the cube is resampled.
+"""
+import hashlib
+import json
+
+import numpy as np
+from astropy.io import fits
+from skimage import transform as tf
+
+GEOM_VERSION = 1
+
+# geometry dict keys and their header keywords
+SCALARS = (('xsize', 'XSIZE'), ('ysize', 'YSIZE'),
+           ('pxscl', 'PXSCL'), ('slscl', 'SLSCL'),
+           ('cbarsno', 'CBARSNO'), ('cbarsfl', 'CBARSFL'),
+           ('arcno', 'ARCNO'), ('arcfl', 'ARCFL'),
+           ('barsep', 'BARSEP'), ('bar0', 'BAR0'),
+           ('waveall0', 'WAVALL0'), ('waveall1', 'WAVALL1'),
+           ('wavegood0', 'WAVGOOD0'), ('wavegood1', 'WAVGOOD1'),
+           ('wavemid', 'WAVMID'), ('dwout', 'DWOUT'),
+           ('wave0out', 'WAVE0OUT'), ('wave1out', 'WAVE1OUT'),
+           ('avwvsig', 'AVWVSIG'), ('sdwvsig', 'SDWVSIG'))
+
+
+def scalar(value):
+    """Plain python value of a geometry parameter"""
+    if isinstance(value, (np.generic, np.ndarray)):
+        value = value.item()
+    return value
+
+
+def geom_hash(geom):
+    """SHA-256 of the geometry parameters and slice transforms"""
+    sha = hashlib.sha256()
+    sha.update(json.dumps([GEOM_VERSION] +
+                          [scalar(geom[key]) for key, kwd in SCALARS]
+                          ).encode())
+    for name in ('xl0', 'xl1'):
+        sha.update(np.asarray(geom[name], dtype='>i4').tobytes())
+    for name in ('tform', 'invtf'):
+        for trans in geom[name]:
+            sha.update(np.asarray(trans.params, dtype='>f8').tobytes())
+    return sha.hexdigest()
+
+
+def write_geom(path, geom, coords=None, overwrite=False):
+    """Write a geometry dict, and optionally its coordinate maps"""
+    hdr = fits.Header()
+    hdr['GEOMVER'] = (GEOM_VERSION, 'Geometry file schema version')
+    # SHA-256 of the content, too long for a comment
+    hdr['GEOMHASH'] = geom_hash(geom)
+    for key, kwd in SCALARS:
+        hdr[kwd] = scalar(geom[key])
+    slices = fits.BinTableHDU.from_columns([
+        fits.Column(name='XL0', format='J', array=np.asarray(geom['xl0'])),
+        fits.Column(name='XL1', format='J', array=np.asarray(geom['xl1'])),
+        fits.Column(name='TFORM', format='%dD' % geom['tform'][0].params.size,
+                    dim='(%d,2)' % geom['tform'][0].params.shape[1],
+                    array=np.array([t.params for t in geom['tform']])),
+        fits.Column(name='INVTF', format='%dD' % geom['invtf'][0].params.size,
+                    dim='(%d,2)' % geom['invtf'][0].params.shape[1],
+                    array=np.array([t.params for t in geom['invtf']]))],
+        name='SLICES')
+    hdus = [fits.PrimaryHDU(header=hdr), slices]
+    if coords is not None:
+        hdus.append(fits.ImageHDU(np.asarray(coords, dtype=np.float64),
+                                  name='COORDS'))
+    fits.HDUList(hdus).writeto(path, overwrite=overwrite)
+
+
+def read_geom(path):
+    """Read a geometry file into the dict solve_geom builds
+
+    Raises:
+    -------
+        ValueError: unknown schema version or content hash mismatch
+    """
+    with fits.open(path, memmap=True) as hdul:
+        hdr = hdul[0].header
+        if hdr.get('GEOMVER') != GEOM_VERSION:
+            raise ValueError("unsupported geometry version %s in %s" %
+                             (hdr.get('GEOMVER'), path))
+        geom = dict((key, hdr[kwd]) for key, kwd in SCALARS)
+        tab = hdul['SLICES'].data
+        geom['xl0'] = [int(x) for x in tab['XL0']]
+        geom['xl1'] = [int(x) for x in tab['XL1']]
+        geom['tform'] = [tf.PolynomialTransform(np.array(p, dtype=np.float64))
+                         for p in tab['TFORM']]
+        geom['invtf'] = [tf.PolynomialTransform(np.array(p, dtype=np.float64))
+                         for p in tab['INVTF']]
+        if geom_hash(geom) != hdr['GEOMHASH']:
+            raise ValueError("geometry content hash mismatch in %s" % path)
+    geom['geom_file'] = path
+    return geom
+
+
+def read_geom_coords(path):
+    """Memory-mapped coordinate maps of a geometry file, or None"""
+    hdul = fits.open(path, memmap=True)
+    if 'COORDS' not in hdul:
+        hdul.close()
+        return None
+    # the map stays valid after the file is closed
+    coords = hdul['COORDS'].data
+    hdul.close()
+    return coords
@@ -2,6 +2,7 @@ from ..core import CcdPrimitives
 from ..core import ImgmathPrimitives
 from ..core import ProctabPrimitives
 from ..core import DevelopmentPrimitives
+from ..core import CalibCache
 import os
 from .. import conf
 from . import KcwiConf
@@ -17,7 +18,15 @@ from scipy.interpolate import interpolate
 from scipy.optimize import curve_fit
 from scipy.stats import sigmaclip, mode
 from skimage import transform as tf
-import pickle
+import tempfile
+import warnings
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from . import drizzle
+from .geometry import write_geom, read_geom, read_geom_coords
+from .drizzle import drizzle_slice
+from .xcorr import xcorr_full, xcorr_peak
+from . import linefit
 from astropy.table import Table
 from astropy.coordinates import SkyCoord
 from astropy import units as u
@@ -194,6 +203,144 @@ def get_line_window(y, c, thresh=0., verbose=False):
     # END: get_line_window()
 
 
+def walk_spectrum(y, start, step, stop, prev0=None):
+    """Where walks along a spectrum stop, for many walks at once
+
+    Each walk goes from sample start, step samples at a time, until
+    stop(vals, prev, idx, rows) is True for a sample, or it leaves the
+    spectrum.  Samples are examined in blocks that double in size, so
+    long walks cost a few array operations, not one per sample.
+
+    Args:
+    -----
+        y (array): spectrum
+        start (array): (int) first sample of each walk
+        step (int): +1 or -1
+        stop (function): bool array of the samples stopping a walk, from
+            their values, the values of the samples walked before them,
+            their indices and the walk of each row
+        prev0 (array): values before the first samples
+
+    Returns:
+    --------
+        array: (int) sample where each walk stopped, outside the spectrum
+            (-1 or len(y)) if it went off an end
+    """
+    nx = len(y)
+    start = np.asarray(start, dtype=int)
+    if prev0 is None:
+        prev0 = np.full(len(start), np.nan)
+    end = np.empty(len(start), dtype=int)
+    todo = np.arange(len(start))
+    k0 = 0
+    width = 8
+    while len(todo):
+        idx = start[todo, np.newaxis] + step * (k0 + np.arange(width))
+        inside = (idx >= 0) & (idx < nx)
+        vals = y[np.clip(idx, 0, nx - 1)]
+        if k0 == 0:
+            first = prev0[todo, np.newaxis]
+        else:
+            first = y[np.clip(idx[:, :1] - step, 0, nx - 1)]
+        prev = np.concatenate((first, vals[:, :-1]), axis=1)
+        with np.errstate(invalid='ignore'):
+            done = ~inside | stop(vals, prev, idx, todo[:, np.newaxis])
+        hit = done.any(axis=1)
+        end[todo[hit]] = idx[hit, done[hit].argmax(axis=1)]
+        todo = todo[~hit]
+        k0 += width
+        width *= 2
+    return np.clip(end, -1, nx)
+
+
+def get_line_windows(y, cs, thresh=0.):
+    """get_line_window() for many line centers at once
+
+    Each step of get_line_window() is done for all centers together:
+    the walks past the initial maximum and out to half maximum become
+    walk_spectrum() calls, the recentering one argmax over the padded
+    windows.  Windows and counts are the same as get_line_window()
+    gives; where that rejects a line, or fails with an IndexError or a
+    ValueError on the ends of the spectrum, the count is 0.
+
+    Args:
+    -----
+        y (array): spectrum
+        cs (array): (int) line centers
+        thresh (float): minimum peak value
+
+    Returns:
+    --------
+        array: (int) first sample of each window, 0 if rejected
+        array: (int) last sample of each window, 0 if rejected
+        array: (int) samples counted, 0 if rejected
+    """
+    y = np.asarray(y, dtype=np.float64)
+    nx = len(y)
+    cs = np.asarray(cs, dtype=int)
+    n = len(cs)
+    x0 = np.zeros(n, dtype=int)
+    x1 = np.zeros(n, dtype=int)
+    count = np.zeros(n, dtype=int)
+    # check edges
+    ok = (cs >= 2) & (cs <= nx - 2)
+    c = cs[ok]
+    rows = np.nonzero(ok)[0]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        # initial maximum
+        near = np.clip(c[:, np.newaxis] + np.arange(-2, 3), 0, nx)
+        mx = np.nanmax(np.where(near < nx, y[np.minimum(near, nx - 1)],
+                                np.nan), axis=1)
+    # move past higher samples on either side of the initial window
+    lo = walk_spectrum(y, c - 3, -1, lambda v, p, i, r: ~(v > mx[r]))
+    hi = walk_spectrum(y, c + 3, 1, lambda v, p, i, r: ~(v > mx[r]))
+    ok = (lo >= 0) & (hi < nx)
+    c, rows, lo, hi = c[ok], rows[ok], lo[ok], hi[ok]
+    cnt = 5 + (c - 3 - lo) + (hi - c - 3)
+    # adjust starting window to center on max
+    wide = lo[:, np.newaxis] + 1 + np.arange((hi - lo - 1).max(initial=1))
+    vals = np.where(wide < hi[:, np.newaxis], y[np.minimum(wide, nx - 1)],
+                    -np.inf)
+    cmx = lo + 1 + vals.argmax(axis=1)
+    lo = cmx - 2
+    hi = cmx + 2
+    # a window starting before the spectrum comes out empty
+    ok = lo >= 0
+    c, rows, cnt, lo, hi = c[ok], rows[ok], cnt[ok], lo[ok], hi[ok]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        near = lo[:, np.newaxis] + np.arange(5)
+        mx = np.nanmax(np.where(near < nx, y[np.minimum(near, nx - 1)],
+                                np.nan), axis=1)
+    # make sure max is high enough
+    ok = ~(mx < thresh)
+    c, rows, cnt, lo, hi, mx = c[ok], rows[ok], cnt[ok], lo[ok], hi[ok], \
+        mx[ok]
+    # expand until we get to half max
+    hmx = mx * 0.5
+
+    def stop_low(v, p, i, r):
+        # below half max, or missed max, at the edge or wiggly
+        return ~(v > hmx[r]) | (v > mx[r]) | (i <= 0) | (v > p)
+
+    def stop_high(v, p, i, r):
+        return ~(v > hmx[r]) | (v > mx[r]) | (v > p)
+
+    x0s = walk_spectrum(y, lo, -1, stop_low, prev0=mx)
+    x1s = walk_spectrum(y, hi, 1, stop_high, prev0=mx)
+    with np.errstate(invalid='ignore'):
+        ok = (x0s >= 0) & ~(y[np.clip(x0s, 0, nx - 1)] > hmx) & \
+            (x1s < nx) & ~(y[np.clip(x1s, 0, nx - 1)] > hmx)
+    cnt = cnt + (lo - x0s) + (x1s - hi)
+    # where did we end up?
+    ok &= (c >= x0s) & (x1s >= c)
+    x0[rows[ok]] = x0s[ok]
+    x1[rows[ok]] = x1s[ok]
+    count[rows[ok]] = cnt[ok]
+    return x0, x1, count
+
+
 def findpeaks(x, y, wid, sth, ath, pkg=None, verbose=False):
     """Find peaks in spectrum"""
     # derivative
@@ -251,6 +398,327 @@ def findpeaks(x, y, wid, sth, ath, pkg=None, verbose=False):
     # END: findpeaks()
 
 
+def solve_bar(bspec, coeff, at_wave, thresh=50., lines=False,
+              verbose=False):
+    """Wavelength solution of one bar from its smoothed arc spectrum
+
+    Fits a Gaussian and finds the interpolated peak of each atlas line in
+    the bar, all lines at once with linefit, rejecting windows that are
+    too small, have wandered off, or whose fit fails or peak and centroid
+    disagree, then fits a 4th order polynomial with four
+    rounds of 3 sigma clipping.  A module level function so that bars can
+    be solved on a process pool.
+
+    Args:
+    -----
+        bspec (array): smoothed bar arc spectrum
+        coeff (list): starting (pascal shifted) coefficients of the bar
+        at_wave (list): atlas line wavelengths
+        thresh (float): line threshold for get_line_window
+        lines (bool): also return each measured line, for plotting
+
+    Returns:
+    --------
+        dict: wfit (fit coefficients), wsig (fit RMS), nstart and nrej
+            (lines before clipping and lines rejected), at_wave_dat,
+            arc_wave_fit, resid (kept lines), rej_rsd_wave, rej_rsd
+            (clipped lines), rej_wave (rejected lines) and, if lines,
+            lines: one dict per measured line
+    """
+    xsvals = np.arange(0, len(bspec))
+    # get bar wavelengths
+    bw = np.polyval(coeff, xsvals)
+    # store values to fit
+    at_wave_dat = []
+    arc_pix_dat = []
+    rej_wave = []
+    nrej = 0
+    line_dat = [] if lines else None
+    # first pixel at or past each line
+    past = bw >= np.asarray(at_wave, dtype=np.float64)[:, np.newaxis]
+    inobs = past.any(axis=1)
+    line_xs = past.argmax(axis=1)
+    # find a window for each line, all at once
+    minows, maxows, counts = get_line_windows(bspec, line_xs, thresh=thresh)
+    windows = []
+    for iw, aw in enumerate(at_wave):
+        if not inobs[iw]:
+            windows.append("Atlas line not in observation: %.2f" % aw)
+            continue
+        line_x = line_xs[iw]
+        minow, maxow, count = minows[iw], maxows[iw], counts[iw]
+        if count < 5 or not minow or not maxow:
+            windows.append("Arc window rejected for line %.3f" % aw)
+        # check if window no longer contains initial value
+        elif minow > line_x > maxow:
+            windows.append("Arc window wandered off for line %.3f" % aw)
+        else:
+            windows.append((line_x, minow, maxow))
+    # measure all the lines at once
+    inwin = [w for w in windows if not isinstance(w, str)]
+    if inwin:
+        xw, yw, mask = linefit.pad_windows(bspec, xsvals,
+                                           [w[1] for w in inwin],
+                                           [w[2] for w in inwin])
+        # Gaussian fits
+        fits, fit_ok = linefit.fit_gaussians(xw, yw, mask)
+        # peaks of the interpolated lines
+        peaks, unused = linefit.spline_peaks(xw, yw, mask)
+        # centroids
+        cents = linefit.centroids(xw, yw, mask)
+    il = 0
+    for iw, aw in enumerate(at_wave):
+        if isinstance(windows[iw], str):
+            rej_wave.append(aw)
+            nrej += 1
+            if verbose:
+                print(windows[iw])
+            continue
+        line_x, minow, maxow = windows[iw]
+        fit, cent, peak = fits[il], cents[il], peaks[il]
+        ok = fit_ok[il]
+        il += 1
+        if not ok:
+            nrej += 1
+            if verbose:
+                print("Arc Gaussian fit rejected for line %.3f" % aw)
+            continue
+        if abs(cent - peak) > 0.7:
+            rej_wave.append(aw)
+            nrej += 1
+            if verbose:
+                print("Arc peak - cent offset rejected for line %.3f" % aw)
+            continue
+        # store data
+        arc_pix_dat.append(peak)
+        at_wave_dat.append(aw)
+        if lines:
+            yvec = bspec[minow:maxow+1]
+            xvec = xsvals[minow:maxow+1]
+            # dense interpolation, to plot
+            int_line = interpolate.interp1d(xvec, yvec, kind='cubic',
+                                            bounds_error=False,
+                                            fill_value='extrapolate')
+            xplot = np.linspace(min(xvec), max(xvec), num=1000)
+            line_dat.append({'iw': iw, 'aw': aw, 'line_x': line_x,
+                             'minow': minow, 'maxow': maxow,
+                             'xvec': xvec, 'yvec': yvec,
+                             'wvec': bw[minow:maxow+1],
+                             'max_value': yvec[yvec.argmax()],
+                             'xplot': xplot, 'plt_line': int_line(xplot),
+                             'peak': peak, 'cent': cent,
+                             'sp_pk_x': fit[1]})
+    nstart = len(arc_pix_dat)
+    # Fit wavelengths
+    # Initial fit
+    wfit = np.polyfit(arc_pix_dat, at_wave_dat, 4)
+    pwfit = np.poly1d(wfit)
+    arc_wave_fit = pwfit(arc_pix_dat)
+    resid = arc_wave_fit - at_wave_dat
+    resid_c, low, upp = sigmaclip(resid, low=3., high=3.)
+    wsig = resid_c.std()
+    rej_rsd = []
+    rej_rsd_wave = []
+    # Iteratively remove outliers
+    for it in range(4):
+        arc_dat = []
+        at_dat = []
+        # Trim outliers
+        for il, rsd in enumerate(resid):
+            if low < rsd < upp:
+                arc_dat.append(arc_pix_dat[il])
+                at_dat.append(at_wave_dat[il])
+            else:
+                rej_rsd_wave.append(at_wave_dat[il])
+                rej_rsd.append(rsd)
+        # refit
+        arc_pix_dat = arc_dat.copy()
+        at_wave_dat = at_dat.copy()
+        wfit = np.polyfit(arc_pix_dat, at_wave_dat, 4)
+        pwfit = np.poly1d(wfit)
+        arc_wave_fit = pwfit(arc_pix_dat)
+        resid = arc_wave_fit - at_wave_dat
+        resid_c, low, upp = sigmaclip(resid, low=3., high=3.)
+        wsig = np.nanstd(resid)
+    return {'wfit': wfit, 'wsig': wsig, 'nstart': nstart, 'nrej': nrej,
+            'at_wave_dat': at_wave_dat, 'arc_wave_fit': arc_wave_fit,
+            'resid': resid, 'rej_rsd_wave': rej_rsd_wave,
+            'rej_rsd': rej_rsd, 'rej_wave': rej_wave, 'lines': line_dat}
+
+
+def bspline_basis(t, x, k=3):
+    """Values of the k + 1 B-splines that are not zero at each point
+
+    The Cox-de Boor recursion of de Boor's BSPLVB, for all the points at
+    once.  Points outside the base interval use the polynomial of the
+    first or last interval, as BSpline(extrapolate=True) does.
+
+    Args:
+    -----
+        t (array): knots, as BSpline.t
+        x (array): points
+        k (int): spline degree
+
+    Returns:
+    --------
+        array: (len(x), k + 1) values of B-splines i - k ... i
+        array: (int) index i of the last of them, for each point
+    """
+    x = np.asarray(x, dtype=np.float64)
+    i = np.clip(np.searchsorted(t, x, side='right') - 1, k, len(t) - k - 2)
+    left = x[:, np.newaxis] - t[i[:, np.newaxis] + 1 - np.arange(k + 1)]
+    right = t[i[:, np.newaxis] + np.arange(k + 1)] - x[:, np.newaxis]
+    basis = np.zeros((len(x), k + 1))
+    basis[:, 0] = 1.
+    for j in range(1, k + 1):
+        saved = np.zeros(len(x))
+        for r in range(j):
+            temp = basis[:, r] / (right[:, r + 1] + left[:, j - r])
+            basis[:, r] = saved + right[:, r + 1] * temp
+            saved = left[:, j - r] * temp
+        basis[:, j] = saved
+    return basis, i
+
+
+def resample_rows(x, ys, xnew, rows):
+    """Cubic spline interpolation of many spectra sampled at the same x
+
+    Gives what interp1d(x, ys[row], kind='cubic', bounds_error=False,
+    fill_value='extrapolate')(xnew) gives for each point, with one spline
+    solve for all the spectra and one sparse B-spline evaluation for all
+    the points.
+
+    Args:
+    -----
+        x (array): abscissae of the spectra
+        ys (array): (nspec, len(x)) spectra
+        xnew (array): points to interpolate at
+        rows (array): (int) spectrum to interpolate at each point
+
+    Returns:
+    --------
+        array: interpolated values, shaped like xnew
+    """
+    # interp1d sorts the abscissae
+    order = np.argsort(x, kind='mergesort')
+    spl = interp.make_interp_spline(x[order], ys[:, order].T, k=3)
+    xnew = np.ravel(xnew)
+    rows = np.ravel(rows)
+    # the four basis functions that are not zero at each point
+    basis, last = bspline_basis(spl.t, xnew)
+    icoef = last[:, np.newaxis] + np.arange(-3, 1)
+    return np.einsum('ij,ij->i', basis, spl.c[icoef, rows[:, np.newaxis]])
+
+
+def slice_maps(itrf, xl0, xl1, ny, xsize):
+    """Evaluate a slice's inverse transform over its image columns
+
+    Args:
+    -----
+        itrf (PolynomialTransform): image to slice (x, wavelength) transform
+        xl0, xl1 (int): image column limits of the slice
+        ny (int): number of image rows
+        xsize (int): width of the output slice
+
+    Returns:
+    --------
+        array: (bool) pixels of columns xl0 to xl1 that fall on the slice
+        array: slice x position of each pixel
+        array: wavelength pixel of each pixel
+    """
+    # x relative to the slice edge
+    xs = np.arange(xl1 - xl0, dtype=np.float64)
+    ys = np.arange(ny, dtype=np.float64)
+    if isinstance(itrf, tf.PolynomialTransform):
+        # the polynomial is separable on the pixel grid: sum over terms
+        # c x^(j-i) y^i is ypow . C . xpow, two small matrix products
+        npar = itrf.params.shape[1]
+        order = int(round((np.sqrt(8 * npar + 1) - 3) / 2))
+        xpow = xs[np.newaxis, :] ** np.arange(order + 1)[:, np.newaxis]
+        ypow = ys[:, np.newaxis] ** np.arange(order + 1)[np.newaxis, :]
+        maps = []
+        for params in itrf.params:
+            coef = np.zeros((order + 1, order + 1))
+            idx = 0
+            for j in range(order + 1):
+                for i in range(j + 1):
+                    coef[i, j - i] = params[idx]
+                    idx += 1
+            maps.append(ypow.dot(coef).dot(xpow))
+        xpos, ypos = maps
+    else:
+        # all pixels in one call
+        xg, yg = np.meshgrid(xs, ys)
+        ncoo = itrf(np.column_stack((xg.ravel(), yg.ravel())))
+        xpos = ncoo[:, 0].reshape(xg.shape)
+        ypos = ncoo[:, 1].reshape(xg.shape)
+    good = (xpos >= 0) & (xpos <= xsize)
+    return good, xpos, ypos
+
+
+def coord_maps(tforms, ysize, xsize):
+    """Input image coordinates of every output slice pixel
+
+    Args:
+    -----
+        tforms (list): slice to image transforms, one per slice
+        ysize, xsize (int): output slice shape
+
+    Returns:
+    --------
+        array: (nslices, 2, ysize, xsize) (row, column) coordinates, as
+            used by skimage.transform.warp
+    """
+    return np.stack([tf.warp_coords(tform, (ysize, xsize))
+                     for tform in tforms])
+
+
+def coord_maps_file(geom_file):
+    """Name of the coordinate maps file that goes with a geometry file"""
+    return os.path.splitext(geom_file)[0] + '_coords.npy'
+
+
+def load_coord_maps(geom_file):
+    """Saved coordinate maps of a geometry, memory mapped, or None
+
+    Maps stored in the geometry file come first, then an up to date
+    maps file next to it.
+    """
+    coords = read_geom_coords(geom_file)
+    maps_file = coord_maps_file(geom_file)
+    if coords is None and os.path.exists(maps_file) and \
+            os.path.getmtime(maps_file) >= os.path.getmtime(geom_file):
+        coords = np.load(maps_file, mmap_mode='r')
+    return coords
+
+
+def fit_slice(src, dst):
+    """Slice to image and image to slice transforms from control points"""
+    tform = tf.estimate_transform('polynomial', src, dst, order=3)
+    invtf = tf.estimate_transform('polynomial', dst, src, order=3)
+    return tform, invtf
+
+
+def warp_slices(image_file, image_shape, geom_file, cube_file, cube_shape,
+                slices):
+    """Process pool worker: resample slices into a shared cube memmap
+
+    Args:
+    -----
+        image_file, cube_file (str): float64 memmaps of the image and cube
+        geom_file (str): geometry file, whose coordinate maps are used
+        slices (list): (slice number, xl0, xl1) of the slices to do
+    """
+    image = np.memmap(image_file, dtype=np.float64, mode='r',
+                      shape=image_shape)
+    coords = load_coord_maps(geom_file)
+    cube = np.memmap(cube_file, dtype=np.float64, mode='r+', shape=cube_shape)
+    for isl, xl0, xl1 in slices:
+        cube[:, :, isl] = tf.warp(image[:, xl0:xl1], coords[isl], order=3)
+    cube.flush()
+    del cube
+
+
 class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
                      ProctabPrimitives, DevelopmentPrimitives):
 
@@ -326,6 +794,9 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
         self.x0out = None           # Output first bar pixel position
         self.refoutx = None         # Output x positions for bars in cube
         self.geom_file = None       # Geometry output file
+        # stack_*() variables
+        self.defer_stack = False    # a later frame of the batch stacks
+        self.final_stack = False    # no more frames will join the stack
         super(KcwiPrimitives, self).__init__()
 
     @staticmethod
@@ -573,6 +1044,9 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
     # END: bias_readnoise()
 
     def stack_biases(self):
+        if self.defer_stack:
+            self.log.info("stacking deferred to the last bias of the batch")
+            return
 
         # get current group id
         if 'GROUPID' in self.frame.header:
@@ -584,7 +1058,13 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
         self.log.info("number of biases = %d" % len(combine_list))
         # create master bias
         if len(combine_list) >= KcwiConf.MINIMUM_NUMBER_OF_BIASES:
-            self.image_combine(combine_list, keylog='BIASLIST')
+            if KcwiConf.STACK_INCREMENTAL:
+                self.image_accumulate(combine_list, keylog='BIASLIST',
+                                      topk=KcwiConf.STACK_TOPK,
+                                      exact=KcwiConf.STACK_EXACT,
+                                      finalize=self.final_stack)
+            else:
+                self.image_combine(combine_list, keylog='BIASLIST')
             self.bias_readnoise(combine_list)
             # output file and update proc table
             self.update_proctab(suffix='master_bias', newtype='MBIAS')
@@ -596,6 +1076,9 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
         self.write_proctab()
 
     def stack_darks(self):
+        if self.defer_stack:
+            self.log.info("stacking deferred to the last dark of the batch")
+            return
 
         # get current group id
         if 'GROUPID' in self.frame.header:
@@ -608,8 +1091,15 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
         self.log.info("number of darks = %d" % len(combine_list))
         # create master bias
         if len(combine_list) >= KcwiConf.MINIMUM_NUMBER_OF_DARKS:
-            self.image_combine(combine_list, keylog='DARKLIST',
-                               in_directory='redux', suffix='int')
+            if KcwiConf.STACK_INCREMENTAL:
+                self.image_accumulate(combine_list, keylog='DARKLIST',
+                                      in_directory='redux', suffix='int',
+                                      topk=KcwiConf.STACK_TOPK,
+                                      exact=KcwiConf.STACK_EXACT,
+                                      finalize=self.final_stack)
+            else:
+                self.image_combine(combine_list, keylog='DARKLIST',
+                                   in_directory='redux', suffix='int')
             # output file and update proc table
             self.update_proctab(suffix='master_dark', newtype='MDARK')
             self.write_image(suffix='master_dark')
@@ -620,6 +1110,9 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
         self.write_proctab()
 
     def stack_internal_flats(self):
+        if self.defer_stack:
+            self.log.info("stacking deferred to the last flat of the batch")
+            return
         # how many flats do we have?
         combine_list = self.n_proctab(target_type='FLATLAMP')
         self.log.info("number of flats = %d" % len(combine_list))
@@ -896,22 +1389,21 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
         # Find  and read control points from continuum bars
         tab = self.n_proctab(target_type='CONTBARS', nearest=True)
         self.log.info("%d continuum bars frames found" % len(tab))
-        trace = self.read_table(tab=tab, indir='redux', suffix='trace')
+        trace = self.read_trace(tab)
         self.src = trace['src']  # source control points
         self.dst = trace['dst']  # destination control points
         self.barid = trace['barid']
         self.slid = trace['slid']
         # Get other items
-        self.midrow = trace.meta['MIDROW']
-        self.win = trace.meta['WINDOW']
-        self.refdelx = trace.meta['REFDELX']
-        self.cbarsno = trace.meta['CBARSNO']
-        self.cbarsfl = trace.meta['CBARSFL']
+        self.midrow = trace['midrow']
+        self.win = trace['window']
+        self.refdelx = trace['refdelx']
+        self.cbarsno = trace['cbarsno']
+        self.cbarsfl = trace['cbarsfl']
         self.arcno = self.frame.header['FRAMENO']
         self.arcfl = self.frame.header['OFNAME']
 
-        self.log.info("Fitting spatial control points")
-        tform = tf.estimate_transform('polynomial', self.src, self.dst, order=3)
+        tform = tf.PolynomialTransform(trace['tform'])
 
         self.log.info("Transforming arc image")
         warped = tf.warp(self.frame.data, tform)
@@ -944,6 +1436,42 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
         self.log.info(self.extract_arcs.__qualname__)
     # END: extract_arcs()
 
+    def read_trace(self, tab):
+        """Control points traced on a continuum bars image and their fit
+
+        The trace table is read and the bar transform fitted through the
+        calibration cache, so both only happen once per trace.
+
+        Returns:
+        --------
+            dict: src, dst, barid and slid control point arrays, midrow,
+                window, refdelx, cbarsno, cbarsfl and the tform
+                polynomial transform parameters
+        """
+        infile = os.path.join('redux',
+                              tab['OFNAME'][-1].split('.')[0] + '_trace.fits')
+        cache = CalibCache.open()
+        key = cache.key('trace', [infile])
+        trace = cache.get(key)
+        if trace is None:
+            self.log.info("reading table: %s" % infile)
+            table = Table.read(infile, format='fits')
+            trace = {'src': np.array(table['src']),
+                     'dst': np.array(table['dst']),
+                     'barid': np.array(table['barid']),
+                     'slid': np.array(table['slid'])}
+            for name in ('MIDROW', 'WINDOW', 'REFDELX', 'CBARSNO',
+                         'CBARSFL'):
+                trace[name.lower()] = table.meta[name]
+            self.log.info("Fitting spatial control points")
+            tform = tf.estimate_transform('polynomial', trace['src'],
+                                          trace['dst'], order=3)
+            trace['tform'] = tform.params
+            cache.put(key, trace)
+        else:
+            self.log.info("calibration cache hit: %s" % infile)
+        return trace
+
     def arc_offsets(self):
         self.log.info("Finding inter-bar offsets")
         if self.arcs is not None:
@@ -959,21 +1487,22 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
             nsamp = len(refarc[10:-10])
             # possible offsets
             offar = np.arange(1-nsamp, nsamp)
-            # Collect offsets
-            offsets = []
+            # Cross-correlate all bars at once, avoiding junk on the ends
+            xcorr = xcorr_full(refarc[10:-10],
+                               np.array(self.arcs)[:, 10:-10])
+            # Calculate offsets
+            offsets, unused = xcorr_peak(xcorr, offar,
+                                         refine=KcwiConf.XCORR_SUBPIXEL)
+            offsets = list(offsets)
             for na, arc in enumerate(self.arcs):
-                # Cross-correlate, avoiding junk on the ends
-                xcorr = np.correlate(refarc[10:-10], arc[10:-10], mode='full')
-                # Calculate offset
-                offset = offar[xcorr.argmax()]
-                offsets.append(offset)
+                offset = offsets[na]
                 self.log.info("Arc %d Slice %d XCorr shift = %d" %
                               (na, int(na/5), offset))
                 # display if requested
                 if do_plot:
                     pl.clf()
                     pl.plot(refarc, color='green')
-                    pl.plot(np.roll(arc, offset), color='red')
+                    pl.plot(np.roll(arc, int(round(offset))), color='red')
                     pl.ylim(bottom=0.)
                     pl.xlabel("CCD y (px)")
                     pl.ylabel("e-")
@@ -1040,18 +1569,29 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
             self.log.info("Reading atlas spectrum in: %s" % atpath)
         else:
             self.log.error("Atlas spectrum not found for %s" % atpath)
-        # Read the atlas
-        ff = pf.open(atpath)
-        reflux = ff[0].data
-        refdisp = ff[0].header['CDELT1']
-        refwav = np.arange(0, len(reflux)) * refdisp + ff[0].header['CRVAL1']
-        ff.close()
-        # Convolve with appropriate Gaussian
+        # Read the atlas, convolved to the resolution, through the cache
         resolution = self.frame.resolution(refwave=self.frame.cwave())
+        cache = CalibCache.open()
+        key = cache.key('atlas', [atpath], resolution=resolution)
+        atlas = cache.get(key)
+        if atlas is None:
+            ff = pf.open(atpath)
+            reflux = ff[0].data
+            refdisp = ff[0].header['CDELT1']
+            refwav = np.arange(0, len(reflux)) * refdisp + \
+                ff[0].header['CRVAL1']
+            ff.close()
+            # Convolve with appropriate Gaussian
+            atrespix = resolution / refdisp
+            reflux = gaussian_filter1d(reflux, atrespix/2.354)  # to sigma
+            atlas = cache.put(key, {'reflux': reflux, 'refwav': refwav,
+                                    'refdisp': refdisp})
+        reflux = atlas['reflux']
+        refwav = atlas['refwav']
+        refdisp = atlas['refdisp']
         atrespix = resolution / refdisp
         self.log.info("Resolution = %.3f Ang, or %.2f Atlas px" % (resolution,
                                                                    atrespix))
-        reflux = gaussian_filter1d(reflux, atrespix/2.354)   # convert to sigma
         # Observed arc spectrum
         obsarc = self.arcs[self.REFBAR]
         # Preliminary wavelength solution
@@ -1088,14 +1628,15 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
         nsamp = len(cc_refwav)
         offar = np.arange(1 - nsamp, nsamp)
         # Cross-correlate
-        xcorr = np.correlate(cc_obsarc, cc_reflux, mode='full')
+        xcorr = xcorr_full(cc_obsarc, cc_reflux)
         # Get central region
         x0c = int(len(xcorr)/3)
         x1c = int(2*(len(xcorr)/3))
         xcorr_central = xcorr[x0c:x1c]
         offar_central = offar[x0c:x1c]
         # Calculate offset
-        offset_pix = offar_central[xcorr_central.argmax()]
+        offset_pix, unused = xcorr_peak(xcorr_central, offar_central,
+                                        refine=KcwiConf.XCORR_SUBPIXEL)
         offset_wav = offset_pix * refdisp
         self.log.info("Initial arc-atlas offset (px, Ang): %d, %.1f" %
                       (offset_pix, offset_wav))
@@ -1170,6 +1711,114 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
         self.x0 = int(len(obsarc)/2)
     # END: read_atlas()
 
+    def disp_coeff(self, cwave, disp):
+        """Wavelength polynomial of a bar from its central wavelength and
+        dispersion, with the higher orders of the grating equation
+
+        Returns:
+        --------
+            list: np.polyval coefficients, highest order first
+        """
+        # y binning
+        ybin = self.frame.ybinsize()
+        rho = self.frame.rho()
+        coeff = [0., 0., 0., 0., 0.]
+        coeff[4] = cwave
+        coeff[3] = disp
+        cosbeta = disp / (self.PIX * ybin) * rho * self.FCAM * 1.e-4
+        if cosbeta > 1.:
+            cosbeta = 1.
+        beta = math.acos(cosbeta)
+        coeff[2] = -(self.PIX * ybin / self.FCAM) ** 2 * \
+            math.sin(beta) / 2. / rho * 1.e4
+        coeff[1] = -(self.PIX * ybin / self.FCAM) ** 3 * \
+            math.cos(beta) / 6. / rho * 1.e4
+        coeff[0] = (self.PIX * ybin / self.FCAM) ** 4 * \
+            math.sin(beta) / 24. / rho * 1.e4
+        return coeff
+
+    def xcorr_dispersions(self, disps, p0):
+        """Cross-correlate every bar with the atlas at every trial dispersion
+
+        For each dispersion the central region of all the bars is
+        resampled onto the atlas wavelengths in one batch (the bars only
+        differ by their central wavelength p0), tapered, and correlated
+        with the atlas in one batched FFT.
+
+        Args:
+        -----
+            disps (array): trial central dispersions
+            p0 (array): central wavelength of each bar
+
+        Returns:
+        --------
+            array: (nbars, ndisps) x-corr peak values
+            array: (nbars, ndisps) shifts of the peaks in atlas pixels
+        """
+        nbars = len(self.arcs)
+        p0 = np.asarray(p0, dtype=np.float64)
+        maxima = np.zeros((nbars, len(disps)))
+        shifts = np.zeros((nbars, len(disps)))
+        # central region of all the bars
+        subxvals = self.xvals[self.minrow:self.maxrow]
+        subspecs = np.array(self.arcs)[:, self.minrow:self.maxrow]
+        tapers = {}
+        for di, disp in enumerate(disps):
+            # polynomial less the central wavelength of the bar
+            coeff = self.disp_coeff(0., disp)
+            waves = np.polyval(coeff, subxvals)
+            # what are the min and max wavelengths to consider?
+            wl0 = np.polyval(coeff, self.xvals[self.minrow]) + p0
+            wl1 = np.polyval(coeff, self.xvals[self.maxrow]) + p0
+            minwvl = np.fmin(wl0, wl1)
+            maxwvl = np.fmax(wl0, wl1)
+            # where will we need to interpolate to cross-correlate?
+            minrw = np.searchsorted(self.refwave, minwvl, side='left')
+            maxrw = np.searchsorted(self.refwave, maxwvl, side='right') - 1
+            nsamp = maxrw - minrw
+            # atlas ranges, padded to the longest
+            npad = nsamp.max()
+            samp = np.arange(npad)
+            inside = samp < nsamp[:, np.newaxis]
+            iref = np.minimum(minrw[:, np.newaxis] + samp,
+                              len(self.refwave) - 1)
+            # bell cosine tapers to avoid nasty edge effects
+            tkwgt = np.zeros((nbars, npad))
+            for n in np.unique(nsamp):
+                if n not in tapers:
+                    tapers[n] = signal.windows.tukey(
+                        n, alpha=self.frame.taperfrac())
+                tkwgt[nsamp == n, :n] = tapers[n]
+            subrefspec = self.reflux[iref] * tkwgt
+            # interpolate the bar spectra at the atlas wavelengths
+            rows = np.broadcast_to(np.arange(nbars)[:, np.newaxis],
+                                   inside.shape)
+            intspec = np.zeros((nbars, npad))
+            intspec[inside] = resample_rows(
+                waves, subspecs, (self.refwave[iref] -
+                                  p0[:, np.newaxis])[inside], rows[inside])
+            intspec *= tkwgt
+            # cross correlate the interpolated spectra with the atlas spec
+            xcorr = xcorr_full(intspec, subrefspec)
+            # central region of each, from the unpadded length
+            nxc = 2 * nsamp - 1
+            x0c = (nxc / 3).astype(int)
+            x1c = (2 * (nxc / 3)).astype(int)
+            ncen = x1c - x0c
+            cen = np.arange(ncen.max())
+            icen = np.minimum(x0c[:, np.newaxis] - nsamp[:, np.newaxis] +
+                              npad + cen, xcorr.shape[1] - 1)
+            xcorr_central = np.where(cen < ncen[:, np.newaxis],
+                                     np.take_along_axis(xcorr, icen, 1),
+                                     -np.inf)
+            # Calculate offsets
+            shift, peak = xcorr_peak(xcorr_central, cen,
+                                     refine=KcwiConf.XCORR_SUBPIXEL,
+                                     size=ncen)
+            maxima[:, di] = peak
+            shifts[:, di] = shift + x0c - (nsamp - 1)
+        return maxima, shifts
+
     def fit_center(self):
         """ Fit central region
 
@@ -1184,8 +1833,6 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
             pl.ion()
         else:
             do_inter = False
-        # y binning
-        ybin = self.frame.ybinsize()
         # let's populate the 0 points vector
         p0 = self.frame.cwave() + np.array(self.baroffs) * self.prelim_disp \
             - self.offset_wave
@@ -1203,107 +1850,32 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
         # dispersions to try
         disps = self.prelim_disp * (1.0 + max_ddisp *
                                     (np.arange(0, nn+1) - nn/2.) * 2.0 / nn)
+        # x-corr maxima and shifts of all bars at all dispersions
+        maxima, shifts = self.xcorr_dispersions(disps, p0)
+        # Get interpolations, all bars at once
+        int_max = interpolate.interp1d(disps, maxima, kind='cubic',
+                                       bounds_error=False,
+                                       fill_value='extrapolate')
+        int_shift = interpolate.interp1d(disps, shifts, kind='cubic',
+                                         bounds_error=False,
+                                         fill_value='extrapolate')
+        xdisps = np.linspace(min(disps), max(disps), num=nn*100)
+        # get peak values
+        maxima_res = int_max(xdisps)
+        shifts_res = int_shift(xdisps) * self.refdisp
+        imax = maxima_res.argmax(axis=1)
         # containers for bar-specific values
         bardisp = []
         barshift = []
         centwave = []
         centdisp = []
 
-        # values for central fit
-        subxvals = self.xvals[self.minrow:self.maxrow]
         # loop over bars
-        for b, bs in enumerate(self.arcs):
-            # wavelength coefficients
-            coeff = [0., 0., 0., 0., 0.]
-            # container for maxima, shifts
-            maxima = []
-            shifts = []
-            # get sub spectrum for this bar
-            subspec = bs[self.minrow:self.maxrow]
-            # now loop over dispersions
-            for di, disp in enumerate(disps):
-                # populate the coefficients
-                coeff[4] = p0[b]
-                coeff[3] = disp
-                cosbeta = disp / (self.PIX*ybin) * self.frame.rho() * \
-                    self.FCAM * 1.e-4
-                if cosbeta > 1.:
-                    cosbeta = 1.
-                beta = math.acos(cosbeta)
-                coeff[2] = -(self.PIX * ybin / self.FCAM) ** 2 * \
-                    math.sin(beta) / 2. / self.frame.rho() * 1.e4
-                coeff[1] = -(self.PIX * ybin / self.FCAM) ** 3 * \
-                    math.cos(beta) / 6. / self.frame.rho() * 1.e4
-                coeff[0] = (self.PIX * ybin / self.FCAM) ** 4 * \
-                    math.sin(beta) / 24. / self.frame.rho() * 1.e4
-                # what are the min and max wavelengths to consider?
-                wl0 = np.polyval(coeff, self.xvals[self.minrow])
-                wl1 = np.polyval(coeff, self.xvals[self.maxrow])
-                minwvl = np.nanmin([wl0, wl1])
-                maxwvl = np.nanmax([wl0, wl1])
-                # where will we need to interpolate to cross-correlate?
-                minrw = [i for i, v in enumerate(self.refwave)
-                         if v >= minwvl][0]
-                maxrw = [i for i, v in enumerate(self.refwave)
-                         if v <= maxwvl][-1]
-                subrefwvl = self.refwave[minrw:maxrw]
-                # need a copy to avoid altering original
-                subrefspec = self.reflux[minrw:maxrw].copy()
-                # get bell cosine taper to avoid nasty edge effects
-                tkwgt = signal.windows.tukey(len(subrefspec),
-                                             alpha=self.frame.taperfrac())
-                # apply taper to atlas spectrum
-                subrefspec *= tkwgt
-                # adjust wavelengths
-                waves = np.polyval(coeff, subxvals)
-                # interpolate the bar spectrum
-                obsint = interpolate.interp1d(waves, subspec, kind='cubic',
-                                              bounds_error=False,
-                                              fill_value='extrapolate')
-                intspec = obsint(subrefwvl)
-                # apply taper to bar spectrum
-                intspec *= tkwgt
-                # get a label
-                # cross correlate the interpolated spectrum with the atlas spec
-                nsamp = len(subrefwvl)
-                offar = np.arange(1 - nsamp, nsamp)
-                # Cross-correlate
-                xcorr = np.correlate(intspec, subrefspec, mode='full')
-                # Get central region
-                x0c = int(len(xcorr) / 3)
-                x1c = int(2 * (len(xcorr) / 3))
-                xcorr_central = xcorr[x0c:x1c]
-                offar_central = offar[x0c:x1c]
-                # Calculate offset
-                maxima.append(xcorr_central[xcorr_central.argmax()])
-                shifts.append(offar_central[xcorr_central.argmax()])
-            # Get interpolations
-            int_max = interpolate.interp1d(disps, maxima, kind='cubic',
-                                           bounds_error=False,
-                                           fill_value='extrapolate')
-            int_shift = interpolate.interp1d(disps, shifts, kind='cubic',
-                                             bounds_error=False,
-                                             fill_value='extrapolate')
-            xdisps = np.linspace(min(disps), max(disps), num=nn*100)
-            # get peak values
-            maxima_res = int_max(xdisps)
-            shifts_res = int_shift(xdisps) * self.refdisp
-            bardisp.append(xdisps[maxima_res.argmax()])
-            barshift.append(shifts_res[maxima_res.argmax()])
+        for b in range(len(self.arcs)):
+            bardisp.append(xdisps[imax[b]])
+            barshift.append(shifts_res[b, imax[b]])
             # update coeffs
-            coeff[4] = p0[b] - barshift[-1]
-            coeff[3] = bardisp[-1]
-            cosbeta = coeff[3] / (self.PIX * ybin) * self.frame.rho() * \
-                self.FCAM * 1.e-4
-            if cosbeta > 1.:
-                cosbeta = 1.
-            beta = math.acos(cosbeta)
-            coeff[2] = -(self.PIX * ybin / self.FCAM) ** 2 * \
-                math.sin(beta) / 2. / self.frame.rho() * 1.e4
-            coeff[1] = -(self.PIX * ybin / self.FCAM) ** 3 * \
-                math.cos(beta) / 6. / self.frame.rho() * 1.e4
-            coeff[0] = (self.PIX * ybin / self.FCAM) ** 4 * \
-                math.sin(beta) / 24. / self.frame.rho() * 1.e4
+            coeff = self.disp_coeff(p0[b] - barshift[-1], bardisp[-1])
             scoeff = pascal_shift(coeff, self.x0)
             self.log.info("Central Fit: Bar#, Cdisp, Coefs: "
                           "%3d  %.4f  %.2f  %.4f  %13.5e %13.5e" %
@@ -1319,8 +1891,8 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
             if self.frame.inter() >= 1:
                 # plot maxima
                 pl.clf()
-                pl.plot(disps, maxima, 'r.', label='Data', ms=8)
-                pl.plot(xdisps, int_max(xdisps), '-', label='Interp')
+                pl.plot(disps, maxima[b], 'r.', label='Data', ms=8)
+                pl.plot(xdisps, maxima_res[b], '-', label='Interp')
                 ylim = pl.gca().get_ylim()
                 pl.plot([bardisp[-1], bardisp[-1]], ylim, 'g--',
                         label='Peak Disp')
@@ -1395,51 +1967,30 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
         self.log.info(self.fit_center.__qualname__)
     # END: fit_center()
 
-    def get_atlas_lines(self):
-        """Get relevant atlas line positions and wavelengths"""
-        if KcwiConf.INTER >= 3:
-            do_inter = True
-            pl.ion()
-        else:
-            do_inter = False
+    def find_atlas_lines(self, atwave, atspec):
+        """Isolated, well fitted lines of an atlas spectrum
 
-        # get atlas wavelength range
-        #
-        # get pixel values (no longer centered in the middle)
-        specsz = len(self.arcs[self.REFBAR])
-        xvals = np.arange(0, specsz)
-        # min, max rows
-        minrow = 50
-        maxrow = specsz-50
-        # wavelength range
-        mnwvs = []
-        mxwvs = []
-        # Get wavelengths
-        for b in range(self.NBARS):
-            waves = np.polyval(self.twkcoeff[b], xvals)
-            mnwvs.append(np.min(waves))
-            mxwvs.append(np.max(waves))
-        minwav = min(mnwvs) + 10.
-        maxwav = max(mxwvs) - 10.
-        # Get corresponding atlas range
-        minrw = [i for i, v in enumerate(self.refwave) if v >= minwav][0]
-        maxrw = [i for i, v in enumerate(self.refwave) if v <= maxwav][-1]
-        self.log.info("Min, Max wave (A): %.2f, %.2f" % (minwav, maxwav))
-        # store atlas ranges
-        self.atminrow = minrw
-        self.atmaxrow = maxrw
-        self.atminwave = minwav
-        self.atmaxwave = maxwav
-        # get atlas sub spectrum
-        atspec = self.reflux[minrw:maxrw]
-        atwave = self.refwave[minrw:maxrw]
-        # get reference bar spectrum
-        subxvals = xvals[minrow:maxrow]
-        subyvals = self.arcs[self.REFBAR][minrow:maxrow].copy()
-        subwvals = np.polyval(self.twkcoeff[self.REFBAR], subxvals)
-        # smooth subyvals
-        win = boxcar(3)
-        subyvals = sp.signal.convolve(subyvals, win, mode='same') / sum(win)
+        The line list goes through the calibration cache, keyed by the
+        spectrum and the resolution, so it is only measured once.
+
+        Returns:
+        --------
+            dict: refws and refas, wavelengths and peaks of the lines kept,
+                init_cent, all peaks found, rej_neigh_w, rej_fit_w,
+                rej_par_w and rej_par_a, lines rejected and nrej
+        """
+        cache = CalibCache.open()
+        # method names the line measurement, so that lists cached by an
+        # earlier algorithm are not reused
+        key = cache.key('atlas_lines', method='linefit1',
+                        spectrum=hashlib.sha256(atspec.tobytes()).hexdigest(),
+                        wave=hashlib.sha256(atwave.tobytes()).hexdigest(),
+                        resolution=self.frame.resolution(),
+                        refdisp=self.refdisp)
+        lines = cache.get(key)
+        if lines is not None:
+            self.log.info("Using cached atlas line list")
+            return lines
         # find good peaks in arc spectrum
         smooth_width = 4                                            # in pixels
         ampl_thresh = 0.
@@ -1491,40 +2042,45 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
         rej_par_w = []
         rej_par_a = []
         nrej = 0
+        # find a window for each peak, all at once
+        line_xs = np.searchsorted(atwave, spec_cent, side='left')
+        minows, maxows, counts = get_line_windows(atspec, line_xs)
+        windows = []
         for i, pk in enumerate(spec_cent):
-
-            # Fit Atlas Peak
-            line_x = [i for i, v in enumerate(atwave) if v >= pk][0]
-            minow, maxow, count = get_line_window(atspec, line_x)
+            minow, maxow, count = minows[i], maxows[i], counts[i]
             if count < 5 or not minow or not maxow:
+                windows.append(None)
+            else:
+                windows.append((minow, maxow))
+        # fit all the atlas peaks at once
+        inwin = [w for w in windows if w is not None]
+        if inwin:
+            xw, yw, mask = linefit.pad_windows(atspec, atwave,
+                                               [w[0] for w in inwin],
+                                               [w[1] for w in inwin])
+            fits, fit_ok = linefit.fit_gaussians(xw, yw, mask)
+            pkws, pkas = linefit.spline_peaks(xw, yw, mask)
+        il = 0
+        for i, pk in enumerate(spec_cent):
+            if windows[i] is None:
                 rej_fit_w.append(pk)
                 nrej += 1
                 self.log.info("Atlas window rejected for line %.3f" % pk)
                 continue
-            yvec = atspec[minow:maxow + 1]
-            xvec = atwave[minow:maxow + 1]
-            try:
-                fit, _ = curve_fit(gaus, xvec, yvec, p0=[100., pk, 1.])
-            except RuntimeError:
+            fit, pkw, pka = fits[il], pkws[il], pkas[il]
+            ok = fit_ok[il]
+            il += 1
+            if not ok:
                 rej_fit_w.append(pk)
                 nrej += 1
                 self.log.info("Atlas Gaussian fit rejected for line %.3f" % pk)
                 continue
-            int_line = interpolate.interp1d(xvec, yvec, kind='cubic',
-                                            bounds_error=False,
-                                            fill_value='extrapolate')
-            x_dense = np.linspace(min(xvec), max(xvec), num=1000)
-            # get peak value
-            y_dense = int_line(x_dense)
-            pki = y_dense.argmax()
-            pkw = x_dense[pki]
-            # pka = yvec.argmax()
             xoff = abs(pkw - fit[1]) / self.refdisp     # in pixels
             woff = abs(pkw - pk)                        # in Angstroms
             wrat = abs(fit[2]) / fwid                   # can be neg or pos
             if woff > 1. or xoff > 1. or wrat > 1.1:
                 rej_par_w.append(pkw)
-                rej_par_a.append(y_dense[pki])
+                rej_par_a.append(pka)
                 nrej += 1
                 self.log.info("Atlas line parameters rejected for line %.3f" %
                               pk)
@@ -1532,7 +2088,71 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
                               (woff, xoff, wrat))
                 continue
             refws.append(pkw)
-            refas.append(y_dense[pki])
+            refas.append(pka)
+        return cache.put(key, {'init_cent': np.array(init_cent),
+                               'rej_neigh_w': np.array(rej_neigh_w),
+                               'rej_fit_w': np.array(rej_fit_w),
+                               'rej_par_w': np.array(rej_par_w),
+                               'rej_par_a': np.array(rej_par_a),
+                               'refws': np.array(refws),
+                               'refas': np.array(refas),
+                               'nrej': nrej})
+
+    def get_atlas_lines(self):
+        """Get relevant atlas line positions and wavelengths"""
+        if KcwiConf.INTER >= 3:
+            do_inter = True
+            pl.ion()
+        else:
+            do_inter = False
+
+        # get atlas wavelength range
+        #
+        # get pixel values (no longer centered in the middle)
+        specsz = len(self.arcs[self.REFBAR])
+        xvals = np.arange(0, specsz)
+        # min, max rows
+        minrow = 50
+        maxrow = specsz-50
+        # wavelength range
+        mnwvs = []
+        mxwvs = []
+        # Get wavelengths
+        for b in range(self.NBARS):
+            waves = np.polyval(self.twkcoeff[b], xvals)
+            mnwvs.append(np.min(waves))
+            mxwvs.append(np.max(waves))
+        minwav = min(mnwvs) + 10.
+        maxwav = max(mxwvs) - 10.
+        # Get corresponding atlas range
+        minrw = [i for i, v in enumerate(self.refwave) if v >= minwav][0]
+        maxrw = [i for i, v in enumerate(self.refwave) if v <= maxwav][-1]
+        self.log.info("Min, Max wave (A): %.2f, %.2f" % (minwav, maxwav))
+        # store atlas ranges
+        self.atminrow = minrw
+        self.atmaxrow = maxrw
+        self.atminwave = minwav
+        self.atmaxwave = maxwav
+        # get atlas sub spectrum
+        atspec = self.reflux[minrw:maxrw]
+        atwave = self.refwave[minrw:maxrw]
+        # get reference bar spectrum
+        subxvals = xvals[minrow:maxrow]
+        subyvals = self.arcs[self.REFBAR][minrow:maxrow].copy()
+        subwvals = np.polyval(self.twkcoeff[self.REFBAR], subxvals)
+        # smooth subyvals
+        win = boxcar(3)
+        subyvals = sp.signal.convolve(subyvals, win, mode='same') / sum(win)
+        # measure the atlas lines, or reuse a line list already measured
+        lines = self.find_atlas_lines(atwave, atspec)
+        init_cent = lines['init_cent']
+        rej_neigh_w = lines['rej_neigh_w']
+        rej_fit_w = lines['rej_fit_w']
+        rej_par_w = lines['rej_par_w']
+        rej_par_a = lines['rej_par_a']
+        refws = list(lines['refws'])
+        refas = lines['refas']
+        nrej = lines['nrej']
         # store wavelengths
         self.at_wave = refws
         # plot results
@@ -1604,6 +2224,28 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
             pl.pause(self.frame.plotpause())
     # END: get_atlas_lines()
 
+    def solve_bars(self, bspecs, coeffs, thresh, lines=False,
+                   verbose=False):
+        """solve_bar() for each bar, in bar order
+
+        Bars are independent, so when KcwiConf.NPROCS > 1 they are solved
+        on a process pool, with the same results as one after the other.
+        """
+        nprocs = min(self.nprocs(), len(bspecs))
+        args = [(bspec, coeff, self.at_wave, thresh, lines, verbose)
+                for bspec, coeff in zip(bspecs, coeffs)]
+        t0 = time.time()
+        if nprocs > 1:
+            with ProcessPoolExecutor(max_workers=nprocs) as pool:
+                solutions = list(pool.map(
+                    solve_bar, *zip(*args),
+                    chunksize=int(math.ceil(len(args) / nprocs))))
+        else:
+            solutions = [solve_bar(*a) for a in args]
+        self.log.info("Solved %d bars with %d processes in %.1f s" %
+                      (len(solutions), nprocs, time.time() - t0))
+        return solutions
+
     def solve_arcs(self):
         """Solve the bar arc wavelengths"""
         if KcwiConf.INTER >= 2:
@@ -1627,189 +2269,91 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
         atspec = self.reflux[self.atminrow:self.atmaxrow]
         # get x values starting at zero pixels
         self.xsvals = np.arange(0, len(self.arcs[self.REFBAR]))
-        # loop over arcs and generate a wavelength solution for each
-        for ib, b in enumerate(self.arcs):
-            # print("")
-            # self.log.info("BAR %d" % ib)
-            # print("")
-            # Starting pascal shifted coeffs from fit_center()
-            coeff = self.twkcoeff[ib]
-            # get bar wavelengths
-            bw = np.polyval(coeff, self.xsvals)
-            # smooth spectrum according to slicer
-            if 'Small' in self.frame.ifuname():
-                bspec = b
+        # smooth spectra according to slicer
+        if 'Small' in self.frame.ifuname():
+            bspecs = list(self.arcs)
+        else:
+            if 'Large' in self.frame.ifuname():
+                win = boxcar(5)
             else:
-                if 'Large' in self.frame.ifuname():
-                    win = boxcar(5)
-                else:
-                    win = boxcar(3)
-                bspec = sp.signal.convolve(b, win, mode='same') / sum(win)
-            # spmode = mode(np.round(bspec))
-            # spmed = np.nanmedian(bspec)
-            # self.log.info("Arc spec median = %.3f, mode = %d" %
-            #              (spmed, spmode.mode[0]))
-            # store values to fit
-            at_wave_dat = []
-            arc_pix_dat = []
-            rej_wave = []
-            nrej = 0
-            # loop over lines
-            for iw, aw in enumerate(self.at_wave):
-                # get window for this line
-                try:
-                    line_x = [i for i, v in enumerate(bw) if v >= aw][0]
-                    minow, maxow, count = get_line_window(bspec, line_x,
-                                                          thresh=hgt)
-                    if count < 5 or not minow or not maxow:
-                        rej_wave.append(aw)
-                        nrej += 1
-                        if verbose:
-                            self.log.info("Arc window rejected for line %.3f"
-                                          % aw)
-                        continue
-                    # check if window no longer contains initial value
-                    if minow > line_x > maxow:
-                        rej_wave.append(aw)
-                        nrej += 1
-                        if verbose:
-                            self.log.info(
-                                "Arc window wandered off for line %.3f" % aw)
-                        continue
-                    yvec = bspec[minow:maxow+1]
-                    xvec = self.xsvals[minow:maxow+1]
-                    wvec = bw[minow:maxow+1]
-                    max_value = yvec[yvec.argmax()]
-                    # Gaussian fit
-                    try:
-                        fit, _ = curve_fit(gaus, xvec, yvec,
-                                           p0=[100., line_x, 1.])
-                    except RuntimeError:
-                        nrej += 1
-                        if verbose:
-                            self.log.info(
-                                "Arc Gaussian fit rejected for line %.3f" % aw)
-                        continue
-                    sp_pk_x = fit[1]
-                    # Get interpolation
-                    int_line = interpolate.interp1d(xvec, yvec, kind='cubic',
-                                                    bounds_error=False,
-                                                    fill_value='extrapolate')
-                    xplot = np.linspace(min(xvec), max(xvec), num=1000)
-                    # get peak value
-                    plt_line = int_line(xplot)
-                    max_index = plt_line.argmax()
-                    peak = xplot[max_index]
-                    # Calculate centroid
-                    cent = np.sum(xvec * yvec) / np.sum(yvec)
-                    if abs(cent - peak) > 0.7:
-                        rej_wave.append(aw)
-                        nrej += 1
-                        if verbose:
-                            self.log.info("Arc peak - cent offset rejected for "
-                                          "line %.3f" % aw)
-                        continue
-                    # store data
-                    arc_pix_dat.append(peak)
-                    at_wave_dat.append(aw)
-                    # plot, if requested
-                    if do_inter:
-                        ptitle = "Bar: %d - %3d/%3d: x0, x1, Cent, Wave = " \
-                                 "%d, %d, %8.1f, %9.2f" % \
-                                 (ib, (iw + 1), len(self.at_wave),
-                                  minow, maxow, cent, aw)
-                        atx0 = [i for i, v in enumerate(atwave) if v >= min(wvec)][0]
-                        atx1 = [i for i, v in enumerate(atwave) if v >= max(wvec)][0]
-                        atnorm = np.nanmax(yvec) / np.nanmax(atspec[atx0:atx1])
-                        pl.clf()
-                        pl.plot(wvec, yvec, 'k--', label='Arc')
-                        pl.plot(wvec, yvec, 'r.')
-                        ylim = [0, pl.gca().get_ylim()[1]]
-                        pl.plot(atwave[atx0:atx1], atspec[atx0:atx1] * atnorm,
-                                'g-.', label='Atlas')
-                        pl.plot([aw, aw], ylim, 'r-.', label='W in')
-                        pl.xlabel("Wavelength (A)")
-                        pl.ylabel("Relative Flux")
-                        pl.ylim(ylim)
-                        pl.title(ptitle)
-                        pl.legend()
-                        input("next - <cr>: ")
-                        pl.clf()
-                        pl.plot(xvec, yvec, 'r.', label='Data')
-                        pl.plot(xplot, plt_line, label='Interp')
-                        ylim = [0, pl.gca().get_ylim()[1]]
-                        xlim = pl.gca().get_xlim()
-                        pl.plot(xlim, [max_value*0.5, max_value*0.5], 'k--')
-                        pl.plot([cent, cent], ylim, 'g--', label='Cntr')
-                        pl.plot([line_x, line_x], ylim, 'r-.', label='X in')
-                        pl.plot([peak, peak], ylim, 'c-.', label='Peak')
-                        pl.plot([sp_pk_x, sp_pk_x], ylim, 'm-.', label='Gpeak')
-                        pl.xlabel("CCD Y (px)")
-                        pl.ylabel("Flux (DN)")
-                        pl.ylim(ylim)
-                        pl.title(ptitle)
-                        pl.legend()
-
-                        q = input(ptitle + "; <cr> - Next, q to quit: ")
-                        if 'Q' in q.upper():
-                            do_inter = False
-                            pl.ioff()
-                except IndexError:
-                    if verbose:
-                        self.log.info("Atlas line not in observation: %.2f" % aw)
-                    rej_wave.append(aw)
-                    nrej += 1
-                    continue
-                except ValueError:
-                    if verbose:
-                        self.log.info("Interpolation error for line at %.2f" % aw)
-                    rej_wave.append(aw)
-                    nrej += 1
+                win = boxcar(3)
+            bspecs = [sp.signal.convolve(b, win, mode='same') / sum(win)
+                      for b in self.arcs]
+        # solve the bars, starting with the pascal shifted coeffs from
+        # fit_center(), on a process pool if configured
+        solutions = self.solve_bars(bspecs, self.twkcoeff, hgt,
+                                    lines=do_inter, verbose=verbose)
+        # plots are all made here, in bar order
+        for ib, b in enumerate(self.arcs):
+            sol = solutions[ib]
+            # plot lines, if requested
+            for ln in (sol['lines'] if do_inter else ()):
+                ptitle = "Bar: %d - %3d/%3d: x0, x1, Cent, Wave = " \
+                         "%d, %d, %8.1f, %9.2f" % \
+                         (ib, (ln['iw'] + 1), len(self.at_wave),
+                          ln['minow'], ln['maxow'], ln['cent'], ln['aw'])
+                wvec = ln['wvec']
+                yvec = ln['yvec']
+                atx0 = [i for i, v in enumerate(atwave)
+                        if v >= min(wvec)][0]
+                atx1 = [i for i, v in enumerate(atwave)
+                        if v >= max(wvec)][0]
+                atnorm = np.nanmax(yvec) / np.nanmax(atspec[atx0:atx1])
+                pl.clf()
+                pl.plot(wvec, yvec, 'k--', label='Arc')
+                pl.plot(wvec, yvec, 'r.')
+                ylim = [0, pl.gca().get_ylim()[1]]
+                pl.plot(atwave[atx0:atx1], atspec[atx0:atx1] * atnorm,
+                        'g-.', label='Atlas')
+                pl.plot([ln['aw'], ln['aw']], ylim, 'r-.', label='W in')
+                pl.xlabel("Wavelength (A)")
+                pl.ylabel("Relative Flux")
+                pl.ylim(ylim)
+                pl.title(ptitle)
+                pl.legend()
+                input("next - <cr>: ")
+                pl.clf()
+                pl.plot(ln['xvec'], yvec, 'r.', label='Data')
+                pl.plot(ln['xplot'], ln['plt_line'], label='Interp')
+                ylim = [0, pl.gca().get_ylim()[1]]
+                xlim = pl.gca().get_xlim()
+                pl.plot(xlim, [ln['max_value']*0.5, ln['max_value']*0.5],
+                        'k--')
+                pl.plot([ln['cent'], ln['cent']], ylim, 'g--', label='Cntr')
+                pl.plot([ln['line_x'], ln['line_x']], ylim, 'r-.',
+                        label='X in')
+                pl.plot([ln['peak'], ln['peak']], ylim, 'c-.', label='Peak')
+                pl.plot([ln['sp_pk_x'], ln['sp_pk_x']], ylim, 'm-.',
+                        label='Gpeak')
+                pl.xlabel("CCD Y (px)")
+                pl.ylabel("Flux (DN)")
+                pl.ylim(ylim)
+                pl.title(ptitle)
+                pl.legend()
+
+                q = input(ptitle + "; <cr> - Next, q to quit: ")
+                if 'Q' in q.upper():
+                    do_inter = False
+                    pl.ioff()
+                    break
             self.log.info("Fitting wavelength solution starting with %d "
                           "lines after rejecting %d lines" %
-                          (len(arc_pix_dat), nrej))
-            # Fit wavelengths
-            # Initial fit
-            wfit = np.polyfit(arc_pix_dat, at_wave_dat, 4)
+                          (sol['nstart'], sol['nrej']))
+            wfit = sol['wfit']
             pwfit = np.poly1d(wfit)
-            arc_wave_fit = pwfit(arc_pix_dat)
-            resid = arc_wave_fit - at_wave_dat
-            resid_c, low, upp = sigmaclip(resid, low=3., high=3.)
-            wsig = resid_c.std()
-            rej_rsd = []
-            rej_rsd_wave = []
-            # Iteratively remove outliers
-            for it in range(4):
-                # self.log.info("Iteration %d" % it)
-                arc_dat = []
-                at_dat = []
-                # Trim outliers
-                for il, rsd in enumerate(resid):
-                    if low < rsd < upp:
-                        arc_dat.append(arc_pix_dat[il])
-                        at_dat.append(at_wave_dat[il])
-                    else:
-                        # self.log.info("REJ: %d, %.2f, %.3f" %
-                        #              (il, arc_pix_dat[il], at_wave_dat[il]))
-                        rej_rsd_wave.append(at_wave_dat[il])
-                        rej_rsd.append(rsd)
-                # refit
-                arc_pix_dat = arc_dat.copy()
-                at_wave_dat = at_dat.copy()
-                wfit = np.polyfit(arc_pix_dat, at_wave_dat, 4)
-                pwfit = np.poly1d(wfit)
-                arc_wave_fit = pwfit(arc_pix_dat)
-                resid = arc_wave_fit - at_wave_dat
-                resid_c, low, upp = sigmaclip(resid, low=3., high=3.)
-                wsig = np.nanstd(resid)
+            wsig = sol['wsig']
+            at_wave_dat = sol['at_wave_dat']
+            arc_wave_fit = sol['arc_wave_fit']
+            resid = sol['resid']
+            rej_rsd_wave = sol['rej_rsd_wave']
+            rej_rsd = sol['rej_rsd']
+            rej_wave = sol['rej_wave']
             # store results
-            # print("")
             self.log.info("Bar %03d, Slice = %02d, RMS = %.3f, N = %d" %
-                          (ib, int(ib / 5), wsig, len(arc_pix_dat)))
-            # print("")
+                          (ib, int(ib / 5), wsig, len(at_wave_dat)))
             self.fincoeff.append(wfit)
             bar_sig.append(wsig)
-            bar_nls.append(len(arc_pix_dat))
+            bar_nls.append(len(at_wave_dat))
             # plot bar fit residuals
             if master_inter:
                 pl.ion()
@@ -1822,7 +2366,7 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
                 pl.ylabel("Fit - Inp (A)")
                 pl.title(self.frame.plotlabel() +
                          " Bar = %03d, Slice = %02d, RMS = %.3f, N = %d" %
-                         (ib, int(ib / 5), wsig, len(arc_pix_dat)))
+                         (ib, int(ib / 5), wsig, len(at_wave_dat)))
                 xlim = [self.atminwave, self.atmaxwave]
                 pl.plot(xlim, [0., 0.], '-')
                 pl.plot(xlim, [wsig, wsig], '-.', color='gray')
@@ -1849,7 +2393,7 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
                 pl.ylabel("Flux")
                 pl.title(self.frame.plotlabel() +
                          " Bar = %03d, Slice = %02d, RMS = %.3f, N = %d" %
-                         (ib, int(ib/5), wsig, len(arc_pix_dat)))
+                         (ib, int(ib/5), wsig, len(at_wave_dat)))
                 leg_first = True
                 for w in self.at_wave:
                     if leg_first:
@@ -2052,8 +2596,7 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
         # Output variables
         xl0_out = []
         xl1_out = []
-        tform_list = []
-        invtf_list = []
+        points = []
         # Loop over 24 slices
         for isl in range(0, 24):
             # Get control points
@@ -2087,15 +2630,15 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
                           (isl, xl0, xl1))
             # adjust control points
             xit = [x - float(xl0) for x in xi]
-            # fit transform
+            # control points to fit
             dst = np.column_stack((xit, yi))
             src = np.column_stack((xw, yw))
-            self.log.info("Fitting wavelength and spatial control points")
-            tform = tf.estimate_transform('polynomial', src, dst, order=3)
-            invtf = tf.estimate_transform('polynomial', dst, src, order=3)
-            # Store for output
-            tform_list.append(tform)
-            invtf_list.append(invtf)
+            points.append((src, dst))
+        # fit transforms, slices in parallel if configured
+        self.log.info("Fitting wavelength and spatial control points")
+        fits = self.process_slices(fit_slice, points)
+        tform_list = [tform for tform, invtf in fits]
+        invtf_list = [invtf for tform, invtf in fits]
         # Pixel scales
         pxscl = KcwiConf.PIXSCALE * self.frame.xbinsize()
         ifunum = self.frame.ifunum()
@@ -2108,7 +2651,7 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
         # Package geometry data
         ofname = self.frame.header['OFNAME']
         self.geom_file = os.path.join(conf.REDUXDIR,
-                                      ofname.split('.')[0] + '_geom.pkl')
+                                      ofname.split('.')[0] + '_geom.fits')
         if os.path.exists(self.geom_file):
             self.log.error("Geometry file already exists: %s" % self.geom_file)
         else:
@@ -2127,8 +2670,9 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
                 "xl0": xl0_out, "xl1": xl1_out,
                 "tform": tform_list, "invtf": invtf_list
             }
-            with open(self.geom_file, 'wb') as ofile:
-                pickle.dump(geom, ofile)
+            # with the resampling coordinates reused by every cube
+            write_geom(self.geom_file, geom,
+                       coords=coord_maps(tform_list, ysize, xsize))
             self.log.info("Geometry written to: %s" % self.geom_file)
         logstr = self.solve_geom.__module__ + "." + \
                  self.solve_geom.__qualname__
@@ -2136,11 +2680,186 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
         self.log.info(self.solve_geom.__qualname__)
     # END: solve_geom()
 
+    def write_coord_maps(self, geom, geom_file=None):
+        """Compute and save the resampling coordinates of a geometry
+
+        The (row, column) input coordinates of every output pixel of
+        every slice are written next to the geometry file, so that cubes
+        made with the same geometry only need to interpolate.
+        """
+        if geom_file is None:
+            geom_file = geom['geom_file']
+        coords = coord_maps(geom['tform'], geom['ysize'], geom['xsize'])
+        maps_file = coord_maps_file(geom_file)
+        tmp = maps_file + '.tmp'
+        with open(tmp, 'wb') as ofile:
+            np.save(ofile, coords)
+        os.replace(tmp, maps_file)
+        self.log.info("Coordinate maps written to: %s" % maps_file)
+        return coords
+
+    def read_coord_maps(self, geom, geom_file):
+        """Resampling coordinates of a geometry, memory mapped
+
+        Maps missing, older than the geometry file or of the wrong shape
+        are recomputed and saved next to the geometry file.
+        """
+        shape = (len(geom['tform']), 2, geom['ysize'], geom['xsize'])
+        cache = CalibCache.open()
+        key = cache.key('coords', [geom_file])
+        value = cache.get(key)
+        if value is not None:
+            return value['coords']
+        coords = load_coord_maps(geom_file)
+        if coords is None or coords.shape != shape:
+            coords = self.write_coord_maps(geom, geom_file)
+        # the maps are stored with the geometry, only keep them in memory
+        cache.put(key, {'coords': coords}, persist=False)
+        return coords
+
+    def read_geometry(self, geom_file):
+        """Geometry solved by solve_geom(), through the calibration cache
+
+        The geometry file is only read and checked once per process.
+
+        Raises:
+        -------
+            ValueError: unknown schema version or content hash mismatch
+        """
+        cache = CalibCache.open()
+        return cache.fetch(cache.key('geometry', [geom_file]),
+                           lambda: read_geom(geom_file), persist=False)
+
+    def nprocs(self):
+        """Process pool size for slices and bars, capped at the CPU count"""
+        return max(1, min(self.frame.nprocs(), os.cpu_count() or 1))
+
+    def process_slices(self, func, args):
+        """Call func(*a) for each slice's a in args
+
+        Slices are independent, so when KcwiConf.NPROCS > 1 the calls go
+        to a process pool.  Results are returned in slice order either
+        way.
+        """
+        nprocs = min(self.nprocs(), len(args))
+        if nprocs > 1:
+            with ProcessPoolExecutor(max_workers=nprocs) as pool:
+                futures = [pool.submit(func, *a) for a in args]
+                return [f.result() for f in futures]
+        else:
+            return [func(*a) for a in args]
+
+    def warp_cube(self, data_img, geom, geom_file, nprocs):
+        """Resample all slices on a process pool
+
+        The image and the output cube are shared with the workers as
+        file-backed arrays (in /dev/shm, where available) instead of
+        being pickled, and the coordinate maps are memory mapped from
+        their file, which is written first if needed.  Every slice goes
+        through the same tf.warp call, so the cube does not depend on
+        nprocs.
+        """
+        cube_shape = (geom['ysize'], geom['xsize'], 24)
+        # the workers memory map the maps from their file
+        coords = load_coord_maps(geom_file)
+        if coords is None or coords.shape != (len(geom['tform']), 2,
+                                              geom['ysize'], geom['xsize']):
+            self.write_coord_maps(geom, geom_file)
+        del coords
+        shmdir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        files = []
+        try:
+            for suffix in ('.image', '.cube'):
+                fd, fname = tempfile.mkstemp(suffix=suffix, dir=shmdir)
+                os.close(fd)
+                files.append(fname)
+            image_file, cube_file = files
+            image = np.memmap(image_file, dtype=np.float64, mode='w+',
+                              shape=data_img.shape)
+            image[:] = data_img
+            image.flush()
+            del image
+            cube = np.memmap(cube_file, dtype=np.float64, mode='w+',
+                             shape=cube_shape)
+            slices = [(isl, geom['xl0'][isl], geom['xl1'][isl])
+                      for isl in range(0, 24)]
+            with ProcessPoolExecutor(max_workers=nprocs) as pool:
+                futures = [pool.submit(warp_slices, image_file,
+                                       data_img.shape,
+                                       geom_file, cube_file,
+                                       cube_shape, slices[i::nprocs])
+                           for i in range(nprocs)]
+                for f in futures:
+                    f.result()
+            out_cube = np.array(cube)
+            del cube
+        finally:
+            for fname in files:
+                os.remove(fname)
+        return out_cube
+
+    def read_drizzle_matrices(self, geom, geom_file, ny):
+        """Drizzle matrices of a geometry, one per slice
+
+        Built from the inverse slice transforms for images of ny rows and
+        saved next to the geometry file; matrices already read are kept
+        for the process.
+
+        Returns:
+        --------
+            list: drizzle.slice_operators() of each slice's matrix
+        """
+        matrix_file = os.path.splitext(geom_file)[0] + '_drizzle.npz'
+        ncols = [xl1 - xl0 for xl0, xl1 in zip(geom['xl0'], geom['xl1'])]
+        key = (os.path.abspath(matrix_file), os.path.getmtime(geom_file), ny)
+        operators = drizzle.open_matrices.get(key)
+        if operators is not None:
+            return operators
+        matrices = None
+        if os.path.exists(matrix_file) and \
+                os.path.getmtime(matrix_file) >= os.path.getmtime(geom_file):
+            matrices = drizzle.load_matrices(matrix_file)
+        if matrices is None or \
+                [m.shape[1] for m in matrices] != [ny * n for n in ncols]:
+            self.log.info("Building drizzle matrices")
+            matrices = []
+            for isl in range(0, 24):
+                good, xpos, ypos = slice_maps(geom['invtf'][isl],
+                                              geom['xl0'][isl],
+                                              geom['xl1'][isl], ny,
+                                              geom['xsize'])
+                matrices.append(drizzle.drizzle_matrix(
+                    xpos, ypos, geom['xsize'], geom['ysize']))
+            drizzle.save_matrices(matrix_file, matrices)
+            self.log.info("Drizzle matrices written to: %s" % matrix_file)
+        operators = [drizzle.slice_operators(m) for m in matrices]
+        drizzle.open_matrices[key] = operators
+        return operators
+
+    def write_aux_image(self, data, suffix=None):
+        """Write an image that goes with the current frame, e.g. a cube's
+        coverage, with a copy of the frame header"""
+        if suffix is not None:
+            origfn = self.frame.header['OFNAME']
+            outfn = os.path.join(conf.REDUXDIR,
+                                 origfn.split('.')[0]+'_'+suffix+'.fits')
+            if not conf.OVERWRITE and os.path.exists(outfn):
+                self.log.error("output file exists: %s" % outfn)
+            else:
+                hdr = self.frame.header.copy()
+                hdr.pop('BUNIT', None)
+                pf.writeto(outfn, data, header=hdr, overwrite=conf.OVERWRITE)
+                self.log.info("output file: %s" % outfn)
+
     def generate_maps(self):
         """Generate map images"""
+        geom = None
         if self.geom_file is not None and os.path.exists(self.geom_file):
-            with open(self.geom_file, 'rb') as ifile:
-                geom = pickle.load(ifile)
+            try:
+                geom = self.read_geometry(self.geom_file)
+            except ValueError as e:
+                self.log.error(str(e))
+        if geom is not None:
             # get geometry params
             xl0s = geom['xl0']
             xl1s = geom['xl1']
@@ -2155,22 +2874,21 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
             wave_map_img = np.full_like(data_img, fill_value=-1.)
             xpos_map_img = np.full_like(data_img, fill_value=-1.)
             slice_map_img = np.full_like(data_img, fill_value=-1.)
-            # loop over slices
-            for isl in range(0, 24):
-                itrf = invtf_list[isl]
-                xl0 = xl0s[isl]
-                xl1 = xl1s[isl]
-                for ix in range(xl0, xl1):
-                    coords = np.zeros((ny, 2))
-                    for iy in range(0, ny):
-                        coords[iy, 0] = ix - xl0
-                        coords[iy, 1] = iy
-                    ncoo = itrf(coords)
-                    for iy in range(0, ny):
-                        if 0 <= ncoo[iy, 0] <= xsize:
-                            slice_map_img[iy, ix] = isl
-                            xpos_map_img[iy, ix] = ncoo[iy, 0]
-                            wave_map_img[iy, ix] = ncoo[iy, 1] * dw + wave0
+            # evaluate the slices, in threads if configured
+            args = [(invtf_list[isl], xl0s[isl], xl1s[isl], ny, xsize)
+                    for isl in range(0, 24)]
+            nthreads = self.frame.nthreads()
+            if nthreads > 1:
+                with ThreadPoolExecutor(max_workers=nthreads) as pool:
+                    maps = list(pool.map(lambda a: slice_maps(*a), args))
+            else:
+                maps = [slice_maps(*a) for a in args]
+            # fill in slice order, later slices overwriting any overlap
+            for isl, (good, xpos, ypos) in enumerate(maps):
+                cols = slice(xl0s[isl], xl1s[isl])
+                slice_map_img[:, cols][good] = isl
+                xpos_map_img[:, cols][good] = xpos[good]
+                wave_map_img[:, cols][good] = ypos[good] * dw + wave0
             # output maps
             self.frame.data = wave_map_img
             self.write_image(suffix='wavemap')
@@ -2206,10 +2924,14 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
         self.log.info("%d arc frames found" % len(tab))
         ofname = tab['OFNAME'][0]
         geom_file = os.path.join(conf.REDUXDIR,
-                                 ofname.split('.')[0] + '_geom.pkl')
+                                 ofname.split('.')[0] + '_geom.fits')
+        geom = None
         if os.path.exists(geom_file):
-            with open(geom_file, 'rb') as ifile:
-                geom = pickle.load(ifile)
+            try:
+                geom = self.read_geometry(geom_file)
+            except ValueError as e:
+                self.log.error(str(e))
+        if geom is not None:
             # Slice size
             xsize = geom['xsize']
             ysize = geom['ysize']
@@ -2220,9 +2942,28 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
             fig.set_size_inches(5, 12, forward=True)
             # Store original data
             data_img = self.frame.data
+            use_drizzle = KcwiConf.CUBE_METHOD == 'drizzle'
+            if use_drizzle:
+                # flux conserving, with variance and coverage cubes
+                matrices = self.read_drizzle_matrices(geom, geom_file,
+                                                      data_img.shape[0])
+                if isinstance(self.frame.uncertainty, VarianceUncertainty):
+                    var_img = self.frame.uncertainty.array
+                    var_cube = np.zeros((ysize, xsize, 24))
+                else:
+                    var_img = None
+                    var_cube = None
+                cov_cube = np.zeros((ysize, xsize, 24))
+            else:
+                nprocs = self.nprocs()
+                if nprocs > 1:
+                    out_cube = self.warp_cube(data_img, geom, geom_file,
+                                              nprocs)
+                else:
+                    # precomputed resampling coordinates
+                    coords = self.read_coord_maps(geom, geom_file)
             # Loop over 24 slices
             for isl in range(0, 24):
-                tform = geom['tform'][isl]
                 xl0 = geom['xl0'][isl]
                 xl1 = geom['xl1'][isl]
                 self.log.info("Transforming image slice %d" % isl)
@@ -2241,11 +2982,21 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
                 #        pl.ioff()
                 # else:
                 #    pl.pause(self.frame.plotpause())
-                warped = tf.warp(slice_img, tform, order=3,
-                                 output_shape=(ysize, xsize))
-                for iy in range(ysize):
-                    for ix in range(xsize):
-                        out_cube[iy, ix, isl] = warped[iy, ix]
+                if use_drizzle:
+                    warped, var, cov = drizzle_slice(
+                        matrices[isl], slice_img,
+                        None if var_img is None else var_img[:, xl0:xl1],
+                        shape=(ysize, xsize))
+                    out_cube[:, :, isl] = warped
+                    cov_cube[:, :, isl] = cov
+                    if var_cube is not None:
+                        var_cube[:, :, isl] = var
+                elif nprocs > 1:
+                    # already resampled by the process pool
+                    warped = out_cube[:, :, isl]
+                else:
+                    warped = tf.warp(slice_img, coords[isl], order=3)
+                    out_cube[:, :, isl] = warped
                 wmed = np.nanmedian(warped)
                 wstd = np.nanstd(warped)
                 pl.clf()
@@ -2398,8 +3149,15 @@ class KcwiPrimitives(CcdPrimitives, ImgmathPrimitives,
             # write out cube
             logstr = self.make_cube.__module__ + "." + \
                      self.make_cube.__qualname__
+            self.frame.header['CUBEMETH'] = (KcwiConf.CUBE_METHOD,
+                                             'Cube resampling method')
             self.frame.header['HISTORY'] = logstr
             self.frame.data = out_cube
+            if use_drizzle:
+                if var_cube is not None:
+                    self.frame.uncertainty = VarianceUncertainty(
+                        var_cube, unit=self.frame.uncertainty.unit)
+                self.write_aux_image(cov_cube, suffix='ecube')
         else:
             self.log.error("Geometry file not found: %s" % geom_file)
         self.log.info(self.make_cube.__qualname__)
@@ -0,0 +1,238 @@
+"""Batched measurement of emission lines in spectrum windows
+
+The arc and atlas lines are measured in windows of a few pixels around
+each line, of different lengths.  pad_windows() stacks the windows into
+padded arrays with a mask, and the functions below measure all of them
+at once:
+
+    fit_gaussians()     least-squares Gaussians, started from Caruana's
+                        closed form fit of a parabola to the log of the
+                        flux and refined with Levenberg-Marquardt steps
+    spline_peaks()      maximum of the cubic spline through each window,
+                        found analytically on each pixel interval
+    centroids()         flux weighted centroids
+"""
+import numpy as np
+from scipy import interpolate
+
+
+def pad_windows(y, x, x0, x1):
+    """Windows y[x0:x1+1] of a spectrum, padded to the longest
+
+    Args:
+    -----
+        y, x (array): spectrum and its abscissae
+        x0, x1 (array): (int) first and last index of each window
+
+    Returns:
+    --------
+        array: (nwin, width) abscissae
+        array: (nwin, width) values
+        array: (nwin, width) (bool) True inside the window
+    """
+    x0 = np.asarray(x0, dtype=int)
+    npts = np.asarray(x1, dtype=int) - x0 + 1
+    width = npts.max() if len(npts) else 0
+    idx = x0[:, np.newaxis] + np.arange(width)
+    mask = np.arange(width) < npts[:, np.newaxis]
+    idx = np.where(mask, idx, x0[:, np.newaxis])
+    return np.asarray(x)[idx], np.asarray(y)[idx], mask
+
+
+def centroids(x, y, mask):
+    """Flux weighted centroid of each window"""
+    yw = np.where(mask, y, 0.)
+    return np.sum(x * yw, axis=1) / np.sum(yw, axis=1)
+
+
+def gaussian_guess(x, y, mask):
+    """Caruana's closed form Gaussian parameters of each window
+
+    A parabola is fitted to ln(y) by least squares weighted with y**2,
+    which gives amplitude, center and sigma directly.  Windows where that
+    fails (too few positive samples, or no maximum) get the moments of
+    the flux instead.
+
+    Returns:
+    --------
+        array: (nwin, 3) amplitude, center, sigma
+    """
+    good = mask & (y > 0.)
+    # work relative to the first sample for conditioning
+    dx = x - x[:, :1]
+    w = np.where(good, y, 0.) ** 2
+    lny = np.log(np.where(good, y, 1.))
+    pw = dx[..., np.newaxis] ** np.arange(3)
+    lhs = np.einsum('nw,nwi,nwj->nij', w, pw, pw)
+    rhs = np.einsum('nw,nwi,nw->ni', w, pw, lny)
+    ok = good.sum(axis=1) >= 3
+    coef = np.zeros_like(rhs)
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        if ok.any():
+            solvable = ok & (np.abs(np.linalg.det(lhs)) > 0.)
+            coef[solvable] = np.linalg.solve(lhs[solvable],
+                                             rhs[solvable][..., np.newaxis]
+                                             )[..., 0]
+            ok = solvable
+        c0, c1, c2 = coef.T
+        ok &= c2 < 0.
+        mu = -c1 / (2. * c2)
+        sigma = np.sqrt(-1. / (2. * c2))
+        amp = np.exp(c0 - c1 ** 2 / (4. * c2))
+        ok &= np.isfinite(mu) & np.isfinite(sigma) & np.isfinite(amp)
+    # moments where the parabola failed
+    yw = np.where(mask, np.clip(y, 0., None), 0.)
+    tot = yw.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mmu = np.sum(dx * yw, axis=1) / tot
+        msig = np.sqrt(np.sum((dx - mmu[:, np.newaxis]) ** 2 * yw,
+                              axis=1) / tot)
+    mamp = np.where(mask, y, -np.inf).max(axis=1)
+    params = np.where(ok[:, np.newaxis],
+                      np.column_stack((amp, mu, sigma)),
+                      np.column_stack((mamp, mmu, msig)))
+    params[:, 1] += x[:, 0]
+    return params
+
+
+def fit_gaussians(x, y, mask, p0=None, maxiter=100, ftol=1.e-12):
+    """Least-squares Gaussian a * exp(-(x - mu)**2 / (2 * sigma**2)) of
+    each window, with batched Levenberg-Marquardt steps
+
+    Minimizes the same sum of squares as curve_fit(gaus, x, y), for all
+    windows at once: each iteration solves one 3 x 3 system per window.
+
+    Args:
+    -----
+        x, y, mask (array): windows, as from pad_windows()
+        p0 (array): (nwin, 3) starting parameters, default from
+            gaussian_guess()
+        maxiter (int): iterations before giving up on a window
+        ftol (float): relative change of the sum of squares that counts
+            as converged
+
+    Returns:
+    --------
+        array: (nwin, 3) amplitude, center, sigma
+        array: (bool) windows whose fit converged to finite parameters
+    """
+    if p0 is None:
+        p0 = gaussian_guess(x, y, mask)
+    # fit relative to the first sample for conditioning
+    xref = x[:, :1]
+    dx = np.where(mask, x - xref, 0.)
+    yv = np.where(mask, y, 0.)
+    params = np.array(p0, dtype=np.float64)
+    params[:, 1] -= xref[:, 0]
+    nwin = len(params)
+    lam = np.full(nwin, 1.e-3)
+    done = np.zeros(nwin, dtype=bool)
+
+    def residuals(p):
+        with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+            u = (dx - p[:, 1:2]) / p[:, 2:3]
+            e = np.exp(-0.5 * u ** 2)
+            r = np.where(mask, yv - p[:, 0:1] * e, 0.)
+        return r, u, e
+
+    r, u, e = residuals(params)
+    cost = np.sum(r ** 2, axis=1)
+    eye = np.eye(3)
+    for it in range(maxiter):
+        act = ~done & np.isfinite(cost)
+        if not act.any():
+            break
+        p = params[act]
+        ua = u[act]
+        ea = np.where(mask[act], e[act], 0.)
+        # derivatives of the model by amplitude, center and sigma
+        jac = np.stack((ea, p[:, 0:1] * ea * ua / p[:, 2:3],
+                        p[:, 0:1] * ea * ua ** 2 / p[:, 2:3]), axis=-1)
+        jtj = np.einsum('nwi,nwj->nij', jac, jac)
+        grad = np.einsum('nwi,nw->ni', jac, r[act])
+        damp = jtj + lam[act, np.newaxis, np.newaxis] * \
+            jtj * eye[np.newaxis]
+        with np.errstate(invalid='ignore'):
+            try:
+                step = np.linalg.solve(damp, grad[..., np.newaxis])[..., 0]
+            except np.linalg.LinAlgError:
+                step = np.stack([np.linalg.lstsq(d, g, rcond=None)[0]
+                                 for d, g in zip(damp, grad)])
+        trial = params.copy()
+        trial[act] = p + step
+        rt, ut, et = residuals(trial)
+        ct = np.sum(rt ** 2, axis=1)
+        better = act & np.isfinite(ct) & (ct <= cost)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            small = (cost - ct) <= ftol * np.maximum(cost, 1.e-300)
+        done |= better & small
+        params[better] = trial[better]
+        r[better] = rt[better]
+        u[better] = ut[better]
+        e[better] = et[better]
+        cost[better] = ct[better]
+        lam[better] *= 0.1
+        worse = act & ~better
+        lam[worse] *= 10.
+        # no step gets any better
+        done |= worse & (lam > 1.e16)
+    ok = done & np.all(np.isfinite(params), axis=1) & (params[:, 2] != 0.)
+    params[:, 1] += xref[:, 0]
+    return params, ok
+
+
+def spline_peaks(x, y, mask):
+    """Position and value of the maximum of the cubic spline through each
+    window
+
+    The spline is the not-a-knot cubic interp1d(x, y, kind='cubic') uses;
+    the abscissae of each window must be evenly spaced.  Windows of the
+    same length share one spline solve, and the maximum is found from the
+    roots of the derivative on each interval instead of on a dense grid.
+
+    Returns:
+    --------
+        array: position of each maximum
+        array: value of each maximum
+    """
+    npts = mask.sum(axis=1)
+    xpk = np.zeros(len(npts))
+    ypk = np.zeros(len(npts))
+    for n in np.unique(npts):
+        rows = np.nonzero(npts == n)[0]
+        yg = y[rows, :n]
+        # the spline on sample numbers, and its slopes at the samples
+        spl = interpolate.make_interp_spline(np.arange(n), yg.T, k=3)
+        d = spl.derivative()(np.arange(n)).T
+        y0, y1 = yg[:, :-1], yg[:, 1:]
+        d0, d1 = d[:, :-1], d[:, 1:]
+        # y0 + d0 t + c2 t^2 + c3 t^3 on each interval, 0 <= t <= 1
+        c2 = 3. * (y1 - y0) - 2. * d0 - d1
+        c3 = 2. * (y0 - y1) + d0 + d1
+        # turning points: d0 + 2 c2 t + 3 c3 t^2 = 0
+        qa, qb, qc = 3. * c3, 2. * c2, d0
+        disc = qb ** 2 - 4. * qa * qc
+        sq = np.sqrt(np.clip(disc, 0., None))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            roots = np.stack(((-qb + sq) / (2. * qa), (-qb - sq) / (2. * qa),
+                              -qc / qb))
+        linear = np.abs(qa) <= 1.e-12 * (np.abs(qb) + np.abs(qc))
+        valid = np.stack((~linear & (disc >= 0.), ~linear & (disc >= 0.),
+                          linear)) & (roots > 0.) & (roots < 1.)
+        t = np.where(valid, roots, 0.)
+        vals = np.where(valid, y0 + t * (d0 + t * (c2 + t * c3)), -np.inf)
+        # best turning point and best sample
+        ir = vals.reshape(3, len(rows), -1).argmax(axis=0)
+        tv = np.take_along_axis(vals, ir[np.newaxis], 0)[0]
+        tt = np.take_along_axis(t, ir[np.newaxis], 0)[0]
+        iint = tv.argmax(axis=1)
+        tbest = tv[np.arange(len(rows)), iint]
+        isamp = yg.argmax(axis=1)
+        sbest = yg[np.arange(len(rows)), isamp]
+        use_t = tbest > sbest
+        pos = np.where(use_t, iint + tt[np.arange(len(rows)), iint], isamp)
+        # back to the abscissae of the windows
+        step = (x[rows, n - 1] - x[rows, 0]) / (n - 1)
+        xpk[rows] = x[rows, 0] + pos * step
+        ypk[rows] = np.where(use_t, tbest, sbest)
+    return xpk, ypk
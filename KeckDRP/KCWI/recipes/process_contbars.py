@@ -10,11 +10,8 @@ def process_contbars(p, frame):
         p.log.warning("Already processed")
         return
     # reduce contbars
-    p.subtract_oscan()
-    p.trim_oscan()
-    p.correct_gain()
+    p.basic_ccd_reduce()
     p.remove_badcols()
-    p.rectify_image()
 
     # write image
     p.write_image(suffix='int')
@@ -12,12 +12,9 @@ def process_darks(p, frame):
 
     # reduce dark frame
     p.subtract_bias()
-    p.subtract_oscan()
-    p.trim_oscan()
-    p.correct_gain()
+    p.basic_ccd_reduce()
     p.remove_badcols()
     p.remove_crs()
-    p.rectify_image()
     # write out reduced image
     p.write_image(suffix='int')
 
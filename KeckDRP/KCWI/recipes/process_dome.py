@@ -12,12 +12,9 @@ def process_dome(p, frame):
         return
     # reduce dome flat
     p.subtract_bias()
-    p.subtract_oscan()
-    p.trim_oscan()
-    p.correct_gain()
+    p.basic_ccd_reduce()
     p.remove_badcols()
     p.remove_crs()
-    p.rectify_image()
 
     # output file
     p.write_image(suffix='int')
@@ -11,12 +11,9 @@ def process_internal_flats(p, frame):
         return
     # reduce internal flat
     p.subtract_bias()
-    p.subtract_oscan()
-    p.trim_oscan()
-    p.correct_gain()
+    p.basic_ccd_reduce()
     p.remove_badcols()
     p.remove_crs()
-    p.rectify_image()
     p.subtract_dark()
     p.subtract_scattered_light()
 
@@ -10,13 +10,10 @@ def process_object(p, frame):
         return
     # basic CCD reduction
     p.subtract_bias()
-    p.subtract_oscan()
-    p.trim_oscan()
-    p.correct_gain()
+    p.basic_ccd_reduce()
     p.remove_badcols()
     p.remove_crs()
     p.create_unc()
-    p.rectify_image()
 
     # write image
     p.write_image(suffix='int')
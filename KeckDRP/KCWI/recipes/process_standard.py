@@ -10,11 +10,8 @@ def process_standard(p, frame):
         return
     # reduce standard
     p.subtract_bias()
-    p.subtract_oscan()
-    p.trim_oscan()
-    p.correct_gain()
+    p.basic_ccd_reduce()
     p.remove_badcols()
-    p.rectify_image()
     p.apply_flat()
     p.subtract_sky()
     p.make_cube()
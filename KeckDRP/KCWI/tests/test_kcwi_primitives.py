@@ -1,11 +1,17 @@
 # from KCWIPyDRP.ccd_primitives import CcdPrimitives
 # from KCWIPyDRP.imgmath_primitives import ImgmathPrimitives
 from .. import kcwi_primitives
+from .. import KcwiConf
 from KeckDRP import data_objects
+from KeckDRP.core.imgmath_primitives import stream_combine
+from KeckDRP.core import proctab
+from KeckDRP.core import stack_accumulator
+import KeckDRP
 # from astropy import log
-# from astropy.table import Table
+from astropy.table import Table
 import numpy as np
-# import os
+from astropy.io import fits
+import os
 import pytest
 
 
@@ -19,3 +25,1075 @@ def test_set_frame(p):
     myframe = data_objects.KcwiCCD(np.random.normal(size=(10, 10)), unit="adu")
     p.set_frame(myframe)
     assert p.frame == myframe
+
+
+def synthetic_raw_frame(nxamp=200, nyamp=180, noscan=100, seed=123,
+                        ampmode='ALL'):
+    """Small 4-amp raw frame with overscan, laid out as in map_ccd()"""
+    hdr = fits.Header()
+    hdr['NVIDINP'] = 4
+    hdr['FRAMENO'] = 1
+    hdr['AMPMODE'] = ampmode
+    hdr['CCDCFG'] = '1121004'
+    nx = 2 * (nxamp + noscan)
+    for ia in range(4):
+        y0 = 1 if ia < 2 else nyamp + 1
+        y1 = y0 + nyamp - 1
+        if ia in (0, 2):
+            dx0, dx1 = 1, nxamp
+            bx0, bx1 = nxamp + 1, nxamp + noscan
+        else:
+            dx0, dx1 = nx, nx - nxamp + 1
+            bx0, bx1 = nx - nxamp - noscan + 1, nx - nxamp
+        hdr['GAIN%d' % (ia + 1)] = 0.145 + 0.01 * ia
+        for key in ('ASEC', 'CSEC', 'DSEC'):
+            hdr['%s%d' % (key, ia + 1)] = '[%d:%d,%d:%d]' % (dx0, dx1, y0, y1)
+        hdr['BSEC%d' % (ia + 1)] = '[%d:%d,%d:%d]' % (bx0, bx1, y0, y1)
+    rng = np.random.RandomState(seed)
+    data = 1000. + rng.normal(scale=3.5, size=(2 * nyamp, nx))
+    data += np.linspace(0., 5., 2 * nyamp)[:, np.newaxis]
+    return data_objects.KcwiCCD(data, unit='adu', meta=hdr)
+
+
+def basic_ccd(p, nthreads, monkeypatch):
+    monkeypatch.setattr(KcwiConf, 'NTHREADS', nthreads)
+    p.set_frame(synthetic_raw_frame())
+    p.subtract_oscan()
+    p.trim_oscan()
+    p.correct_gain()
+    return p.frame
+
+
+def test_threaded_amps_match_serial(p, monkeypatch):
+    monkeypatch.setattr(KcwiConf, 'INTER', 0)
+    serial = basic_ccd(p, 1, monkeypatch)
+    threaded = basic_ccd(kcwi_primitives.KcwiPrimitives(), 4, monkeypatch)
+    assert np.array_equal(serial.data, threaded.data)
+    for ia in range(4):
+        assert serial.header['OSCNRN%d' % (ia + 1)] == \
+            threaded.header['OSCNRN%d' % (ia + 1)]
+
+
+@pytest.mark.parametrize('ampmode', ['ALL', '__B', '__D', '__A'])
+def test_basic_ccd_reduce_matches_sequential(p, monkeypatch, ampmode):
+    monkeypatch.setattr(KcwiConf, 'INTER', 0)
+    # sequential stages
+    p.set_frame(synthetic_raw_frame(ampmode=ampmode))
+    p.readnoise = [3.5, 3.6, 3.7, 3.8]
+    p.subtract_oscan()
+    p.trim_oscan()
+    p.correct_gain()
+    p.create_unc()
+    p.rectify_image()
+    sequential = p.frame
+    # fused stage
+    q = kcwi_primitives.KcwiPrimitives()
+    q.set_frame(synthetic_raw_frame(ampmode=ampmode))
+    q.readnoise = p.readnoise
+    q.basic_ccd_reduce()
+    q.create_unc()
+    fused = q.frame
+    assert fused.data.shape == sequential.data.shape
+    assert np.allclose(fused.data, sequential.data, rtol=0., atol=1.e-9)
+    assert np.allclose(fused.uncertainty.array, sequential.uncertainty.array,
+                       rtol=0., atol=1.e-9)
+    for key in ('OSCANSUB', 'OSCANTRM', 'GAINCOR', 'BUNIT', 'NAXIS1',
+                'NAXIS2', 'OSCNRN1', 'OSCNRN4'):
+        assert fused.header[key] == sequential.header[key]
+    assert 'DSEC1' not in fused.header
+
+
+def test_ccd_geometry_shared(p):
+    p.set_frame(synthetic_raw_frame())
+    geom = p.ccd_geometry()
+    # a second frame with the same configuration reuses the geometry
+    q = kcwi_primitives.KcwiPrimitives()
+    q.set_frame(synthetic_raw_frame(seed=321))
+    assert q.ccd_geometry() is geom
+    bsec, dsec, tsec, direc = p.map_ccd()
+    assert bsec[1] == (0, 179, 300, 399)
+    assert dsec[1] == (0, 179, 400, 599)
+    assert tsec[3] == (180, 359, 200, 399)
+    assert direc[1] == (True, False)
+    assert geom.shape == (360, 400)
+    assert p.frame.data[geom.data_slices[1]].shape == (180, 200)
+
+
+def write_stack(tmpdir, nimg=5, shape=(37, 23), seed=42):
+    """Write raw-like uint16 images (BZERO=32768) with a few hot pixels"""
+    rng = np.random.RandomState(seed)
+    names = []
+    for i in range(nimg):
+        data = 1000. + rng.normal(scale=3.5, size=shape)
+        data[rng.randint(shape[0]), rng.randint(shape[1])] += 500.
+        hdu = fits.PrimaryHDU(np.round(data).astype(np.uint16))
+        hdu.header['FRAMENO'] = i + 1
+        hdu.header['CCDCFG'] = '1121004'
+        name = 'img%05d.fits' % (i + 1)
+        hdu.writeto(os.path.join(str(tmpdir), name))
+        names.append(name)
+    return Table([names, list(range(1, nimg + 1))], names=('OFNAME', 'FRAMENO'))
+
+
+@pytest.mark.parametrize('method', ['average', 'median'])
+def test_streaming_combine_matches_reference(p, tmpdir, monkeypatch, method):
+    tab = write_stack(tmpdir)
+    stack = np.array([fits.getdata(os.path.join(str(tmpdir), f))
+                      for f in tab['OFNAME']], dtype=np.float64)
+    # ccdproc-style single pass clipping: mean, std, high threshold 2
+    clipped = np.ma.masked_array(stack, mask=(
+        stack - stack.mean(axis=0) > 2.0 * stack.std(axis=0)))
+    nused = len(stack) - clipped.mask.sum(axis=0)
+    if method == 'median':
+        expected = np.ma.median(clipped, axis=0)
+        unc = 1.482602218505602 * np.ma.median(np.abs(clipped - expected),
+                                               axis=0)
+    else:
+        expected = clipped.mean(axis=0)
+        unc = clipped.std(axis=0)
+    unc = unc / np.sqrt(nused)
+    # tiles that do not divide the image evenly
+    monkeypatch.setattr(KeckDRP.conf, 'COMBINE_TILE_ROWS', 10)
+    p.image_combine(tab, combine_type='bias', in_directory=str(tmpdir),
+                    method=method)
+    assert np.allclose(p.frame.data, expected, rtol=0., atol=1.e-9)
+    assert np.allclose(p.frame.uncertainty.array, unc, rtol=0., atol=1.e-9)
+    assert p.frame.header['NSTACK'] == 5
+    assert 'BZERO' not in p.frame.header
+
+
+@pytest.mark.parametrize('method', ['average', 'median'])
+def test_parallel_combine_matches_serial(tmpdir, method):
+    tab = write_stack(tmpdir, nimg=7)
+    files = [os.path.join(str(tmpdir), f) for f in tab['OFNAME']]
+    serial = stream_combine(files, method=method, sigma_clip=True,
+                            tile_rows=4, unit='adu', nprocs=1)
+    parallel = stream_combine(files, method=method, sigma_clip=True,
+                              tile_rows=4, unit='adu', nprocs=3)
+    assert np.allclose(parallel.data, serial.data, rtol=0., atol=1.e-12)
+    assert np.allclose(parallel.uncertainty.array, serial.uncertainty.array,
+                       rtol=0., atol=1.e-12)
+    assert np.array_equal(parallel.mask, serial.mask)
+
+
+def clipped_average(tmpdir, tab):
+    """Reference bias stack: clip > 2 sigma above the mean, then average
+
+    The clipping test is done in exact integer arithmetic, so that values
+    exactly at the threshold are kept.
+    """
+    stack = np.array([fits.getdata(os.path.join(str(tmpdir), f))
+                      for f in tab['OFNAME']], dtype=np.int64)
+    n = len(stack)
+    d = n * stack - stack.sum(axis=0)
+    var = n * (stack ** 2).sum(axis=0) - stack.sum(axis=0) ** 2
+    clipped = np.ma.masked_array(stack.astype(np.float64),
+                                 mask=(d > 0) & (d ** 2 > 4 * var))
+    nused = n - clipped.mask.sum(axis=0)
+    return clipped.mean(axis=0), clipped.std(axis=0) / np.sqrt(nused)
+
+
+@pytest.mark.parametrize('topk', [1, 2])
+def test_image_accumulate_matches_combine(p, tmpdir, monkeypatch, topk):
+    tab = write_stack(tmpdir, nimg=12)
+    # two outliers in one pixel: more than one buffer slot with topk=1
+    for f in tab['OFNAME'][:2]:
+        with fits.open(os.path.join(str(tmpdir), f), mode='update') as hdul:
+            hdul[0].data[5, 5] += 300
+    monkeypatch.setattr(KeckDRP.conf, 'REDUXDIR', str(tmpdir))
+    monkeypatch.setattr(stack_accumulator, 'open_stacks', {})
+    nread = []
+    read = data_objects.KcwiCCD.read
+    monkeypatch.setattr(data_objects.KcwiCCD, 'read', classmethod(
+        lambda cls, *args, **kwargs: nread.append(1) or read(*args, **kwargs)))
+    accfile = os.path.join(str(tmpdir), 'img00001_bias_stack.npz')
+    # frames arrive one at a time, the last one finalizes the stack
+    for n in range(3, len(tab) + 1):
+        del nread[:]
+        p.image_accumulate(tab[:n], in_directory=str(tmpdir), topk=topk,
+                           exact=True, finalize=n == len(tab))
+        assert os.path.exists(accfile) == (n == len(tab))
+        # exact by Cantelli's inequality, or once finalized
+        if n // 5 <= topk or n == len(tab):
+            data, unc = clipped_average(tmpdir, tab[:n])
+            assert np.allclose(p.frame.data, data, rtol=0., atol=1.e-9)
+            assert np.allclose(p.frame.uncertainty.array, unc, rtol=0.,
+                               atol=1.e-9)
+        assert p.frame.header['NSTACK'] == n
+    # only the new frame was read, unless recombined from disk
+    assert len(nread) == (1 if topk == 2 else 1 + len(tab))
+    # a new process picks up the saved state
+    stack_accumulator.open_stacks.clear()
+    del nread[:]
+    p.image_accumulate(tab, in_directory=str(tmpdir), topk=topk)
+    assert len(nread) == 0
+    assert p.frame.header['NSTACK'] == len(tab)
+
+
+def proc_frame(frameno, imtype, stateid='abc123', ccdcfg='1121004',
+               groupid='NONE', ttime=0.):
+    """Frame with the header keywords recorded in the proc table"""
+    hdr = fits.Header()
+    hdr['FRAMENO'] = frameno
+    hdr['STATEID'] = stateid
+    hdr['CCDCFG'] = ccdcfg
+    hdr['IMTYPE'] = imtype
+    hdr['GROUPID'] = groupid
+    hdr['TTIME'] = ttime
+    hdr['CAMERA'] = 'BLUE'
+    hdr['IFUNAM'] = 'Medium'
+    hdr['BGRATNAM'] = 'BL'
+    hdr['BGRANGLE'] = 10.5
+    hdr['BCWAVE'] = 4500.
+    hdr['BINNING'] = '2,2'
+    hdr['BFILTNAM'] = 'KBlue'
+    hdr['MJD'] = 58000. + frameno / 1000.
+    hdr['OFNAME'] = 'kb%05d.fits' % frameno
+    hdr['TARGNAME'] = 'target %d' % frameno
+    return data_objects.KcwiCCD(np.zeros((2, 2)), unit='adu', meta=hdr)
+
+
+def test_proctab_service(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setattr(proctab, 'open_tables', {})
+    p = kcwi_primitives.KcwiPrimitives()
+    p.read_proctab()
+    for fno in (1, 2, 3):
+        p.set_frame(proc_frame(fno, 'BIAS', groupid='G1'))
+        p.update_proctab(suffix='RAW')
+    for fno in (10, 20, 30):
+        p.set_frame(proc_frame(fno, 'CONTBARS'))
+        p.update_proctab(suffix='RAW')
+    # last write wins for (CID, FRAMENO, STAGE)
+    p.set_frame(proc_frame(20, 'CONTBARS'))
+    p.frame.header['TARGNAME'] = 'rewritten'
+    p.update_proctab(suffix='RAW')
+    p.write_proctab()
+    assert len(p.proctab) == 6
+    assert os.path.exists('kcwi.proc') and os.path.exists('kcwi.proc.jnl')
+    # fresh process: the journal is replayed
+    monkeypatch.setattr(proctab, 'open_tables', {})
+    q = kcwi_primitives.KcwiPrimitives()
+    q.read_proctab()
+    q.set_frame(proc_frame(24, 'OBJECT'))
+    assert not q.in_proctab()
+    assert len(q.n_proctab(target_type='BIAS', target_group='G1')) == 3
+    tab = q.n_proctab(target_type='CONTBARS', nearest=True)
+    assert list(tab['FRAMENO']) == [20]
+    assert tab[0]['TARGNAME'] == 'rewritten'
+    # the exported file holds the same rows
+    ascii_tab = proctab.ProcTable()
+    ascii_tab.import_ascii('kcwi.proc')
+    assert list(ascii_tab.table()['FRAMENO']) == \
+        list(q.proctab.table()['FRAMENO'])
+
+
+def test_proctab_journal_shared(tmpdir):
+    # two processes appending to one journal
+    tfil = str(tmpdir.join('kcwi.proc'))
+    a = proctab.ProcTable(tfil)
+    b = proctab.ProcTable(tfil)
+    row = [proc_frame(1, 'BIAS').header.get(c, 0) for c in proctab.COLUMNS]
+    a.add_row(row)
+    row[proctab.COLUMN['FRAMENO']] = 2
+    b.add_row(row)
+    # b replayed a's row before appending; a keeps b's row when compacting
+    assert len(b) == 2
+    a.compact()
+    assert len(a) == 2
+    c = proctab.ProcTable(tfil)
+    c.refresh()
+    assert list(c.table()['FRAMENO']) == [1, 2]
+
+
+def test_proctab_journal_compacted(tmpdir):
+    tfil = str(tmpdir.join('kcwi.proc'))
+    a = proctab.ProcTable(tfil)
+    b = proctab.ProcTable(tfil)
+    row = [proc_frame(1, 'BIAS').header.get(c, 0) for c in proctab.COLUMNS]
+    for fno in range(1, 11):
+        row[proctab.COLUMN['FRAMENO']] = fno
+        a.add_row(row)
+        # superseded rows, dropped by compaction
+        a.add_row(row)
+    b.refresh()
+    assert len(b) == 10
+    stale = b.offset
+    # a compacts, then grows the new journal past b's offset
+    a.compact()
+    for fno in range(11, 41):
+        row[proctab.COLUMN['FRAMENO']] = fno
+        a.add_row(row)
+    assert os.path.getsize(tfil + '.jnl') > stale
+    b.refresh()
+    assert list(b.table()['FRAMENO']) == list(range(1, 41))
+    # and again, from one compacted journal to the next
+    a.compact()
+    row[proctab.COLUMN['FRAMENO']] = 41
+    a.add_row(row)
+    b.refresh()
+    assert list(b.table()['FRAMENO']) == list(range(1, 42))
+
+
+def test_proctab_sqlite(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setattr(proctab, 'open_tables', {})
+    monkeypatch.setattr(KeckDRP.conf, 'PROCTAB_BACKEND', 'sqlite')
+    # an existing fixed-width table is imported into a new database
+    p = kcwi_primitives.KcwiPrimitives()
+    p.proctab = proctab.ProcTable()
+    for fno in (1, 2, 3):
+        p.set_frame(proc_frame(fno, 'BIAS', groupid='G1'))
+        p.update_proctab(suffix='RAW')
+    p.proctab.export('kcwi.proc')
+    p.read_proctab()
+    assert isinstance(p.proctab, proctab.SqliteProcTable)
+    assert len(p.proctab) == 3
+    for fno in (10, 20, 30):
+        p.set_frame(proc_frame(fno, 'CONTBARS'))
+        p.update_proctab(suffix='RAW')
+    p.set_frame(proc_frame(20, 'CONTBARS'))
+    p.frame.header['TARGNAME'] = 'rewritten'
+    p.update_proctab(suffix='RAW')
+    p.write_proctab()
+    # a second connection, as from another process, sees every row
+    other = proctab.SqliteProcTable('kcwi.proc')
+    assert len(other) == 6
+    # rewriting a row in one connection replaces it in the other
+    row = other.select(FRAMENO=1)[0]
+    other.add_row([row[c] for c in proctab.COLUMNS])
+    assert len(p.proctab) == 6
+    q = kcwi_primitives.KcwiPrimitives()
+    q.read_proctab()
+    q.set_frame(proc_frame(24, 'OBJECT'))
+    assert not q.in_proctab()
+    assert len(q.n_proctab(target_type='BIAS', target_group='G1')) == 3
+    tab = q.n_proctab(target_type='CONTBARS', nearest=True)
+    assert list(tab['FRAMENO']) == [20]
+    assert tab[0]['TARGNAME'] == 'rewritten'
+    # the export matches the journal backend's reading of it
+    ascii_tab = proctab.ProcTable()
+    ascii_tab.import_ascii('kcwi.proc')
+    assert list(ascii_tab.table()['FRAMENO']) == \
+        list(q.proctab.table()['FRAMENO'])
+
+
+def test_nearest_calibration(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setattr(proctab, 'open_tables', {})
+    rng = np.random.RandomState(7)
+    p = kcwi_primitives.KcwiPrimitives()
+    p.new_proctab()
+    framenos = rng.choice(np.arange(1, 200), size=40, replace=False)
+    for fno in framenos:
+        p.set_frame(proc_frame(int(fno), 'CONTBARS'))
+        p.update_proctab(suffix='RAW')
+        p.update_proctab(suffix='int')
+    for target in range(0, 202):
+        p.set_frame(proc_frame(target, 'OBJECT'))
+        tab = p.n_proctab(target_type='CONTBARS')
+        # reference: first row with the smallest offset
+        offs = np.abs(np.asarray(tab['FRAMENO']) - target)
+        expected = tab['FRAMENO'][np.argmin(offs)]
+        near = p.n_proctab(target_type='CONTBARS', nearest=True)
+        assert set(near['FRAMENO']) == {expected}
+        assert len(near) == 2
+        assert set(proctab.nearest_rows(tab, target)['FRAMENO']) == \
+            {expected}
+    # results are copies of the cached selections
+    near['TARGNAME'][0] = 'changed'
+    tab['TARGNAME'][0] = 'changed'
+    assert 'changed' not in p.n_proctab(target_type='CONTBARS',
+                                        nearest=True)['TARGNAME']
+    assert 'changed' not in p.n_proctab(target_type='CONTBARS')['TARGNAME']
+    # equally near in MJD: the lower frame number wins
+    p.set_frame(proc_frame(5, 'ARCLAMP'))
+    p.frame.header['MJD'] = 58000.25
+    p.update_proctab(suffix='RAW')
+    p.set_frame(proc_frame(3, 'ARCLAMP'))
+    p.frame.header['MJD'] = 58000.75
+    p.update_proctab(suffix='RAW')
+    p.set_frame(proc_frame(4, 'OBJECT'))
+    p.frame.header['MJD'] = 58000.5
+    calibs = p.get_calibrations(by_mjd=True)
+    assert list(calibs['ARCLAMP']['FRAMENO']) == [3]
+    assert len(calibs['MBIAS']) == 0
+    p.frame.header['MJD'] = 58000.375
+    assert list(p.get_calibrations(('ARCLAMP',), by_mjd=True)[
+        'ARCLAMP']['FRAMENO']) == [5]
+
+
+def synthetic_geometry(ny=60, width=14, xsize=10, seed=5):
+    """24 slices of curved, slightly overlapping transforms"""
+    from skimage import transform as tf
+    rng = np.random.RandomState(seed)
+    xl0s, xl1s, tforms, invtfs = [], [], [], []
+    for isl in range(24):
+        xl0 = isl * (width - 2)
+        # image (x - xl0, y) to slice (x, wavelength) control points
+        xi, yi = np.meshgrid(np.linspace(0., width, 6),
+                             np.linspace(0., ny, 8))
+        xi, yi = xi.ravel(), yi.ravel()
+        xo = xi - 2. + 1.e-3 * (yi - ny / 2.) ** 2 / ny + \
+            rng.normal(scale=0.05, size=xi.size)
+        yo = yi + 0.02 * xi ** 2 + rng.normal(scale=0.05, size=xi.size)
+        invtfs.append(tf.estimate_transform(
+            'polynomial', np.column_stack((xi, yi)),
+            np.column_stack((xo, yo)), order=3))
+        tforms.append(tf.estimate_transform(
+            'polynomial', np.column_stack((xo, yo)),
+            np.column_stack((xi, yi)), order=3))
+        xl0s.append(xl0)
+        xl1s.append(xl0 + width)
+    geom = {'xl0': xl0s, 'xl1': xl1s, 'tform': tforms, 'invtf': invtfs,
+            'xsize': xsize, 'ysize': ny - 4, 'wave0out': 3500., 'dwout': 0.5,
+            'wave1out': 3528., 'pxscl': 4.048e-05, 'slscl': 3.7718e-04,
+            'cbarsno': 2, 'cbarsfl': 'kb00002.fits', 'arcno': 3,
+            'arcfl': 'kb00003.fits', 'barsep': 8.5, 'bar0': 4.25,
+            'waveall0': 3498.5, 'waveall1': 3530.0, 'wavegood0': 3501.,
+            'wavegood1': 3526.5, 'wavemid': 3514., 'avwvsig': 0.21,
+            'sdwvsig': 0.013}
+    return geom
+
+
+def write_test_geom(geom, path, coords=None):
+    """Write a synthetic geometry file, returning its name"""
+    from KeckDRP.KCWI.geometry import write_geom
+    geom['geom_file'] = str(path)
+    write_geom(str(path), geom, coords=coords)
+    return str(path)
+
+
+def loop_maps(geom, ny, nx):
+    """Pixel by pixel maps, as generate_maps used to make them"""
+    maps = [np.full((ny, nx), -1.) for i in range(3)]
+    wave_map, xpos_map, slice_map = maps
+    for isl in range(0, 24):
+        itrf = geom['invtf'][isl]
+        xl0 = geom['xl0'][isl]
+        for ix in range(xl0, geom['xl1'][isl]):
+            coords = np.zeros((ny, 2))
+            for iy in range(0, ny):
+                coords[iy, 0] = ix - xl0
+                coords[iy, 1] = iy
+            ncoo = itrf(coords)
+            for iy in range(0, ny):
+                if 0 <= ncoo[iy, 0] <= geom['xsize']:
+                    slice_map[iy, ix] = isl
+                    xpos_map[iy, ix] = ncoo[iy, 0]
+                    wave_map[iy, ix] = ncoo[iy, 1] * geom['dwout'] + \
+                        geom['wave0out']
+    return maps
+
+
+@pytest.mark.parametrize('nthreads', [1, 3])
+def test_generate_maps_matches_loop(p, tmpdir, monkeypatch, nthreads):
+    monkeypatch.setattr(KcwiConf, 'NTHREADS', nthreads)
+    ny, nx = 60, 24 * 12 + 2
+    geom = synthetic_geometry(ny=ny)
+    p.geom_file = write_test_geom(geom, tmpdir.join('kb00001_geom.fits'))
+    p.set_frame(data_objects.KcwiCCD(np.zeros((ny, nx)), unit='electron'))
+    written = {}
+    monkeypatch.setattr(p, 'write_image', lambda suffix=None: written.update(
+        {suffix: p.frame.data.copy()}))
+    p.generate_maps()
+    wave_map, xpos_map, slice_map = loop_maps(geom, ny, nx)
+    assert (slice_map >= 0).any() and (slice_map < 0).any()
+    # same pixels, values equal to rounding
+    np.testing.assert_array_equal(written['slicemap'], slice_map)
+    np.testing.assert_allclose(written['posmap'], xpos_map, rtol=0.,
+                               atol=1.e-9)
+    np.testing.assert_allclose(written['wavemap'], wave_map, rtol=0.,
+                               atol=1.e-9)
+
+
+def test_coord_maps_reused(p, tmpdir, monkeypatch):
+    from skimage import transform as tf
+    geom = synthetic_geometry()
+    geom_file = write_test_geom(geom, tmpdir.join('kb00001_geom.fits'))
+    p.write_coord_maps(geom)
+    # later cubes read the saved maps instead of recomputing them
+    monkeypatch.setattr(kcwi_primitives, 'coord_maps', None)
+    coords = p.read_coord_maps(geom, geom_file)
+    assert isinstance(coords, np.memmap)
+    img = np.random.RandomState(3).normal(size=(60, 14))
+    for isl in (0, 11, 23):
+        np.testing.assert_array_equal(
+            tf.warp(img, coords[isl], order=3),
+            tf.warp(img, geom['tform'][isl], order=3,
+                    output_shape=(geom['ysize'], geom['xsize'])))
+
+
+def test_drizzle_conserves_flux(p, tmpdir, monkeypatch):
+    from KeckDRP.KCWI import drizzle
+    monkeypatch.setattr(drizzle, 'open_matrices', {})
+    ny = 60
+    geom = synthetic_geometry(ny=ny)
+    geom_file = write_test_geom(geom, tmpdir.join('kb00001_geom.fits'))
+    matrices = p.read_drizzle_matrices(geom, geom_file, ny)
+    assert len(matrices) == 24
+    rng = np.random.RandomState(9)
+    for isl in (0, 12, 23):
+        matrix = matrices[isl][0]
+        ncols = geom['xl1'][isl] - geom['xl0'][isl]
+        img = rng.uniform(10., 20., size=(ny, ncols))
+        var = rng.uniform(1., 2., size=(ny, ncols))
+        out, ovar, cov = drizzle.drizzle_slice(
+            matrices[isl], img, var, shape=(geom['ysize'], geom['xsize']))
+        # every input pixel is spread over fractions summing to at most 1,
+        # and exactly 1 away from the edges of the output
+        frac = np.asarray(matrix.astype(np.float64).sum(axis=0)).ravel()
+        assert frac.max() < 1. + 1.e-6
+        good, xpos, ypos = kcwi_primitives.slice_maps(
+            geom['invtf'][isl], geom['xl0'][isl], geom['xl1'][isl], ny,
+            geom['xsize'])
+        inner = ((xpos > 1.) & (xpos < geom['xsize'] - 2.) &
+                 (ypos > 1.) & (ypos < geom['ysize'] - 2.)).ravel()
+        assert inner.sum() > ny
+        np.testing.assert_allclose(frac[inner], 1., rtol=1.e-6)
+        # flux is conserved
+        np.testing.assert_allclose(out.sum(), (img.ravel() * frac).sum(),
+                                   rtol=1.e-10)
+        # variance and coverage against dense products
+        dense = matrix.toarray().astype(np.float64)
+        np.testing.assert_allclose(ovar.ravel(), (dense ** 2).dot(var.ravel()))
+        np.testing.assert_array_equal(cov.ravel(),
+                                      (dense > 0).sum(axis=1))
+    # matrices are read back rather than rebuilt
+    monkeypatch.setattr(drizzle, 'open_matrices', {})
+    monkeypatch.setattr(drizzle, 'drizzle_matrix', None)
+    again = p.read_drizzle_matrices(geom, geom_file, ny)
+    assert (again[5][0] != matrices[5][0]).nnz == 0
+
+
+def test_parallel_slices_match_serial(p, tmpdir, monkeypatch):
+    from skimage import transform as tf
+    monkeypatch.setattr(KcwiConf, 'NPROCS', 3)
+    monkeypatch.setattr(os, 'cpu_count', lambda: 4)
+    ny = 60
+    geom = synthetic_geometry(ny=ny)
+    geom_file = write_test_geom(geom, tmpdir.join('kb00001_geom.fits'))
+    img = np.random.RandomState(4).normal(size=(ny, 24 * 12 + 2))
+    p.set_frame(data_objects.KcwiCCD(img, unit='electron'))
+    assert p.nprocs() == 3
+    # the maps are written for the workers
+    cube = p.warp_cube(img, geom, geom_file, p.nprocs())
+    assert os.path.exists(kcwi_primitives.coord_maps_file(geom_file))
+    coords = kcwi_primitives.coord_maps(geom['tform'], geom['ysize'],
+                                        geom['xsize'])
+    for isl in range(24):
+        np.testing.assert_array_equal(
+            cube[:, :, isl],
+            tf.warp(img[:, geom['xl0'][isl]:geom['xl1'][isl]], coords[isl],
+                    order=3))
+    # geometry fits come back in slice order
+    rng = np.random.RandomState(5)
+    points = [(rng.uniform(0., 50., (30, 2)), rng.uniform(0., 50., (30, 2)))
+              for isl in range(24)]
+    fits = p.process_slices(kcwi_primitives.fit_slice, points)
+    for (src, dst), (tform, invtf) in zip(points, fits):
+        ref = kcwi_primitives.fit_slice(src, dst)
+        np.testing.assert_array_equal(tform.params, ref[0].params)
+        np.testing.assert_array_equal(invtf.params, ref[1].params)
+
+
+def test_geometry_file(p, tmpdir):
+    from KeckDRP.KCWI import geometry
+    geom = synthetic_geometry()
+    coords = kcwi_primitives.coord_maps(geom['tform'], geom['ysize'],
+                                        geom['xsize'])
+    geom_file = write_test_geom(geom, tmpdir.join('kb00001_geom.fits'),
+                                coords=coords)
+    back = geometry.read_geom(geom_file)
+    for key, kwd in geometry.SCALARS:
+        assert back[key] == geom[key]
+    assert back['xl0'] == geom['xl0'] and back['xl1'] == geom['xl1']
+    for name in ('tform', 'invtf'):
+        for trans, ref in zip(back[name], geom[name]):
+            np.testing.assert_array_equal(trans.params, ref.params)
+    # stored coordinate maps are used as they are, memory mapped
+    maps = p.read_coord_maps(back, geom_file)
+    np.testing.assert_array_equal(maps, coords)
+    assert not os.path.exists(kcwi_primitives.coord_maps_file(geom_file))
+    # altered content is refused
+    with fits.open(geom_file, mode='update') as hdul:
+        hdul['SLICES'].data['XL0'][3] += 1
+    with pytest.raises(ValueError):
+        geometry.read_geom(geom_file)
+    with fits.open(geom_file, mode='update') as hdul:
+        hdul[0].header['GEOMVER'] = 99
+    with pytest.raises(ValueError):
+        geometry.read_geom(geom_file)
+
+
+def test_calib_cache(tmpdir):
+    from KeckDRP.core.calib_cache import CalibCache
+    infile = tmpdir.join('kb00001_master_bias.fits')
+    infile.write('bias')
+    cache = CalibCache(str(tmpdir.join('cache')), max_mb=1., disk_mb=1.)
+    key = cache.key('image', [str(infile)], unit='adu')
+    assert key != cache.key('image', [str(infile)], unit='electron')
+    value = {'data': np.arange(1000.), 'header': 'FRAMENO = 1'}
+    cache.put(key, value)
+    assert cache.get(key) is value
+    # a new process finds it on disk
+    other = CalibCache(str(tmpdir.join('cache')), max_mb=1., disk_mb=1.)
+    back = other.get(key)
+    np.testing.assert_array_equal(back['data'], value['data'])
+    assert back['header'] == value['header'] and other.disk_hits == 1
+    # rewriting an input changes the key
+    infile.write('new bias')
+    assert cache.key('image', [str(infile)], unit='adu') != key
+    # least recently used entries go first, in memory and on disk
+    for i in range(3):
+        cache.put('k%d' % i, {'data': np.zeros(50000)})
+        os.utime(cache.disk_path('k%d' % i), (i + 1., i + 1.))
+    assert 'k0' not in cache.memory and cache.nbytes <= cache.max_bytes
+    assert not os.path.exists(cache.disk_path('k0'))
+    assert os.path.exists(cache.disk_path('k2'))
+
+
+def test_calib_image_cached(p, tmpdir, monkeypatch):
+    from KeckDRP.core import calib_cache
+    monkeypatch.setattr(calib_cache, 'open_caches', {})
+    monkeypatch.setattr(KeckDRP.conf, 'CALIB_CACHE_DIR',
+                        str(tmpdir.join('cache')))
+    hdr = fits.Header()
+    hdr['NVIDINP'] = 1
+    hdr['BIASRN1'] = 3.2
+    master = data_objects.KcwiCCD(np.random.RandomState(1).normal(
+        size=(20, 30)), unit='adu', meta=hdr)
+    infile = str(tmpdir.join('kb00001_master_bias.fits'))
+    master.write(infile)
+    first = p.read_calib_image(infile)
+    # cache hits are not read from the file again
+    monkeypatch.setattr(data_objects.KcwiCCD, 'read', None)
+    second = p.read_calib_image(infile)
+    np.testing.assert_array_equal(second.data, first.data)
+    assert second.header['BIASRN1'] == 3.2
+    calib_cache.open_caches.clear()
+    third = p.read_calib_image(infile)
+    np.testing.assert_array_equal(third.data, master.data)
+    # one cache per directory and sizes, whatever the working directory
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setattr(KeckDRP.conf, 'CALIB_CACHE_DIR', 'cache')
+    cache = calib_cache.CalibCache.open()
+    assert cache.cachedir == str(tmpdir.join('cache'))
+    assert calib_cache.CalibCache.open() is cache
+    monkeypatch.setattr(KeckDRP.conf, 'CALIB_CACHE_MB', 1.)
+    assert calib_cache.CalibCache.open().max_bytes == 1024 * 1024
+
+
+def test_master_pool_subtract(p, tmpdir, monkeypatch):
+    from astropy.nddata import StdDevUncertainty
+    from KeckDRP.core import calib_cache, master_pool
+    monkeypatch.setattr(master_pool, 'open_pools', {})
+    monkeypatch.setattr(calib_cache, 'open_caches', {})
+    monkeypatch.setattr(KeckDRP.conf, 'CALIB_CACHE_DIR',
+                        str(tmpdir.join('cache')))
+    monkeypatch.setattr(KeckDRP.conf, 'CALIB_CACHE_DISK_MB', 0.)
+    rng = np.random.RandomState(7)
+    hdr = fits.Header()
+    hdr['NVIDINP'] = 2
+    hdr['BIASRN1'] = 3.1
+    hdr['BIASRN2'] = 3.3
+    master = data_objects.KcwiCCD(
+        rng.normal(size=(20, 30)), unit='adu', meta=hdr,
+        uncertainty=StdDevUncertainty(rng.uniform(1., 2., size=(20, 30))))
+    master.write(str(tmpdir.join('kb00001_master_bias.fits')))
+    tab = Table([['kb00001.fits'], [1]], names=('OFNAME', 'FRAMENO'))
+
+    def subtract(frame):
+        p.set_frame(frame.copy())
+        p.img_subtract(tab, indir=str(tmpdir), suffix='master_bias')
+        return p.frame
+
+    frame = data_objects.KcwiCCD(
+        rng.normal(loc=1000., size=(20, 30)), unit='adu',
+        uncertainty=StdDevUncertainty(rng.uniform(1., 2., size=(20, 30))),
+        mask=rng.uniform(size=(20, 30)) > 0.9)
+    for inframe in (frame, data_objects.KcwiCCD(frame.data, unit='adu')):
+        ref = inframe.subtract(master, handle_meta='first_found')
+        out = subtract(inframe)
+        np.testing.assert_allclose(out.data, ref.data, rtol=0., atol=1.e-12)
+        np.testing.assert_allclose(out.uncertainty.array,
+                                   ref.uncertainty.array, rtol=0.,
+                                   atol=1.e-12)
+        np.testing.assert_array_equal(out.mask, ref.mask)
+        assert p.readnoise == [3.1, 3.3]
+    pool = master_pool.MasterPool.open()
+    assert pool.loads == 1 and pool.hits == 1
+    # a proc table change or a rewritten master is read again
+    tab['FRAMENO'][0] = 2
+    subtract(frame)
+    assert pool.loads == 2
+    master.data += 5.
+    master.write(str(tmpdir.join('kb00001_master_bias.fits')), overwrite=True)
+    np.testing.assert_allclose(subtract(frame).data, frame.data - master.data,
+                               rtol=0., atol=1.e-12)
+    assert pool.loads == 3 and len(pool.masters) == 1
+
+
+@pytest.mark.parametrize('backend', ['inotify', 'poll'])
+def test_file_watcher(tmpdir, backend):
+    from KeckDRP import file_watcher
+    if backend == 'inotify' and file_watcher.load_libc() is None:
+        pytest.skip("inotify not available")
+    tmpdir.join('kb00001.fits').write('old')
+    watcher = file_watcher.open_watcher(str(tmpdir), '*.fits',
+                                        backend=backend, interval=0.01)
+    try:
+        assert watcher.existing == ['kb00001.fits']
+        assert watcher.wait(timeout=0.05) == []
+        # a file is reported once, after it is completely written
+        with open(str(tmpdir.join('kb00002.fits')), 'w') as f:
+            f.write('new')
+        tmpdir.join('kb00002.txt').write('other')
+        assert watcher.wait(timeout=5.) == [str(tmpdir.join('kb00002.fits'))]
+        tmpdir.join('kb00002.fits').write('again')
+        assert watcher.wait(timeout=0.05) == []
+        # moved in, as by a writer using a temporary file
+        tmpdir.join('tmp').write('moved')
+        os.rename(str(tmpdir.join('tmp')), str(tmpdir.join('kb00003.fits')))
+        assert watcher.wait(timeout=5.) == [str(tmpdir.join('kb00003.fits'))]
+    finally:
+        watcher.close()
+
+
+def write_raw_header(path, frameno, imtype, stateid='s1', ccdcfg='1121004',
+                     camera='BLUE', ttime=0.):
+    hdr = fits.Header()
+    hdr['FRAMENO'] = frameno
+    hdr['OBJECT'] = 'target'
+    hdr['IMTYPE'] = imtype
+    hdr['TELAPSE'] = 0.0
+    hdr['CAMERA'] = camera
+    hdr['CCDCFG'] = ccdcfg
+    hdr['STATEID'] = stateid
+    hdr['TTIME'] = ttime
+    fits.PrimaryHDU(np.zeros((2, 2)), header=hdr).writeto(path)
+    return path
+
+
+def record_frame(path, logdir, defer_stack=False):
+    """Stand-in for reduce.py go(), logging when it ran"""
+    import time
+    start = time.time()
+    time.sleep(0.05)
+    with open(os.path.join(logdir, os.path.basename(path) + '.txt'),
+              'w') as f:
+        f.write('%r %r %d' % (start, time.time(), defer_stack))
+
+
+@pytest.mark.parametrize('nprocs', [1, 2])
+def test_scheduler_dependencies(tmpdir, nprocs):
+    from KeckDRP import scheduler, Instruments
+    frames = [(1, 'OBJECT', 's1'), (2, 'ARCLAMP', 's1'),
+              (3, 'CONTBARS', 's1'), (4, 'BIAS', 's1'), (5, 'OBJECT', 's2'),
+              (6, 'BIAS', 's1'), (7, 'DARK', 's1'), (8, 'OBJECT', 's1'),
+              (9, 'ARCLAMP', 's2'), (10, 'CONTBARS', 's2'),
+              (11, 'BIAS', 's2', '2221004')]
+    paths = [write_raw_header(str(tmpdir.join('kb%05d.fits' % f[0])), *f)
+             for f in frames]
+    logdir = tmpdir.mkdir('log')
+    order = scheduler.run(paths, record_frame, args=(str(logdir),),
+                          nprocs=nprocs)
+    assert sorted(order) == sorted(paths)
+    times = {}
+    for path in paths:
+        start, end, defer = logdir.join(os.path.basename(path) + '.txt'
+                                        ).read().split()
+        times[path] = (float(start), float(end))
+    depends = scheduler.build_graph(scheduler.scan_frames(
+        paths, Instruments.KCWI()))
+    name = dict((p, os.path.basename(p)) for p in paths)
+    # objects wait for their biases, dark, bars and arc
+    assert set(name[p] for p in depends[paths[0]]) == set(
+        ['kb00002.fits', 'kb00003.fits', 'kb00004.fits', 'kb00006.fits',
+         'kb00007.fits'])
+    assert set(name[p] for p in depends[paths[5]]) == set(['kb00004.fits'])
+    assert not depends[paths[10]]
+    for path in paths:
+        for dep in depends[path]:
+            assert times[path][0] >= times[dep][1]
+            assert order.index(path) > order.index(dep)
+
+
+def test_scheduler_worker_conf(monkeypatch):
+    from KeckDRP import scheduler
+    for conf, item in [(KcwiConf, 'NPROCS'), (KcwiConf, 'NTHREADS'),
+                       (KeckDRP.conf, 'COMBINE_NPROCS'),
+                       (KeckDRP.conf, 'PROCTAB_BACKEND')]:
+        monkeypatch.setattr(conf, item, getattr(conf, item))
+    monkeypatch.setattr(os, 'cpu_count', lambda: 8)
+    scheduler.init_worker(3)
+    assert KcwiConf.NPROCS == KcwiConf.NTHREADS == 2
+    assert KeckDRP.conf.COMBINE_NPROCS == 2
+    assert KeckDRP.conf.PROCTAB_BACKEND == 'sqlite'
+    scheduler.init_worker(16)
+    assert KcwiConf.NPROCS == KcwiConf.NTHREADS == 1
+
+
+def test_batch_stacks_once(p, tmpdir):
+    from KeckDRP import scheduler
+    frames = [(1, 'OBJECT'), (2, 'BIAS'), (3, 'DARK'), (4, 'BIAS'),
+              (5, 'BIAS'), (6, 'DARK'), (7, 'FLATLAMP'), (8, 'FLATLAMP')]
+    paths = [write_raw_header(str(tmpdir.join('kb%05d.fits' % f[0])), *f)
+             for f in frames]
+    logdir = tmpdir.mkdir('log')
+    order = scheduler.run(paths, record_frame, args=(str(logdir),))
+    # calibrations first
+    assert [os.path.basename(f)[2:7] for f in order] == [
+        '00002', '00004', '00005', '00003', '00006', '00007', '00008',
+        '00001']
+    # only the last frame of each master stacks it
+    stacked = [path for path in paths if logdir.join(
+        os.path.basename(path) + '.txt').read().split()[2] == '0']
+    assert [os.path.basename(f)[2:7] for f in stacked] == [
+        '00001', '00005', '00006', '00008']
+    # only frames of the requested type are read
+    assert scheduler.run(paths, record_frame, args=(str(logdir),),
+                         imtype='dark') == [paths[2], paths[5]]
+    p.defer_stack = True
+    p.stack_biases()
+    p.stack_darks()
+    p.stack_internal_flats()
+
+
+def test_batch_stacks_each_dark_exposure(tmpdir):
+    from KeckDRP import scheduler
+    # one group of darks of two exposure times, as n_proctab() tells apart
+    frames = [(1, 'BIAS', 0.), (2, 'DARK', 300.), (3, 'DARK', 600.),
+              (4, 'DARK', 300.), (5, 'DARK', 600.), (6, 'DARK', 300.)]
+    paths = [write_raw_header(str(tmpdir.join('kb%05d.fits' % f[0])),
+                              f[0], f[1], ttime=f[2]) for f in frames]
+    logdir = tmpdir.mkdir('log')
+    scheduler.run(paths, record_frame, args=(str(logdir),))
+    stacked = [path for path in paths if logdir.join(
+        os.path.basename(path) + '.txt').read().split()[2] == '0']
+    assert [os.path.basename(f)[2:7] for f in stacked] == [
+        '00001', '00005', '00006']
+
+
+def synthetic_arcs(nbars=120, npix=2000, seed=11):
+    """Arc spectra of random lines, each bar shifted by a few pixels"""
+    rng = np.random.RandomState(seed)
+    x = np.arange(npix)
+    lines = rng.uniform(50, npix - 50, size=40)
+    fluxes = rng.uniform(100., 5000., size=40)
+    shifts = rng.uniform(-15., 15., size=nbars)
+    arcs = [np.sum(fluxes * np.exp(-0.5 * ((x[:, np.newaxis] - lines - sh) /
+                                           1.5) ** 2), axis=1) +
+            rng.normal(scale=5., size=npix) for sh in shifts]
+    return arcs, shifts
+
+
+def test_xcorr_matches_correlate():
+    from KeckDRP.KCWI.xcorr import xcorr_full, xcorr_peak
+    rng = np.random.RandomState(2)
+    ref = rng.normal(size=300)
+    stack = rng.normal(size=(7, 300))
+    xc = xcorr_full(ref, stack)
+    for row, spec in zip(xc, stack):
+        np.testing.assert_allclose(row, np.correlate(ref, spec, mode='full'),
+                                   rtol=0., atol=1.e-10)
+    # unequal lengths, as for the atlas
+    np.testing.assert_allclose(xcorr_full(stack[0][:200], ref),
+                               np.correlate(stack[0][:200], ref, mode='full'),
+                               rtol=0., atol=1.e-10)
+    # sub-pixel peak of a shifted Gaussian
+    x = np.arange(400.)
+    gauss = np.exp(-0.5 * ((x - 200.) / 4.) ** 2)
+    shifted = np.exp(-0.5 * ((x - 203.3) / 4.) ** 2)
+    lags = np.arange(-399, 400)
+    lag, peak = xcorr_peak(xcorr_full(shifted, gauss), lags)
+    assert lag == 3
+    lag, peak = xcorr_peak(xcorr_full(shifted, gauss), lags, refine=True)
+    assert abs(lag - 3.3) < 0.05
+
+
+def test_arc_offsets_match_correlate(p, monkeypatch):
+    monkeypatch.setattr(KcwiConf, 'INTER', 0)
+    arcs, shifts = synthetic_arcs()
+    p.set_frame(data_objects.KcwiCCD(np.zeros((2, 2)), unit='adu',
+                                     meta=fits.Header()))
+    p.arcs = arcs
+    p.arc_offsets()
+    refarc = arcs[p.REFBAR]
+    nsamp = len(refarc[10:-10])
+    offar = np.arange(1 - nsamp, nsamp)
+    expected = [offar[np.correlate(refarc[10:-10], arc[10:-10],
+                                   mode='full').argmax()] for arc in arcs]
+    assert list(p.baroffs) == expected
+
+
+def synthetic_central_fit(p, disp=0.5, npix=1200, seed=5):
+    """Atlas and bar arcs drawn from it with a known dispersion"""
+    from scipy.interpolate import interp1d
+    rng = np.random.RandomState(seed)
+    hdr = fits.Header()
+    hdr['CAMERA'] = 'BLUE'
+    hdr['BGRATNAM'] = 'BM'
+    hdr['BCWAVE'] = 4500.
+    hdr['BINNING'] = '2,2'
+    p.set_frame(data_objects.KcwiCCD(np.zeros((2, 2)), unit='adu',
+                                     meta=hdr))
+    half = npix * disp
+    p.refdisp = 0.2
+    p.refwave = np.arange(4500. - half, 4500. + half, p.refdisp)
+    lines = rng.uniform(4500. - 0.8 * half, 4500. + 0.8 * half, size=60)
+    fluxes = rng.uniform(100., 5000., size=60)
+    p.reflux = np.sum(fluxes * np.exp(-0.5 * (
+        (p.refwave[:, np.newaxis] - lines) / 1.2) ** 2), axis=1)
+    p.xvals = np.arange(npix) - int(npix / 2)
+    p.x0 = int(npix / 2)
+    p.minrow = int(npix / 3)
+    p.maxrow = int(2. * npix / 3)
+    p.baroffs = list(rng.randint(-10, 10, size=p.NBARS))
+    p.prelim_disp = disp * 1.02
+    p.offset_wave = 0.
+    atlas = interp1d(p.refwave, p.reflux, kind='cubic')
+    p0 = 4500. + np.array(p.baroffs) * p.prelim_disp
+    p.arcs = [atlas(np.polyval(p.disp_coeff(c, disp), p.xvals))
+              for c in p0]
+    return p0
+
+
+def test_xcorr_dispersions_match_loop(p, monkeypatch):
+    from scipy import signal
+    from scipy.interpolate import interp1d
+    monkeypatch.setattr(KcwiConf, 'INTER', 0)
+    p0 = synthetic_central_fit(p)
+    disps = 0.5 * np.linspace(0.97, 1.03, 7)
+    maxima, shifts = p.xcorr_dispersions(disps, p0)
+    assert maxima.shape == shifts.shape == (p.NBARS, len(disps))
+    subxvals = p.xvals[p.minrow:p.maxrow]
+    for b in (0, 57, 119):
+        subspec = p.arcs[b][p.minrow:p.maxrow]
+        for di, disp in enumerate(disps):
+            # one bar at one dispersion, as fit_center used to do it
+            coeff = p.disp_coeff(p0[b], disp)
+            wl0 = np.polyval(coeff, p.xvals[p.minrow])
+            wl1 = np.polyval(coeff, p.xvals[p.maxrow])
+            minrw = [i for i, v in enumerate(p.refwave)
+                     if v >= min(wl0, wl1)][0]
+            maxrw = [i for i, v in enumerate(p.refwave)
+                     if v <= max(wl0, wl1)][-1]
+            tkwgt = signal.windows.tukey(maxrw - minrw,
+                                         alpha=p.frame.taperfrac())
+            intspec = interp1d(np.polyval(coeff, subxvals), subspec,
+                               kind='cubic', bounds_error=False,
+                               fill_value='extrapolate')(
+                                   p.refwave[minrw:maxrw]) * tkwgt
+            xcorr = np.correlate(intspec, p.reflux[minrw:maxrw] * tkwgt,
+                                 mode='full')
+            offar = np.arange(1 - len(tkwgt), len(tkwgt))
+            x0c = int(len(xcorr) / 3)
+            x1c = int(2 * (len(xcorr) / 3))
+            imax = xcorr[x0c:x1c].argmax()
+            assert shifts[b, di] == offar[x0c:x1c][imax]
+            np.testing.assert_allclose(maxima[b, di], xcorr[x0c:x1c][imax],
+                                       rtol=1.e-9)
+
+
+def test_fit_center_recovers_dispersion(p, monkeypatch):
+    monkeypatch.setattr(KcwiConf, 'INTER', 0)
+    p0 = synthetic_central_fit(p)
+    p.fit_center()
+    assert len(p.centcoeff) == len(p.twkcoeff) == p.NBARS
+    centcoeff = np.array(p.centcoeff)
+    np.testing.assert_allclose(centcoeff[:, 3], 0.5, atol=2.e-3)
+    np.testing.assert_allclose(centcoeff[:, 4], p0, atol=0.5)
+
+
+def test_solve_bars_parallel_matches_serial(p, monkeypatch):
+    from scipy.signal import find_peaks
+    p0 = synthetic_central_fit(p, disp=0.3)
+    coeffs = [kcwi_primitives.pascal_shift(p.disp_coeff(c, 0.3), p.x0)
+              for c in p0]
+    p.at_wave = list(p.refwave[find_peaks(p.reflux, height=500.)[0]])
+    bspecs = p.arcs[:12]
+    monkeypatch.setattr(KcwiConf, 'NPROCS', 1)
+    serial = p.solve_bars(bspecs, coeffs, 50.)
+    monkeypatch.setattr(KcwiConf, 'NPROCS', 3)
+    monkeypatch.setattr(os, 'cpu_count', lambda: 4)
+    parallel = p.solve_bars(bspecs, coeffs, 50.)
+    assert len(serial) == len(parallel) == len(bspecs)
+    xs = np.arange(len(bspecs[0]))
+    for coeff, ser, par in zip(coeffs, serial, parallel):
+        assert np.array_equal(ser['wfit'], par['wfit'])
+        assert ser['wsig'] == par['wsig']
+        assert ser['at_wave_dat'] == par['at_wave_dat']
+        assert len(ser['at_wave_dat']) > 10
+        np.testing.assert_allclose(np.polyval(ser['wfit'], xs[400:800]),
+                                   np.polyval(coeff, xs[400:800]), atol=0.1)
+
+
+def test_linefit_matches_curve_fit():
+    from scipy.optimize import curve_fit
+    from scipy.interpolate import interp1d
+    from KeckDRP.KCWI import linefit
+    rng = np.random.RandomState(3)
+    npix = 2000
+    x = np.arange(npix) * 0.2 + 4000.
+    y = rng.normal(scale=3., size=npix)
+    cen = np.arange(60., npix - 60., 40.)
+    cen += rng.uniform(-3., 3., size=len(cen))
+    sig = rng.uniform(1.5, 4., size=len(cen))
+    for c, s in zip(cen, sig):
+        y += rng.uniform(50., 3000.) * np.exp(
+            -0.5 * ((np.arange(npix) - c) / s) ** 2)
+    x0 = (cen - 1.2 * sig).astype(int)
+    x1 = (cen + 1.2 * sig).astype(int) + 1
+    xw, yw, mask = linefit.pad_windows(y, x, x0, x1)
+    fits, ok = linefit.fit_gaussians(xw, yw, mask)
+    peaks, pkvals = linefit.spline_peaks(xw, yw, mask)
+    cents = linefit.centroids(xw, yw, mask)
+    assert ok.all()
+    for i in range(len(cen)):
+        xvec = x[x0[i]:x1[i] + 1]
+        yvec = y[x0[i]:x1[i] + 1]
+        fit, _ = curve_fit(kcwi_primitives.gaus, xvec, yvec,
+                           p0=[100., xvec[len(xvec) // 2], 1.])
+        np.testing.assert_allclose(fits[i, :2], fit[:2], rtol=1.e-6)
+        np.testing.assert_allclose(abs(fits[i, 2]), abs(fit[2]), rtol=1.e-6)
+        # the analytic peak is within a step of the dense grid peak
+        x_dense = np.linspace(min(xvec), max(xvec), num=1000)
+        y_dense = interp1d(xvec, yvec, kind='cubic')(x_dense)
+        assert abs(peaks[i] - x_dense[y_dense.argmax()]) <= \
+            x_dense[1] - x_dense[0]
+        assert pkvals[i] >= y_dense.max() - 1.e-9
+        np.testing.assert_allclose(cents[i], np.sum(xvec * yvec) /
+                                   np.sum(yvec))
+
+
+@pytest.mark.parametrize('seed', range(25))
+def test_line_windows_match_scalar(seed):
+    # random spectra of lines on noise, with ties and NaNs, and centers
+    # anywhere, including off the ends
+    rng = np.random.RandomState(seed)
+    nx = rng.randint(6, 300)
+    x = np.arange(nx)
+    for trial in range(8):
+        y = rng.normal(scale=rng.uniform(0.1, 20.), size=nx)
+        for line in range(rng.randint(0, 12)):
+            y += rng.uniform(0., 500.) * np.exp(
+                -0.5 * ((x - rng.uniform(-5., nx + 5.)) /
+                        rng.uniform(0.5, 6.)) ** 2)
+        if trial % 4 == 1:
+            y = np.round(y)
+        elif trial % 4 == 2:
+            y[rng.randint(0, nx, size=3)] = np.nan
+        cs = rng.randint(-3, nx + 3, size=50)
+        thresh = rng.choice([0., 50.])
+        x0, x1, count = kcwi_primitives.get_line_windows(y, cs, thresh)
+        for c, win in zip(cs, zip(x0, x1, count)):
+            try:
+                minow, maxow, cnt = kcwi_primitives.get_line_window(y, c,
+                                                                    thresh)
+            except (IndexError, ValueError):
+                minow, maxow, cnt = None, None, 0
+            if cnt == 0:
+                assert win == (0, 0, 0)
+            else:
+                assert win == (minow, maxow, cnt)
@@ -0,0 +1,71 @@
+"""Batched cross-correlation of spectra with real FFTs
+
+xcorr_full() gives what np.correlate(a, v, mode='full') gives, for one
+spectrum or a stack of spectra at once, in O(N log N) instead of
+O(N^2): every row is transformed in one call and the products inverse
+transformed in another.  xcorr_peak() locates the maximum of each
+correlation, optionally to a fraction of a sample by fitting a parabola
+through the peak and its two neighbours.
+"""
+import numpy as np
+from scipy import fft
+
+
+def xcorr_full(a, v):
+    """Full cross-correlation of the last axes of a and v
+
+    Args:
+    -----
+        a, v (array): spectra, or stacks of spectra that broadcast
+            against each other, e.g. (nbars, n) and (n,)
+
+    Returns:
+    --------
+        array: shape (..., len(a) + len(v) - 1), sample k is the
+            correlation at lag k - (len(v) - 1), as for np.correlate
+    """
+    a = np.asarray(a, dtype=np.float64)
+    v = np.asarray(v, dtype=np.float64)
+    n = a.shape[-1] + v.shape[-1] - 1
+    nfft = fft.next_fast_len(n, real=True)
+    # correlating with v is convolving with v reversed
+    spec = fft.rfft(a, nfft, axis=-1) * fft.rfft(v[..., ::-1], nfft, axis=-1)
+    return fft.irfft(spec, nfft, axis=-1)[..., :n]
+
+
+def xcorr_peak(xcorr, lags, refine=False, size=None):
+    """Lag and value of the maximum of each correlation
+
+    Args:
+    -----
+        xcorr (array): correlations along the last axis
+        lags (array): lag of each sample
+        refine (bool): interpolate the lag of the maximum with a parabola
+            through the three samples around it
+        size (array): number of samples of each correlation, for stacks
+            of correlations of different lengths padded with -inf
+
+    Returns:
+    --------
+        array: lags of the maxima, lags[argmax] unless refine
+        array: values at the maxima
+    """
+    xcorr = np.asarray(xcorr)
+    lags = np.asarray(lags)
+    imax = np.argmax(xcorr, axis=-1)
+    peak = np.take_along_axis(xcorr, imax[..., np.newaxis], -1)[..., 0]
+    lag = lags[imax]
+    if refine:
+        if size is None:
+            size = xcorr.shape[-1]
+        inner = (imax > 0) & (imax < size - 1)
+        i0 = np.clip(imax, 1, np.maximum(size - 2, 1))[..., np.newaxis]
+        ym = np.take_along_axis(xcorr, i0 - 1, -1)[..., 0]
+        y0 = np.take_along_axis(xcorr, i0, -1)[..., 0]
+        yp = np.take_along_axis(xcorr, i0 + 1, -1)[..., 0]
+        curv = ym - 2. * y0 + yp
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delta = np.where(inner & (curv < 0.), 0.5 * (ym - yp) / curv, 0.)
+        step = lags[1] - lags[0] if len(lags) > 1 else 1
+        lag = lag + delta * step
+    return lag, peak
@@ -38,6 +38,54 @@ if not _ASTROPY_SETUP_:
             True,
             'Overwrite output images?'
         )
+        COMBINE_TILE_ROWS = _config.ConfigItem(
+            256,
+            'Rows per tile when stacking from disk (0: stack in memory)'
+        )
+        COMBINE_NPROCS = _config.ConfigItem(
+            4,
+            'Max processes for stacking from disk (capped at the CPU count)'
+        )
+        PROCTAB_BACKEND = _config.ConfigItem(
+            'journal',
+            'Proc table storage: journal, or sqlite to share between processes'
+        )
+        NEAREST_BY_MJD = _config.ConfigItem(
+            False,
+            'Associate calibrations by nearest MJD instead of FRAMENO'
+        )
+        PROCTAB_EXPORT = _config.ConfigItem(
+            True,
+            'Export the proc table journal to the fixed-width kcwi.proc file'
+        )
+        CALIB_CACHE_DIR = _config.ConfigItem(
+            '',
+            'Directory of the calibration cache (default: REDUXDIR/cache)'
+        )
+        CALIB_CACHE_MB = _config.ConfigItem(
+            1024.,
+            'Memory held by cached calibration products (MB)'
+        )
+        CALIB_CACHE_DISK_MB = _config.ConfigItem(
+            4096.,
+            'Disk space held by cached calibration products (MB, 0: no disk)'
+        )
+        MASTER_POOL_MB = _config.ConfigItem(
+            1024.,
+            'Memory held by master frames kept loaded for subtraction (MB)'
+        )
+        WATCH_BACKEND = _config.ConfigItem(
+            'auto',
+            'How reduce.py --loop finds new frames: auto, inotify or poll'
+        )
+        WATCH_INTERVAL = _config.ConfigItem(
+            1.0,
+            'Seconds between directory listings when polling for new frames'
+        )
+        REDUCE_NPROCS = _config.ConfigItem(
+            1,
+            'Frames reduced at once by reduce.py (>1 needs the sqlite backend)'
+        )
 
     conf = Conf()
 
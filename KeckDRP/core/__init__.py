@@ -3,3 +3,9 @@ from .imgmath_primitives import ImgmathPrimitives
 from .proctab_primitives import ProctabPrimitives
 from .development_primitives import DevelopmentPrimitives
 from .decorators import repeat_processing
+from .ccd_geometry import CcdGeometry
+from .stack_accumulator import StackAccumulator
+from .proctab import ProcTable
+from .proctab import SqliteProcTable
+from .calib_cache import CalibCache
+from .master_pool import MasterPool
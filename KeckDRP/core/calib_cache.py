@@ -0,0 +1,192 @@
+"""Content-addressed cache of calibration products
+
+Calibration products, such as master bias and dark arrays, fitted
+transforms, coordinate maps and atlas line lists, are looked up by a
+key hashing the kind of product, the identity of every input file (its
+absolute path, size and modification time) and the configuration values
+the product depends on.  Rewriting an input, or changing a parameter,
+changes the key, so a stale entry is never returned and never needs to
+be invalidated.
+
+There are two tiers:
+
+    memory  least recently used entries are dropped once the arrays held
+            exceed CALIB_CACHE_MB
+    disk    one .npz file per entry in CALIB_CACHE_DIR, the least
+            recently used files are removed once they exceed
+            CALIB_CACHE_DISK_MB
+
+A value is a dict of numpy arrays, numbers and strings.  Values that
+cannot be stored in an npz file, e.g. transform objects, are only kept
+in memory.
+"""
+import collections
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+# caches opened in this process, by directory, sizes and process id
+open_caches = {}
+
+
+def file_id(path):
+    """Absolute path, size and modification time of an input file"""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    return [path, st.st_size, st.st_mtime_ns]
+
+
+def nbytes(value):
+    """Memory held by the arrays of a cache value"""
+    return sum(v.nbytes for v in value.values()
+               if isinstance(v, np.ndarray) and not isinstance(v, np.memmap))
+
+
+class CalibCache(object):
+
+    def __init__(self, cachedir=None, max_mb=1024., disk_mb=4096.):
+        self.cachedir = cachedir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.disk_bytes = int(disk_mb * 1024 * 1024)
+        # key: (value, nbytes), least recently used first
+        self.memory = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @classmethod
+    def open(cls, cachedir=None):
+        """Return the cache for cachedir, shared within the process
+
+        The directory and sizes default to the CALIB_CACHE_* items of the
+        configuration.
+        """
+        import KeckDRP
+        if cachedir is None:
+            cachedir = KeckDRP.conf.CALIB_CACHE_DIR or \
+                os.path.join(KeckDRP.conf.REDUXDIR, 'cache')
+        # an absolute path, the process may change directory later
+        cachedir = os.path.abspath(cachedir)
+        max_mb = KeckDRP.conf.CALIB_CACHE_MB
+        disk_mb = KeckDRP.conf.CALIB_CACHE_DISK_MB
+        path = (cachedir, max_mb, disk_mb, os.getpid())
+        cache = open_caches.get(path)
+        if cache is None:
+            cache = cls(cachedir, max_mb=max_mb, disk_mb=disk_mb)
+            open_caches[path] = cache
+        return cache
+
+    @staticmethod
+    def key(kind, files=(), **config):
+        """Hash of a product kind, its input files and configuration
+
+        Args:
+        -----
+            kind (str): product name, e.g. 'master'
+            files (list): input file paths, all must exist
+            config: parameters the product depends on, JSON serializable
+
+        Returns:
+        --------
+            str: SHA-256 hex digest
+        """
+        sha = hashlib.sha256()
+        sha.update(json.dumps([kind, [file_id(f) for f in files],
+                               sorted(config.items())],
+                              default=str).encode())
+        return sha.hexdigest()
+
+    def disk_path(self, key):
+        return os.path.join(self.cachedir, key + '.npz')
+
+    def get(self, key, default=None):
+        """Cached value for key, from memory or else from disk"""
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key][0]
+        if self.cachedir is not None and self.disk_bytes > 0:
+            path = self.disk_path(key)
+            try:
+                with np.load(path, allow_pickle=False) as npz:
+                    value = dict((k, npz[k].item() if npz[k].ndim == 0
+                                  else npz[k]) for k in npz.files)
+                # mark as recently used for disk eviction
+                os.utime(path)
+            except (OSError, ValueError):
+                value = None
+            if value is not None:
+                self.disk_hits += 1
+                self.remember(key, value)
+                return value
+        self.misses += 1
+        return default
+
+    def put(self, key, value, persist=True):
+        """Store a value in memory and, if persist, on disk"""
+        self.remember(key, value)
+        if persist and self.cachedir is not None and self.disk_bytes > 0:
+            os.makedirs(self.cachedir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.cachedir)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    np.savez(f, **value)
+                os.replace(tmp, self.disk_path(key))
+            except Exception:
+                os.remove(tmp)
+                raise
+            self.evict_disk()
+        return value
+
+    def fetch(self, key, compute, persist=True):
+        """Cached value for key, calling compute() to make it if missing"""
+        value = self.get(key)
+        if value is None:
+            value = self.put(key, compute(), persist=persist)
+        return value
+
+    def remember(self, key, value):
+        """Add a value to the memory tier, dropping old entries to fit"""
+        size = nbytes(value)
+        if key in self.memory:
+            self.nbytes -= self.memory.pop(key)[1]
+        if size > self.max_bytes:
+            return
+        self.memory[key] = (value, size)
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            self.nbytes -= self.memory.popitem(last=False)[1][1]
+
+    def evict_disk(self):
+        """Remove the least recently used files beyond the disk budget"""
+        entries = []
+        for name in os.listdir(self.cachedir):
+            if name.endswith('.npz'):
+                try:
+                    st = os.stat(os.path.join(self.cachedir, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(e[1] for e in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cachedir, name))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self, disk=False):
+        """Empty the memory tier, and the disk tier if disk"""
+        self.memory.clear()
+        self.nbytes = 0
+        if disk and self.cachedir is not None and \
+                os.path.isdir(self.cachedir):
+            for name in os.listdir(self.cachedir):
+                if name.endswith('.npz'):
+                    os.remove(os.path.join(self.cachedir, name))
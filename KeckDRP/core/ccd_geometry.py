@@ -0,0 +1,138 @@
+"""CCD readout geometry, parsed once per readout configuration
+
+The amplifier sections of a raw KCWI frame only depend on the readout
+configuration (CCDCFG and AMPMODE), so they are parsed from the header
+strings once and the resulting CcdGeometry is shared by every frame
+taken with the same configuration.
+"""
+from functools import lru_cache
+
+
+@lru_cache(maxsize=256)
+def parse_section(section):
+    """Parse a FITS image section string
+
+    Args:
+    -----
+        section (str): FITS section, e.g. '[1:2048,1:2056]'
+
+    Returns:
+    --------
+        tuple: (int) y0, y1, x0, x1, 0-biased and inclusive
+        tuple: (bool) y-direction, x-direction, True if forward, else False
+    """
+    xsec, ysec = section.strip()[1:-1].split(',')
+    p1, p2 = (int(p) for p in xsec.split(':'))
+    p3, p4 = (int(p) for p in ysec.split(':'))
+    # tests for individual axes
+    xfor = p1 <= p2
+    yfor = p3 <= p4
+    x0, x1 = (p1 - 1, p2 - 1) if xfor else (p2 - 1, p1 - 1)
+    y0, y1 = (p3 - 1, p4 - 1) if yfor else (p4 - 1, p3 - 1)
+    # use python axis ordering
+    return (y0, y1, x0, x1), (yfor, xfor)
+
+
+def rectification_mode(ampmode):
+    """Return the reorientation needed for a given AMPMODE
+
+    Returns:
+    --------
+        str: 'rot180', 'fliplr', 'flipud' or None
+    """
+    ampmode = ampmode.strip().upper()
+    if '__B' in ampmode or '__G' in ampmode:
+        return 'rot180'
+    elif '__D' in ampmode or '__F' in ampmode:
+        return 'fliplr'
+    elif '__A' in ampmode or '__H' in ampmode or 'TUP' in ampmode:
+        return 'flipud'
+    else:
+        return None
+
+
+def to_slices(sec):
+    """Convert an inclusive (y0, y1, x0, x1) section to numpy slices"""
+    return slice(sec[0], sec[1] + 1), slice(sec[2], sec[3] + 1)
+
+
+class CcdGeometry(object):
+    """Amplifier sections of a raw frame for one readout configuration
+
+    Attributes:
+    -----------
+        namps (int): number of amplifiers
+        bsec, dsec, tsec (list): (y0, y1, x0, x1) bias, data and trimmed
+            sections for each amp, as returned by map_ccd()
+        direc (list): (y, x) read directions, True if forward
+        rsec (list): trimmed sections after rectification
+        bias_slices, data_slices, trim_slices, rect_slices (list):
+            (y, x) slice pairs for the sections above
+        shape (tuple): shape of the trimmed image
+        rectify (str): reorientation for the AMPMODE, see
+            rectification_mode()
+    """
+
+    def __init__(self, ampmode, bsecs, dsecs):
+        self.namps = len(bsecs)
+        self.bsec = []
+        self.dsec = []
+        self.tsec = []
+        self.direc = []
+        for i in range(self.namps):
+            sec, rfor = parse_section(bsecs[i])
+            self.bsec.append(sec)
+            sec, rfor = parse_section(dsecs[i])
+            self.dsec.append(sec)
+            self.direc.append(rfor)
+            ny = sec[1] - sec[0]
+            nx = sec[3] - sec[2]
+            # amps are laid out as | 3 | 4 | over | 1 | 2 |
+            if i == 0:
+                y0, x0 = 0, 0
+            elif i == 1:
+                y0, x0 = 0, self.tsec[0][3] + 1
+            elif i == 2:
+                y0, x0 = self.tsec[0][1] + 1, 0
+            elif i == 3:
+                y0, x0 = self.tsec[0][1] + 1, self.tsec[0][3] + 1
+            else:
+                raise ValueError("bad amp number: %d" % i)
+            self.tsec.append((y0, y0 + ny, x0, x0 + nx))
+        max_sec = max(self.tsec)
+        self.shape = (max_sec[1] + 1, max_sec[3] + 1)
+        # trimmed sections after rectification
+        self.rectify = rectification_mode(ampmode)
+        ny, nx = self.shape
+        self.rsec = []
+        for sec in self.tsec:
+            y0, y1, x0, x1 = sec
+            if self.rectify in ('rot180', 'flipud'):
+                y0, y1 = ny - 1 - sec[1], ny - 1 - sec[0]
+            if self.rectify in ('rot180', 'fliplr'):
+                x0, x1 = nx - 1 - sec[3], nx - 1 - sec[2]
+            self.rsec.append((y0, y1, x0, x1))
+        # precomputed slices
+        self.bias_slices = [to_slices(sec) for sec in self.bsec]
+        self.data_slices = [to_slices(sec) for sec in self.dsec]
+        self.trim_slices = [to_slices(sec) for sec in self.tsec]
+        self.rect_slices = [to_slices(sec) for sec in self.rsec]
+
+
+@lru_cache(maxsize=32)
+def get_geometry(ccdcfg, ampmode, bsecs, dsecs):
+    """Memoized CcdGeometry for a readout configuration
+
+    The section strings are part of the key so that frames with the same
+    CCDCFG and AMPMODE but different sections never share a geometry.
+    """
+    return CcdGeometry(ampmode, bsecs, dsecs)
+
+
+def ccd_geometry(header):
+    """Return the (shared) CcdGeometry for a raw frame header"""
+    namps = header['NVIDINP']
+    bsecs = tuple(header['BSEC%d' % (i + 1)] for i in range(namps))
+    dsecs = tuple(header['DSEC%d' % (i + 1)] for i in range(namps))
+    return get_geometry(str(header.get('CCDCFG', '')),
+                        header['AMPMODE'].strip().upper(), bsecs, dsecs)
@@ -1,7 +1,9 @@
 from KeckDRP import PrimitivesBASE
+from .ccd_geometry import ccd_geometry, parse_section, rectification_mode
 import numpy as np
 import matplotlib.pyplot as pl
 import math
+from concurrent.futures import ThreadPoolExecutor
 
 
 class CcdPrimitives(PrimitivesBASE):
@@ -17,34 +19,39 @@ class CcdPrimitives(PrimitivesBASE):
             porder = 7
         # header keyword to update
         key = 'OSCANSUB'
-        # is it performed?
+        # working precision, converted once so the subtraction is in place
+        if self.frame.float32():
+            dtype = np.float32
+        else:
+            dtype = np.float64
+        if self.frame.data.dtype != dtype:
+            self.frame.data = self.frame.data.astype(dtype)
+        # fit and subtract each amp, in parallel if configured
+        results = self.process_amps(self.subtract_oscan_amp, namps,
+                                    bsec, dsec, direc, porder)
+        # log, record and plot in amp order
+        performed = self.record_oscan(results)
+
+        if performed:
+            self.frame.header[key] = (True, self.keyword_comments[key])
+        else:
+            self.frame.header[key] = (False, self.keyword_comments[key])
+        logstr = self.subtract_oscan.__module__ + "." + \
+                 self.subtract_oscan.__qualname__
+        self.frame.header['HISTORY'] = logstr
+        self.log.info(self.subtract_oscan.__qualname__)
+
+    def record_oscan(self, results):
+        """Log, plot and record the per-amp overscan fits in amp order
+
+        Returns:
+        --------
+            bool: True if the overscan was subtracted from any amp
+        """
         performed = False
-        # loop over amps
-        for ia in range(namps):
-            # get gain
-            gain = self.frame.header['GAIN%d' % (ia + 1)]
-            # check if we have enough data to fit
-            if (bsec[ia][3] - bsec[ia][2]) > self.frame.minoscanpix():
-                # pull out an overscan vector
-                x0 = bsec[ia][2] + self.frame.oscanbuf()
-                x1 = bsec[ia][3] - self.frame.oscanbuf()
-                y0 = bsec[ia][0]
-                y1 = bsec[ia][1] + 1
-                osvec = np.nanmedian(self.frame.data[y0:y1, x0:x1], axis=1)
-                nsam = x1 - x0
-                xx = np.arange(len(osvec), dtype=np.float)
-                # fit it, avoiding first 50 px
-                if direc[ia]:
-                    # forward read skips first 50 px
-                    oscoef = np.polyfit(xx[50:], osvec[50:], porder)
-                else:
-                    # reverse read skips last 50 px
-                    oscoef = np.polyfit(xx[:-50], osvec[:-50], porder)
-                # generate fitted overscan vector for full range
-                osfit = np.polyval(oscoef, xx)
-                # calculate residuals
-                resid = (osvec - osfit) * math.sqrt(nsam) * gain / 1.414
-                sdrs = float("%.3f" % np.std(resid))
+        for ia, result in enumerate(results):
+            if result is not None:
+                osvec, osfit, sdrs = result
                 self.log.info("Amp%d Read noise from oscan in e-: %.3f" %
                               ((ia + 1), sdrs))
                 self.frame.header['OSCNRN%d' % (ia + 1)] = \
@@ -68,22 +75,68 @@ class CcdPrimitives(PrimitivesBASE):
                     else:
                         pl.pause(self.frame.plotpause())
                     pl.clf()
-                # subtract it
-                for ix in range(dsec[ia][2], dsec[ia][3]+1):
-                    self.frame.data[y0:y1, ix] = \
-                        self.frame.data[y0:y1, ix] - osfit
                 performed = True
             else:
-                self.log.info("not enough overscan px to fit amp %d")
+                self.log.info("not enough overscan px to fit amp %d" %
+                              (ia + 1))
+        return performed
 
-        if performed:
-            self.frame.header[key] = (True, self.keyword_comments[key])
+    def subtract_oscan_amp(self, ia, bsec, dsec, direc, porder):
+        """Fit and subtract the overscan of a single amplifier
+
+        Only touches the rows and columns of amp ia, so amps can be
+        processed concurrently.
+
+        Returns:
+        --------
+            tuple: overscan vector, fitted overscan, read noise in e-,
+                   or None if there are not enough overscan pixels
+        """
+        result = self.fit_oscan_amp(ia, bsec, direc, porder)
+        if result is not None:
+            osfit = result[1]
+            # subtract it from all data columns in one in-place operation
+            y0 = bsec[ia][0]
+            y1 = bsec[ia][1] + 1
+            x0 = dsec[ia][2]
+            x1 = dsec[ia][3] + 1
+            self.frame.data[y0:y1, x0:x1] -= osfit[:, np.newaxis]
+        return result
+
+    def fit_oscan_amp(self, ia, bsec, direc, porder):
+        """Fit the overscan of a single amplifier without subtracting it
+
+        Returns:
+        --------
+            tuple: overscan vector, fitted overscan, read noise in e-,
+                   or None if there are not enough overscan pixels
+        """
+        # get gain
+        gain = self.frame.header['GAIN%d' % (ia + 1)]
+        # check if we have enough data to fit
+        if (bsec[ia][3] - bsec[ia][2]) <= self.frame.minoscanpix():
+            return None
+        # pull out an overscan vector
+        x0 = bsec[ia][2] + self.frame.oscanbuf()
+        x1 = bsec[ia][3] - self.frame.oscanbuf()
+        y0 = bsec[ia][0]
+        y1 = bsec[ia][1] + 1
+        osvec = np.nanmedian(self.frame.data[y0:y1, x0:x1], axis=1)
+        nsam = x1 - x0
+        xx = np.arange(len(osvec), dtype=np.float)
+        # fit it, avoiding first 50 px
+        if direc[ia]:
+            # forward read skips first 50 px
+            oscoef = np.polyfit(xx[50:], osvec[50:], porder)
         else:
-            self.frame.header[key] = (False, self.keyword_comments[key])
-        logstr = self.subtract_oscan.__module__ + "." + \
-                 self.subtract_oscan.__qualname__
-        self.frame.header['HISTORY'] = logstr
-        self.log.info(self.subtract_oscan.__qualname__)
+            # reverse read skips last 50 px
+            oscoef = np.polyfit(xx[:-50], osvec[:-50], porder)
+        # generate fitted overscan vector for full range
+        osfit = np.polyval(oscoef, xx)
+        # calculate residuals
+        resid = (osvec - osfit) * math.sqrt(nsam) * gain / 1.414
+        sdrs = float("%.3f" % np.std(resid))
+        return osvec, osfit, sdrs
 
     def trim_oscan(self):
         # parameters
@@ -95,21 +148,20 @@ class CcdPrimitives(PrimitivesBASE):
         # get output image dimensions
         max_sec = max(tsec)
         # create new blank image
-        new = np.zeros((max_sec[1]+1, max_sec[3]+1), dtype=np.float64)
+        if self.frame.float32():
+            dtype = np.float32
+        else:
+            dtype = np.float64
+        new = np.zeros((max_sec[1]+1, max_sec[3]+1), dtype=dtype)
+        # transfer each amp to new image, in parallel if configured
+        self.process_amps(self.trim_oscan_amp, namps, dsec, tsec, new)
         # loop over amps
         for ia in range(namps):
-            # input range indices
-            yi0 = dsec[ia][0]
-            yi1 = dsec[ia][1] + 1
-            xi0 = dsec[ia][2]
-            xi1 = dsec[ia][3] + 1
             # output range indices
             yo0 = tsec[ia][0]
             yo1 = tsec[ia][1] + 1
             xo0 = tsec[ia][2]
             xo1 = tsec[ia][3] + 1
-            # transfer to new image
-            new[yo0:yo1, xo0:xo1] = self.frame.data[yi0:yi1, xi0:xi1]
             # update amp section
             sec = "[%d:" % (xo0+1)
             sec += "%d," % xo1
@@ -132,17 +184,37 @@ class CcdPrimitives(PrimitivesBASE):
         self.frame.header['HISTORY'] = logstr
         self.log.info(self.trim_oscan.__qualname__)
 
+    def trim_oscan_amp(self, ia, dsec, tsec, new):
+        """Copy the data section of amp ia into the trimmed image new"""
+        # input range indices
+        yi0 = dsec[ia][0]
+        yi1 = dsec[ia][1] + 1
+        xi0 = dsec[ia][2]
+        xi1 = dsec[ia][3] + 1
+        # output range indices
+        yo0 = tsec[ia][0]
+        yo1 = tsec[ia][1] + 1
+        xo0 = tsec[ia][2]
+        xo1 = tsec[ia][3] + 1
+        # transfer to new image
+        new[yo0:yo1, xo0:xo1] = self.frame.data[yi0:yi1, xi0:xi1]
+
     def correct_gain(self):
         namps = self.frame.namps()
+        secs = []
+        gains = []
         for ia in range(namps):
             # get amp section
             sec, rfor = self.parse_imsec(
                 section_key='ATSEC%d' % (ia + 1))
+            secs.append(sec)
             # get gain for this amp
             gain = self.frame.header['GAIN%d' % (ia + 1)]
+            gains.append(gain)
             self.log.info("Applying gain correction of %.3f in section %s" %
                           (gain, self.frame.header['ATSEC%d' % (ia + 1)]))
-            self.frame.data[sec[0]:(sec[1]+1), sec[2]:(sec[3]+1)] *= gain
+        # apply gains, in parallel if configured
+        self.process_amps(self.correct_gain_amp, namps, secs, gains)
 
         self.frame.header['GAINCOR'] = (True, self.keyword_comments['GAINCOR'])
         self.frame.header['BUNIT'] = ('electron',
@@ -154,6 +226,11 @@ class CcdPrimitives(PrimitivesBASE):
         self.frame.header['HISTORY'] = logstr
         self.log.info(self.correct_gain.__qualname__)
 
+    def correct_gain_amp(self, ia, secs, gains):
+        """Multiply amp section ia by its gain in place"""
+        sec = secs[ia]
+        self.frame.data[sec[0]:(sec[1]+1), sec[2]:(sec[3]+1)] *= gains[ia]
+
     def remove_crs(self):
         self.log.info("remove_crs")
 
@@ -162,18 +239,18 @@ class CcdPrimitives(PrimitivesBASE):
 
     def rectify_image(self):
         """Rotate images based on ampmode"""
-        ampmode = self.frame.header['AMPMODE'].strip().upper()
-        if '__B' in ampmode or '__G' in ampmode:
+        mode = self.rectification()
+        if mode == 'rot180':
             newimg = np.rot90(self.frame.data, 2)
             newunc = np.rot90(self.frame.uncertainty.array, 2)
             self.frame.data = newimg
             self.frame.uncertainty.array = newunc
-        elif '__D' in ampmode or '__F' in ampmode:
+        elif mode == 'fliplr':
             newimg = np.fliplr(self.frame.data)
             newunc = np.fliplr(self.frame.uncertainty.array)
             self.frame.data = newimg
             self.frame.uncertainty.array = newunc
-        elif '__A' in ampmode or '__H' in ampmode or 'TUP' in ampmode:
+        elif mode == 'flipud':
             newimg = np.flipud(self.frame.data)
             newunc = np.flipud(self.frame.uncertainty.array)
             self.frame.data = newimg
@@ -183,38 +260,128 @@ class CcdPrimitives(PrimitivesBASE):
         self.frame.header['HISTORY'] = logstr
         self.log.info(self.rectify_image.__qualname__)
 
+    def rectification(self):
+        """Return the reorientation needed for the AMPMODE of the frame
+
+        Returns:
+        --------
+            str: 'rot180', 'fliplr', 'flipud' or None
+        """
+        return rectification_mode(self.frame.header['AMPMODE'])
+
+    def basic_ccd_reduce(self):
+        """Overscan subtract, trim, gain correct and rectify in one pass
+
+        Equivalent to calling subtract_oscan, trim_oscan, correct_gain and
+        rectify_image in turn, but each raw amp section is read once and
+        written, overscan subtracted and gain corrected, straight into its
+        rectified place in a single output image.  The ATSECn keywords
+        describe the amp sections of the rectified output, so later
+        per-amp steps (e.g. create_unc) can be applied after this one.
+        """
+        # image sections for each amp
+        geom = self.ccd_geometry()
+        namps = geom.namps
+        # polynomial fit order
+        if namps == 4:
+            porder = 2
+        else:
+            porder = 7
+        # output image, in working precision
+        if self.frame.float32():
+            dtype = np.float32
+        else:
+            dtype = np.float64
+        new = np.zeros(geom.shape, dtype=dtype)
+        ny, nx = geom.shape
+        rsec = geom.rsec
+        # gains
+        gains = [self.frame.header['GAIN%d' % (ia + 1)]
+                 for ia in range(namps)]
+        # reduce each amp, in parallel if configured
+        results = self.process_amps(self.basic_ccd_reduce_amp, namps, geom,
+                                    porder, gains, new)
+        # overscan
+        performed = self.record_oscan(results)
+        self.frame.header['OSCANSUB'] = (performed,
+                                         self.keyword_comments['OSCANSUB'])
+        # trim
+        for ia in range(namps):
+            sec = rsec[ia]
+            self.frame.header['ATSEC%d' % (ia+1)] = "[%d:%d,%d:%d]" % (
+                sec[2] + 1, sec[3] + 1, sec[0] + 1, sec[1] + 1)
+            # remove obsolete sections
+            self.frame.header.pop('ASEC%d' % (ia + 1))
+            self.frame.header.pop('BSEC%d' % (ia + 1))
+            self.frame.header.pop('DSEC%d' % (ia + 1))
+            self.frame.header.pop('CSEC%d' % (ia + 1))
+            self.log.info("Applying gain correction of %.3f in section %s" %
+                          (gains[ia], self.frame.header['ATSEC%d' % (ia + 1)]))
+        self.frame.data = new
+        self.frame.header['NAXIS1'] = nx
+        self.frame.header['NAXIS2'] = ny
+        self.frame.header['OSCANTRM'] = (True,
+                                         self.keyword_comments['OSCANTRM'])
+        # gain
+        self.frame.header['GAINCOR'] = (True, self.keyword_comments['GAINCOR'])
+        self.frame.header['BUNIT'] = ('electron',
+                                      self.keyword_comments['BUNIT'])
+        self.frame.unit = 'electron'
+
+        logstr = self.basic_ccd_reduce.__module__ + "." + \
+                 self.basic_ccd_reduce.__qualname__
+        self.frame.header['HISTORY'] = logstr
+        self.log.info(self.basic_ccd_reduce.__qualname__)
+
+    def basic_ccd_reduce_amp(self, ia, geom, porder, gains, new):
+        """Write amp ia of the raw frame into its place in the output image
+
+        Returns:
+        --------
+            tuple: overscan fit results, as from fit_oscan_amp
+        """
+        result = self.fit_oscan_amp(ia, geom.bsec, geom.direc, porder)
+        # raw data section
+        raw = self.frame.data[geom.data_slices[ia]]
+        # output section, viewed in raw orientation
+        out = new[geom.rect_slices[ia]]
+        if geom.rectify in ('rot180', 'flipud'):
+            out = out[::-1, :]
+        if geom.rectify in ('rot180', 'fliplr'):
+            out = out[:, ::-1]
+        if result is not None:
+            # overscan rows matching the data section
+            iy0 = geom.dsec[ia][0] - geom.bsec[ia][0]
+            osfit = result[1][iy0:(iy0 + raw.shape[0])]
+            np.subtract(raw, osfit[:, np.newaxis], out=out)
+        else:
+            out[:] = raw
+        out *= gains[ia]
+        return result
+
+    def process_amps(self, func, namps, *args):
+        """Call func(ia, *args) for each amp ia
+
+        Amp regions never overlap, so when KcwiConf.NTHREADS > 1 the calls
+        are dispatched to a thread pool (NumPy releases the GIL).  Results
+        are returned in amp order either way, so the output is identical
+        to the serial path.
+        """
+        nthreads = min(self.frame.nthreads(), namps)
+        if nthreads > 1:
+            with ThreadPoolExecutor(max_workers=nthreads) as pool:
+                futures = [pool.submit(func, ia, *args)
+                           for ia in range(namps)]
+                return [f.result() for f in futures]
+        else:
+            return [func(ia, *args) for ia in range(namps)]
+
     def parse_imsec(self, section_key=None):
         if section_key is None:
             return None, None
         else:
-            # forward read?
-            xfor = True
-            yfor = True
-            section = self.frame.header[section_key]
-            p1 = int(section[1:-1].split(',')[0].split(':')[0])
-            p2 = int(section[1:-1].split(',')[0].split(':')[1])
-            p3 = int(section[1:-1].split(',')[1].split(':')[0])
-            p4 = int(section[1:-1].split(',')[1].split(':')[1])
-            # tests for individual axes
-            if p1 > p2:
-                x0 = p2 - 1
-                x1 = p1 - 1
-                xfor = False
-            else:
-                x0 = p1 - 1
-                x1 = p2 - 1
-            if p3 > p4:
-                y0 = p4 - 1
-                y1 = p3 - 1
-                yfor = False
-            else:
-                y0 = p3 - 1
-                y1 = p4 - 1
-            # package output
-            sec = (y0, y1, x0, x1)
-            rfor = (yfor, xfor)
-            # use python axis ordering
-            return sec, rfor
+            # parsed sections are cached by section string
+            return parse_section(self.frame.header[section_key])
 
     def map_ccd(self):
         """Return CCD section variables useful for processing
@@ -261,48 +428,15 @@ class CcdPrimitives(PrimitivesBASE):
             list: (bool) y-direction, x-direction, True if forward, else False
         """
 
-        namps = self.frame.namps()
-        # TODO: check namps
-        # section lists
-        bsec = []
-        dsec = []
-        tsec = []
-        direc = []
-        # loop over amps
-        for i in range(namps):
-            sec, rfor = self.parse_imsec(section_key='BSEC%d' % (i+1))
-            bsec.append(sec)
-            sec, rfor = self.parse_imsec(section_key='DSEC%d' % (i+1))
-            dsec.append(sec)
-            direc.append(rfor)
-            if i == 0:
-                y0 = 0
-                y1 = sec[1] - sec[0]
-                x0 = 0
-                x1 = sec[3] - sec[2]
-            elif i == 1:
-                y0 = 0
-                y1 = sec[1] - sec[0]
-                x0 = tsec[0][3] + 1
-                x1 = x0 + sec[3] - sec[2]
-            elif i == 2:
-                y0 = tsec[0][1] + 1
-                y1 = y0 + sec[1] - sec[0]
-                x0 = 0
-                x1 = sec[3] - sec[2]
-            elif i == 3:
-                y0 = tsec[0][1] + 1
-                y1 = y0 + sec[1] - sec[0]
-                x0 = tsec[0][3] + 1
-                x1 = x0 + sec[3] - sec[2]
-            else:
-                # should not get here
-                y0 = -1
-                y1 = -1
-                x0 = -1
-                x1 = -1
-                self.log.info("ERROR - bad amp number: %d" % i)
-            tsec.append((y0, y1, x0, x1))
-
-        return bsec, dsec, tsec, direc
+        geom = self.ccd_geometry()
+        return list(geom.bsec), list(geom.dsec), list(geom.tsec), \
+            list(geom.direc)
+
+    def ccd_geometry(self):
+        """Return the CcdGeometry of the current (raw) frame
+
+        The geometry is parsed once per readout configuration (CCDCFG,
+        AMPMODE and amp sections) and shared across frames.
+        """
+        return ccd_geometry(self.frame.header)
 
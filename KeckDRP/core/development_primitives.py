@@ -8,11 +8,10 @@ class DevelopmentPrimitives(PrimitivesBASE):
 
     def get_idl_counterpart(self, target_type=None):
         self.log.info("fetching idl counterpart")
-        reference_tab = self.proctab[(self.proctab['OFNAME'] ==
-                                      self.frame.header['OFNAME'])]
-        counterpart_tab = self.proctab[((self.proctab['TYPE'] == target_type)
-                                        & (self.proctab['CID'] ==
-                                           reference_tab[0]['CID']))]
+        reference_tab = self.proctab.select(
+            OFNAME=self.frame.header['OFNAME'])
+        counterpart_tab = self.proctab.select(TYPE=target_type,
+                                              CID=reference_tab[0]['CID'])
 #        os.system('cp IDL_redux/'+counterpart_tab[0]['OFNAME']+'* .')
         return counterpart_tab
 
@@ -1,9 +1,177 @@
 from KeckDRP import PrimitivesBASE
 import KeckDRP
 import os
+import math
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
+from astropy.io import fits
+from astropy.nddata import StdDevUncertainty
+from astropy import nddata
 import ccdproc
 
+from . import stack_accumulator
+from .stack_accumulator import StackAccumulator
+from .calib_cache import CalibCache
+from .master_pool import MasterPool, subtract_in_place
+
+
+def read_tile(hdu, y0, y1):
+    """Read rows y0:y1 of a memory-mapped image HDU as float64
+
+    The HDU must be opened with do_not_scale_image_data=True, so that
+    only the tile is scaled by BSCALE/BZERO, not the whole image.
+    """
+    tile = np.array(hdu.data[y0:y1], dtype=np.float64)
+    bscale = hdu.header.get('BSCALE', 1.)
+    bzero = hdu.header.get('BZERO', 0.)
+    if bscale != 1.:
+        tile *= bscale
+    if bzero != 0.:
+        tile += bzero
+    return tile
+
+
+def combine_tile(tile, method='average', sigma_clip=False, low_thresh=None,
+                 high_thresh=2.0):
+    """Combine a stack of image tiles along the first axis
+
+    Follows ccdproc.combine: an optional single pass of sigma clipping
+    about the mean, using the standard deviation, then an average or a
+    median of the unrejected pixels.  The uncertainty is the standard
+    deviation (average) or 1.4826 x MAD (median), divided by the square
+    root of the number of pixels used.
+
+    Args:
+    -----
+        tile (masked array): (nimages, ny, nx) stack of tiles
+
+    Returns:
+    --------
+        array: combined tile
+        array: uncertainty
+        array: (bool) True where all pixels were rejected
+    """
+    if sigma_clip:
+        baseline = np.ma.mean(tile, axis=0)
+        dev = np.ma.std(tile, axis=0)
+        resid = tile.data - baseline.data
+        if low_thresh is not None:
+            tile.mask |= resid < -low_thresh * dev.data
+        if high_thresh is not None:
+            tile.mask |= resid > high_thresh * dev.data
+    nused = tile.shape[0] - np.ma.getmaskarray(tile).sum(axis=0)
+    if method == 'median':
+        combined = np.ma.median(tile, axis=0)
+        uncertainty = 1.482602218505602 * np.ma.median(
+            np.abs(tile - combined), axis=0)
+    else:
+        combined = np.ma.mean(tile, axis=0)
+        uncertainty = np.ma.std(tile, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        uncertainty = uncertainty / np.sqrt(nused)
+    return np.ma.getdata(combined), np.ma.getdata(uncertainty), nused == 0
+
+
+def combine_rows(file_list, y0, y1, out, tile_rows=256, **kwargs):
+    """Combine rows y0:y1 of the input files into out, tile by tile
+
+    Args:
+    -----
+        file_list (list): input FITS files
+        out (array): (3, ny, nx) output for the combined data, the
+            uncertainty and the mask
+        kwargs: passed to combine_tile
+    """
+    hduls = [fits.open(f, memmap=True, do_not_scale_image_data=True)
+             for f in file_list]
+    try:
+        hdus = [hdul[0] for hdul in hduls]
+        # input masks, if present
+        masks = [hdul['MASK'] if 'MASK' in hdul else None for hdul in hduls]
+        nx = hdus[0].data.shape[1]
+        for t0 in range(y0, y1, tile_rows):
+            t1 = min(t0 + tile_rows, y1)
+            tile = np.ma.masked_array(
+                [read_tile(hdu, t0, t1) for hdu in hdus],
+                mask=np.zeros((len(hdus), t1 - t0, nx), dtype=bool))
+            for i, m in enumerate(masks):
+                if m is not None:
+                    tile.mask[i] = m.data[t0:t1] > 0
+            out[0, t0:t1], out[1, t0:t1], out[2, t0:t1] = combine_tile(
+                tile, **kwargs)
+    finally:
+        for hdul in hduls:
+            hdul.close()
+
+
+def combine_band(file_list, y0, y1, outfile, shape, tile_rows, kwargs):
+    """Process pool worker: combine a band of rows into a shared memmap"""
+    out = np.memmap(outfile, dtype=np.float64, mode='r+', shape=shape)
+    combine_rows(file_list, y0, y1, out, tile_rows=tile_rows, **kwargs)
+    out.flush()
+    del out
+
+
+def stream_combine(file_list, method='average', sigma_clip=False,
+                   low_thresh=None, high_thresh=2.0, tile_rows=256,
+                   unit=None, nprocs=1):
+    """Combine FITS images tile by tile from memory-mapped files
+
+    Only tile_rows rows of every input are in memory at once (per
+    process), so peak memory scales with the tile size times the number
+    of images rather than the image size.  Results are the same as
+    reading all images and calling ccdproc.combine with the same method
+    and clipping.
+
+    With nprocs > 1 the image is split into row bands, which are combined
+    on a process pool into a shared, file-backed output array (in
+    /dev/shm, where available).  Every pixel goes through the same
+    arithmetic, so the output does not depend on nprocs.
+
+    Returns:
+    --------
+        KcwiCCD: combined image with the header of the first input
+    """
+    with fits.open(file_list[0], memmap=True,
+                   do_not_scale_image_data=True) as hdul:
+        header = hdul[0].header.copy()
+        ny, nx = hdul[0].data.shape
+    shape = (3, ny, nx)
+    kwargs = dict(method=method, sigma_clip=sigma_clip,
+                  low_thresh=low_thresh, high_thresh=high_thresh)
+    nprocs = max(1, min(nprocs, int(math.ceil(ny / float(tile_rows)))))
+    if nprocs > 1:
+        shmdir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        fd, outfile = tempfile.mkstemp(suffix='.combine', dir=shmdir)
+        os.close(fd)
+        try:
+            out = np.memmap(outfile, dtype=np.float64, mode='w+', shape=shape)
+            # bands of whole tiles
+            band = int(math.ceil(ny / float(tile_rows) / nprocs)) * tile_rows
+            with ProcessPoolExecutor(max_workers=nprocs) as pool:
+                futures = [pool.submit(combine_band, file_list, y0,
+                                       min(y0 + band, ny), outfile, shape,
+                                       tile_rows, kwargs)
+                           for y0 in range(0, ny, band)]
+                for f in futures:
+                    f.result()
+            out = np.array(out)
+        finally:
+            os.remove(outfile)
+    else:
+        out = np.empty(shape, dtype=np.float64)
+        combine_rows(file_list, 0, ny, out, tile_rows=tile_rows, **kwargs)
+    data, uncertainty, mask = out[0], out[1], out[2] > 0
+    # data are scaled, so scaling keywords no longer apply
+    header.remove('BZERO', ignore_missing=True)
+    header.remove('BSCALE', ignore_missing=True)
+    if unit is None:
+        unit = header.get('BUNIT')
+    return KeckDRP.KcwiCCD(data, unit=unit, meta=header, mask=mask,
+                           uncertainty=StdDevUncertainty(uncertainty))
+
 
 class ImgmathPrimitives(PrimitivesBASE):
 
@@ -27,45 +195,38 @@ class ImgmathPrimitives(PrimitivesBASE):
             else:
                 suffix = '_' + suffix + '.fits'
 
-            # stack images
-            stack = []
-            for f in file_list:
-                infile = os.path.join(prefix, f.split('.')[0] + suffix)
-                self.log.info("reading image: %s" % infile)
-                stack.append(KeckDRP.KcwiCCD.read(infile, unit=unit))
-            # combine biases
-            if 'bias' in combine_type:
-                self.set_frame(ccdproc.combine(stack, method=method,
-                                               sigma_clip=True,
-                                               sigma_clip_low_thresh=None,
-                                               sigma_clip_high_thresh=2.0))
-            # or combine any other type
+            infiles = [os.path.join(prefix, f.split('.')[0] + suffix)
+                       for f in file_list]
+            # sigma clip biases
+            sigma_clip = 'bias' in combine_type
+            tile_rows = KeckDRP.conf.COMBINE_TILE_ROWS
+            nprocs = min(KeckDRP.conf.COMBINE_NPROCS, os.cpu_count() or 1)
+            if tile_rows > 0:
+                # stream images from disk in row tiles
+                for infile in infiles:
+                    self.log.info("streaming image: %s" % infile)
+                self.set_frame(stream_combine(infiles, method=method,
+                                              sigma_clip=sigma_clip,
+                                              low_thresh=None,
+                                              high_thresh=2.0,
+                                              tile_rows=tile_rows,
+                                              unit=unit, nprocs=nprocs))
             else:
-                self.set_frame(ccdproc.combine(stack, method=method))
-            self.frame.header['NSTACK'] = (len(stack),
-                                           self.keyword_comments['NSTACK'])
-            self.frame.header['STCKMETH'] = (method,
-                                             self.keyword_comments['STCKMETH'])
-            # handle missing CCDCFG
-            if 'CCDCFG' not in self.frame.header:
-                ccdcfg = self.frame.header['CCDSUM'].replace(" ", "")
-                ccdcfg += "%1d" % self.frame.header['CCDMODE']
-                ccdcfg += "%02d" % self.frame.header['GAINMUL']
-                ccdcfg += "%02d" % self.frame.header['AMPMNUM']
-                self.frame.header['CCDCFG'] = ccdcfg
-            # do we log list in header?
-            if keylog is not None:
-                # make a list of image numbers string
-                image_numbers_string = ','.join(str(e) for e in image_numbers)
-                card = (image_numbers_string, '')
-                # was a keyword comment provided?
-                if keylog is not None:
-                    if keylog in self.keyword_comments:
-                        card = (image_numbers_string,
-                                self.keyword_comments[keylog])
-                    else:
-                        card = (image_numbers_string, '')
-                self.frame.header[keylog] = card
+                # stack images
+                stack = []
+                for infile in infiles:
+                    self.log.info("reading image: %s" % infile)
+                    stack.append(KeckDRP.KcwiCCD.read(infile, unit=unit))
+                # combine biases
+                if sigma_clip:
+                    self.set_frame(ccdproc.combine(
+                        stack, method=method, sigma_clip=True,
+                        sigma_clip_low_thresh=None,
+                        sigma_clip_high_thresh=2.0))
+                # or combine any other type
+                else:
+                    self.set_frame(ccdproc.combine(stack, method=method))
+            self.record_stack(len(infiles), method, image_numbers, keylog)
             log_string = self.image_combine.__module__ + "." + \
                          self.image_combine.__qualname__
             self.frame.header['HISTORY'] = log_string
@@ -74,6 +235,156 @@ class ImgmathPrimitives(PrimitivesBASE):
         else:
             self.log.error("something went wrong with image_combine")
 
+    def record_stack(self, nstack, method, image_numbers, keylog=None):
+        """Record stacking keywords in the header of a combined frame"""
+        self.frame.header['NSTACK'] = (nstack,
+                                       self.keyword_comments['NSTACK'])
+        self.frame.header['STCKMETH'] = (method,
+                                         self.keyword_comments['STCKMETH'])
+        # handle missing CCDCFG
+        if 'CCDCFG' not in self.frame.header:
+            ccdcfg = self.frame.header['CCDSUM'].replace(" ", "")
+            ccdcfg += "%1d" % self.frame.header['CCDMODE']
+            ccdcfg += "%02d" % self.frame.header['GAINMUL']
+            ccdcfg += "%02d" % self.frame.header['AMPMNUM']
+            self.frame.header['CCDCFG'] = ccdcfg
+        # do we log list in header?
+        if keylog is not None:
+            # make a list of image numbers string
+            image_numbers_string = ','.join(str(e) for e in image_numbers)
+            card = (image_numbers_string, '')
+            # was a keyword comment provided?
+            if keylog is not None:
+                if keylog in self.keyword_comments:
+                    card = (image_numbers_string,
+                            self.keyword_comments[keylog])
+                else:
+                    card = (image_numbers_string, '')
+            self.frame.header[keylog] = card
+
+    def image_accumulate(self, tab=None, combine_type='bias',
+                         in_directory=None, suffix=None, unit='adu',
+                         keylog=None, topk=2, exact=False, finalize=False):
+        """Average stack kept up to date one frame at a time
+
+        Like image_combine with method='average', but the running state
+        of the stack is kept between calls, so only frames not yet
+        accumulated are read.  Biases are sigma clipped as in
+        image_combine (values exactly at the threshold are kept); see
+        StackAccumulator for when the clipping is exact.
+
+        Args:
+        -----
+            topk (int): number of largest values kept per pixel for clipping
+            exact (bool): when finalizing, restack from disk where the
+                clipping can not be guaranteed exact, rather than accept
+                an approximation
+            finalize (bool): no more frames will join the stack; save its
+                state to REDUXDIR
+        """
+        if tab is None:
+            self.log.error("something went wrong with image_accumulate")
+            return
+        file_list = tab['OFNAME']
+        image_numbers = [int(f) for f in tab['FRAMENO']]
+
+        if in_directory is None:
+            prefix = '.'
+        else:
+            prefix = in_directory
+
+        if suffix is None:
+            suff = '.fits'
+        else:
+            suff = '_' + suffix + '.fits'
+
+        # running state for this stack, named after its first frame
+        accfile = os.path.join(KeckDRP.conf.REDUXDIR,
+                               file_list[0].split('.')[0] + '_' +
+                               combine_type + '_stack.npz')
+        path = (os.path.abspath(accfile), os.getpid())
+        acc = stack_accumulator.open_stacks.get(path)
+        if acc is None and os.path.exists(accfile):
+            acc = StackAccumulator.load(accfile)
+        # start again if frames left the stack or the buffer changed
+        if acc is not None and (not set(acc.framenos) <= set(image_numbers)
+                                or acc.topk != topk):
+            self.log.info("restarting stack: %s" % accfile)
+            acc = None
+        if acc is None:
+            acc = StackAccumulator(topk=topk)
+        stack_accumulator.open_stacks[path] = acc
+        # add new frames
+        self.accumulate_frames(acc, file_list, image_numbers, prefix, suff,
+                               unit)
+        # sigma clip biases
+        high_thresh = 2.0 if 'bias' in combine_type else None
+        data, uncertainty, inexact = acc.combine(high_thresh=high_thresh)
+        if inexact.any():
+            self.log.warning("clipping of %d pixels may be inexact with "
+                             "%d frames" % (inexact.sum(), acc.n))
+            if finalize and exact:
+                # a buffer of n / (1 + t^2) values always holds every reject
+                self.log.info("restacking from disk")
+                full = StackAccumulator(
+                    topk=acc.n // int(1 + high_thresh ** 2))
+                self.accumulate_frames(full, file_list, image_numbers,
+                                       prefix, suff, unit)
+                data, uncertainty, inexact = full.combine(
+                    high_thresh=high_thresh)
+        if finalize:
+            acc.save(accfile)
+        self.set_frame(KeckDRP.KcwiCCD(
+            data, unit=acc.unit, meta=acc.header,
+            mask=np.zeros(data.shape, dtype=bool),
+            uncertainty=StdDevUncertainty(uncertainty)))
+        self.record_stack(acc.n, 'average', image_numbers, keylog)
+        log_string = self.image_accumulate.__module__ + "." + \
+            self.image_accumulate.__qualname__
+        self.frame.header['HISTORY'] = log_string
+        self.log.info("%s %s using average of %d" % (
+            self.image_accumulate.__name__, combine_type, acc.n))
+
+    def accumulate_frames(self, acc, file_list, image_numbers, prefix, suffix,
+                          unit):
+        """Read and add to acc the frames it does not hold yet"""
+        for f, frameno in zip(file_list, image_numbers):
+            if frameno not in acc.framenos:
+                infile = os.path.join(prefix, f.split('.')[0] + suffix)
+                self.log.info("accumulating image: %s" % infile)
+                ccd = KeckDRP.KcwiCCD.read(infile, unit=unit)
+                acc.add(ccd.data, frameno, header=ccd.header, unit=ccd.unit)
+
+    def read_calib_image(self, infile, unit='adu'):
+        """Read a calibration image through the calibration cache
+
+        The data, uncertainty, mask and header are cached, so a master
+        frame read before, by this process or an earlier one, is not
+        parsed again.
+        """
+        cache = CalibCache.open()
+        key = cache.key('image', [infile], unit=unit)
+        value = cache.get(key)
+        if value is None:
+            ccd = KeckDRP.KcwiCCD.read(infile, unit=unit)
+            value = {'data': ccd.data, 'header': ccd.header.tostring()}
+            if ccd.uncertainty is not None:
+                value['uncertainty'] = ccd.uncertainty.array
+                value['uncertainty_type'] = type(ccd.uncertainty).__name__
+            if ccd.mask is not None:
+                value['mask'] = ccd.mask
+            cache.put(key, value)
+        else:
+            self.log.info("calibration cache hit: %s" % infile)
+        uncertainty = None
+        if 'uncertainty' in value:
+            uncertainty = getattr(nddata, value['uncertainty_type'])(
+                value['uncertainty'], copy=False)
+        return KeckDRP.KcwiCCD(value['data'], unit=unit,
+                               uncertainty=uncertainty,
+                               mask=value.get('mask'),
+                               header=fits.Header.fromstring(value['header']))
+
     def img_subtract(self, tab=None, indir=None, suffix=None, unit='adu',
                      keylog=None):
         if tab is not None:
@@ -91,19 +402,21 @@ class ImgmathPrimitives(PrimitivesBASE):
 
             infile = os.path.join(pref, flist[0].split('.')[0] + suff)
             if os.path.exists(infile):
-                self.log.info("reading image to subtract: %s" % infile)
-                subtrahend = KeckDRP.KcwiCCD.read(infile, unit=unit)
+                # masters stay loaded until rewritten or re-registered
+                master = MasterPool.open().get(
+                    infile, self.read_calib_image, unit=unit,
+                    entry=tuple(str(v) for v in tab[0]))
+                subtrahend = master['ccd']
+                self.log.info("subtracting image: %s" % infile)
                 # get readnoise from master bias
-                if 'master_bias' in infile:
-                    bias_rn = []
-                    namps = subtrahend.header['NVIDINP']
-                    for ia in range(namps):
-                        bias_rn.append(subtrahend.header['BIASRN%d' % (ia + 1)])
-                    self.readnoise = bias_rn
-
-                result = self.frame.subtract(subtrahend,
-                                             handle_meta="first_found")
-                self.set_frame(result)
+                if 'master_bias' in infile and \
+                        master['readnoise'] is not None:
+                    self.readnoise = list(master['readnoise'])
+
+                if not subtract_in_place(self.frame, subtrahend):
+                    result = self.frame.subtract(subtrahend,
+                                                 handle_meta="first_found")
+                    self.set_frame(result)
                 if keylog is not None:
                     if keylog in self.keyword_comments:
                         card = (infile, self.keyword_comments[keylog])
@@ -0,0 +1,131 @@
+"""Process-wide pool of master calibration frames
+
+Every science frame subtracts the same master bias and master dark, so
+the masters read by img_subtract are kept in memory for the life of the
+process, with the readnoise derived from their headers.  A master is
+read again when its file is rewritten (modification time or size) or
+when its proc table entry changes, and the least recently used masters
+are dropped once the pool holds more than MASTER_POOL_MB.
+"""
+import collections
+import os
+
+import numpy as np
+from astropy.nddata import StdDevUncertainty, VarianceUncertainty
+
+# pools opened in this process, by process id
+open_pools = {}
+
+
+def master_readnoise(header):
+    """Readnoise of each amplifier recorded in a master bias header"""
+    if 'NVIDINP' not in header or 'BIASRN1' not in header:
+        return None
+    return [header['BIASRN%d' % (ia + 1)]
+            for ia in range(header['NVIDINP'])]
+
+
+def subtract_in_place(frame, master):
+    """Subtract master from frame, modifying the frame's arrays
+
+    Gives the data, uncertainty and mask CCDData.subtract would, without
+    allocating a new frame.
+
+    Returns:
+    --------
+        bool: False, and frame untouched, if the units or the uncertainty
+            types differ, so the subtraction has to go through
+            CCDData.subtract
+    """
+    if frame.unit != master.unit:
+        return False
+    unc = frame.uncertainty
+    munc = master.uncertainty
+    if unc is not None and munc is not None and \
+            (type(unc) is not type(munc) or
+             not isinstance(unc, (StdDevUncertainty, VarianceUncertainty))):
+        return False
+    dtype = np.result_type(frame.data, master.data)
+    if frame.data.dtype != dtype or not frame.data.flags.writeable:
+        frame.data = frame.data.astype(dtype)
+    frame.data -= master.data
+    if munc is not None:
+        if unc is None:
+            frame.uncertainty = type(munc)(munc.array.copy())
+        elif isinstance(unc, StdDevUncertainty):
+            np.hypot(unc.array, munc.array, out=unc.array)
+        else:
+            unc.array += munc.array
+    if master.mask is not None:
+        if frame.mask is None:
+            frame.mask = master.mask.copy()
+        else:
+            frame.mask |= master.mask
+    return True
+
+
+class MasterPool(object):
+
+    def __init__(self, max_mb=1024.):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        # path: master, least recently used first
+        self.masters = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.loads = 0
+
+    @classmethod
+    def open(cls):
+        """Return the pool of this process, sized by MASTER_POOL_MB"""
+        import KeckDRP
+        pool = open_pools.get(os.getpid())
+        if pool is None:
+            pool = cls(max_mb=KeckDRP.conf.MASTER_POOL_MB)
+            open_pools[os.getpid()] = pool
+        return pool
+
+    def get(self, path, read, unit='adu', entry=None):
+        """Master frame for path, read with read(path, unit) if needed
+
+        Args:
+        -----
+            entry (tuple): proc table row of the master; the master is
+                read again if it differs from the one it was read with
+
+        Returns:
+        --------
+            dict: ccd, the master KcwiCCD, and readnoise, from its header
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size, str(unit), entry)
+        master = self.masters.get(path)
+        if master is not None and master['stamp'] == stamp:
+            self.masters.move_to_end(path)
+            self.hits += 1
+            return master
+        self.discard(path)
+        ccd = read(path, unit)
+        master = {'stamp': stamp, 'ccd': ccd,
+                  'readnoise': master_readnoise(ccd.header),
+                  'nbytes': sum(a.nbytes for a in (
+                      ccd.data, ccd.mask,
+                      None if ccd.uncertainty is None
+                      else ccd.uncertainty.array) if a is not None)}
+        self.loads += 1
+        if master['nbytes'] <= self.max_bytes:
+            self.masters[path] = master
+            self.nbytes += master['nbytes']
+            while self.nbytes > self.max_bytes:
+                self.nbytes -= self.masters.popitem(last=False)[1]['nbytes']
+        return master
+
+    def discard(self, path):
+        """Drop the master read from path, if there is one"""
+        master = self.masters.pop(os.path.abspath(path), None)
+        if master is not None:
+            self.nbytes -= master['nbytes']
+
+    def clear(self):
+        self.masters.clear()
+        self.nbytes = 0
@@ -0,0 +1,556 @@
+"""Indexed, in-memory proc table with an append-only journal
+
+The proc table records every frame the pipeline has processed, one row
+per (CID, FRAMENO, STAGE), the last write for a key winning.  ProcTable
+keeps the rows in memory with hash indexes on the columns the recipes
+query, so appends and lookups do not scale with the size of the table.
+Every append is also written as one JSON line to a journal next to the
+table file (kcwi.proc.jnl), which is replayed incrementally when the
+journal grows.  Appends and compactions hold an exclusive lock on
+kcwi.proc.jnl.lock, and replay the journal first, so rows written by
+another process are never lost.  A compacted journal starts with a
+header line holding a new generation id, from which readers tell that
+the file was rewritten and replay it from the start.  The fixed-width
+kcwi.proc file is only an export.
+
+SqliteProcTable offers the same interface backed by an SQLite database
+(kcwi.proc.db) in WAL mode, so that several reduction processes can
+safely share one proc table.
+"""
+import contextlib
+import fcntl
+import json
+import os
+import sqlite3
+import tempfile
+import uuid
+
+import numpy as np
+from astropy.table import Table
+
+COLUMNS = ('FRAMENO', 'CID', 'DID', 'TYPE', 'GRPID', 'TTIME', 'CAM', 'IFU',
+           'GRAT', 'GANG', 'CWAVE', 'BIN', 'FILT', 'MJD', 'STAGE', 'SUFF',
+           'OFNAME', 'TARGNAME')
+DTYPES = ('int32', 'S24', 'int64', 'S9', 'S12', 'float64', 'S4', 'S6', 'S5',
+          'float64', 'float64', 'S4', 'S5', 'float64', 'int32', 'S5', 'S25',
+          'S25')
+FORMATS = {'GANG': '7.2f', 'CWAVE': '8.2f', 'MJD': '15.6f'}
+# unique key of a row
+KEY = ('CID', 'FRAMENO', 'STAGE')
+# indexed column groups
+INDEXES = (('CAM', 'TYPE'), ('DID',), ('CID',), ('GRPID',), ('FRAMENO',))
+
+COLUMN = dict((name, i) for i, name in enumerate(COLUMNS))
+
+# tables opened in this process, by journal or database path
+open_tables = {}
+
+
+def convert(value, dtype):
+    """Convert a proc table value to the python type of its column"""
+    if dtype.startswith('int'):
+        return int(value)
+    elif dtype.startswith('float'):
+        return float(value)
+    elif isinstance(value, bytes):
+        return value.decode()
+    else:
+        return str(value)
+
+
+def sqltype(dtype):
+    """SQLite column type for a proc table column type"""
+    if dtype.startswith('int'):
+        return 'INTEGER'
+    elif dtype.startswith('float'):
+        return 'REAL'
+    else:
+        return 'TEXT'
+
+
+def journal_generation(line):
+    """Generation id of a journal, from its first line, or None for a
+    journal that was never compacted"""
+    if line.startswith(b'{') and line.endswith(b'\n'):
+        return json.loads(line.decode())['generation']
+    return None
+
+
+@contextlib.contextmanager
+def locked(path):
+    """Hold an exclusive lock on path, created if needed"""
+    with open(path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def write_ascii(tab, tfil):
+    """Write a proc table in the fixed-width format, replacing tfil
+    atomically, so readers never see a partly written file"""
+    fd, tmp = tempfile.mkstemp(suffix='.tmp',
+                               dir=os.path.dirname(os.path.abspath(tfil)))
+    os.close(fd)
+    try:
+        tab.write(tmp, format='ascii.fixed_width', overwrite=True)
+        os.replace(tmp, tfil)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def empty_table():
+    """Proc table with no rows, string columns as objects"""
+    tab = Table(names=COLUMNS, dtype=DTYPES,
+                meta={'KCWI DRP PROC TABLE': 'new table'})
+    # prevent string column truncation
+    for col in tab.itercols():
+        if col.dtype.kind in 'SU':
+            tab.replace_column(col.name, col.astype('object'))
+    return tab
+
+
+class ProcTable(object):
+    """Proc table rows with hash indexes and an append-only journal
+
+    Args:
+    -----
+        tfil (str): fixed-width table file, or None for a table that is
+            only kept in memory
+    """
+
+    def __init__(self, tfil=None):
+        self.tfil = tfil
+        self.journal = None if tfil is None else tfil + '.jnl'
+        self.rows = {}
+        self.keys = {}
+        self.index = dict((cols, {}) for cols in INDEXES)
+        self.nextid = 0
+        self.offset = 0         # bytes of journal replayed or written
+        self.nlines = 0         # lines in journal
+        self.generation = None  # id of the journal, changed by compact()
+        self.cache = None       # sorted astropy Table of all rows
+        self.groups = {}        # sorted Tables of rows, by select criteria
+        self.sorted_keys = {}   # (keys, FRAMENO) by select criteria, column
+        self.dirty = False      # changed since last export
+
+    @classmethod
+    def open(cls, tfil='kcwi.proc'):
+        """Return the proc table for tfil, shared within the process
+
+        A table already open is brought up to date with the journal;
+        otherwise the journal is replayed or, if there is none yet, the
+        fixed-width file is imported.
+        """
+        path = os.path.abspath(tfil + '.jnl')
+        ptab = open_tables.get(path)
+        if ptab is None:
+            ptab = cls(tfil)
+            if not os.path.isfile(ptab.journal) and os.path.isfile(tfil):
+                ptab.import_ascii(tfil)
+            open_tables[path] = ptab
+        ptab.refresh()
+        return ptab
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add_row(self, row, journal=True):
+        """Add a row, replacing any row with the same (CID, FRAMENO, STAGE)
+        """
+        if journal and self.journal is not None:
+            with locked(self.journal + '.lock'):
+                # pick up rows written by others first
+                self.refresh()
+                row = self.insert(row)
+                with open(self.journal, 'a') as jnl:
+                    jnl.write(json.dumps(row) + '\n')
+                    self.offset = jnl.tell()
+                self.nlines += 1
+        else:
+            self.insert(row)
+
+    def insert(self, row):
+        """Add a row to the table and its indexes, returning it converted
+        """
+        row = tuple(convert(v, d) for v, d in zip(row, DTYPES))
+        key = tuple(row[COLUMN[c]] for c in KEY)
+        if key in self.keys:
+            self.remove(self.keys[key])
+        rowid = self.nextid
+        self.nextid += 1
+        self.rows[rowid] = row
+        self.keys[key] = rowid
+        for cols, index in self.index.items():
+            index.setdefault(tuple(row[COLUMN[c]] for c in cols),
+                             set()).add(rowid)
+        self.cache = None
+        self.groups = {}
+        self.sorted_keys = {}
+        self.dirty = True
+        return row
+
+    def remove(self, rowid):
+        """Drop a row from the table and its indexes"""
+        row = self.rows.pop(rowid)
+        for cols, index in self.index.items():
+            ikey = tuple(row[COLUMN[c]] for c in cols)
+            index[ikey].discard(rowid)
+            if not index[ikey]:
+                del index[ikey]
+
+    def select(self, **criteria):
+        """Rows matching all criteria, as a Table sorted by FRAMENO
+
+        Criteria are column=value pairs.  Indexed columns are looked up
+        in their hash index, starting with the most selective; any other
+        columns are then checked row by row on the candidates.  Results
+        are kept until the table changes, and a copy returned.
+        """
+        return self.group(criteria)[1].copy()
+
+    def nearest(self, value, column='FRAMENO', **criteria):
+        """Rows of the frame nearest to value in column, among the rows
+        matching all criteria; see nearest_rows()
+
+        The sorted column of each selection is kept until the table
+        changes, so only a binary search is done per call.
+        """
+        group, tab = self.group(criteria)
+        if len(tab) < 2:
+            return tab.copy()
+        if (group, column) not in self.sorted_keys:
+            self.sorted_keys[(group, column)] = sort_keys(tab, column)
+        frameno = nearest_frame(*self.sorted_keys[(group, column)],
+                                value=value)
+        # the rows of a frame are contiguous
+        framenos = np.asarray(tab['FRAMENO'])
+        lo, hi = np.searchsorted(framenos, frameno, side='left'), \
+            np.searchsorted(framenos, frameno, side='right')
+        return tab[lo:hi].copy()
+
+    def group(self, criteria):
+        """Key and cached Table of the rows matching criteria, not to be
+        modified"""
+        # nothing equals None
+        if any(value is None for value in criteria.values()):
+            return None, self.to_table([])
+        group = tuple(sorted(criteria.items()))
+        if group not in self.groups:
+            self.groups[group] = self.find(criteria)
+        return group, self.groups[group]
+
+    def find(self, criteria):
+        """Sorted Table of the rows matching a dict of criteria"""
+        rest = dict(criteria)
+        matches = []
+        for cols in INDEXES:
+            if all(c in rest for c in cols):
+                ikey = tuple(convert(rest.pop(c), DTYPES[COLUMN[c]])
+                             for c in cols)
+                matches.append(self.index[cols].get(ikey, set()))
+        if matches:
+            matches.sort(key=len)
+            candidates = set(matches[0])
+            for rowids in matches[1:]:
+                candidates &= rowids
+        else:
+            candidates = self.rows.keys()
+        rows = [self.rows[r] for r in candidates]
+        for col, value in rest.items():
+            i = COLUMN[col]
+            value = convert(value, DTYPES[i])
+            rows = [row for row in rows if row[i] == value]
+        return self.to_table(rows)
+
+    def table(self):
+        """All rows as a Table sorted by FRAMENO"""
+        if self.cache is None:
+            self.cache = self.to_table(self.rows.values())
+        return self.cache
+
+    @staticmethod
+    def to_table(rows):
+        """Astropy Table of rows, sorted by FRAMENO, CID and STAGE"""
+        rows = sorted(rows, key=lambda row: (row[COLUMN['FRAMENO']],
+                                             row[COLUMN['CID']],
+                                             row[COLUMN['STAGE']]))
+        if rows:
+            columns = []
+            for dtype, values in zip(DTYPES, zip(*rows)):
+                if dtype.startswith('S'):
+                    # prevent string column truncation
+                    column = np.empty(len(values), dtype=object)
+                    column[:] = values
+                else:
+                    column = np.array(values, dtype=dtype)
+                columns.append(column)
+            tab = Table(columns, names=COLUMNS,
+                        meta={'KCWI DRP PROC TABLE': 'new table'})
+        else:
+            tab = empty_table()
+        for name, fmt in FORMATS.items():
+            tab[name].format = fmt
+        return tab
+
+    def refresh(self):
+        """Replay journal lines appended since the last read or write"""
+        if self.journal is None or not os.path.isfile(self.journal):
+            return
+        with open(self.journal, 'rb') as jnl:
+            generation = journal_generation(jnl.readline())
+            if generation != self.generation:
+                # journal was compacted: start again
+                self.__init__(self.tfil)
+                self.generation = generation
+            jnl.seek(self.offset)
+            for line in jnl:
+                # ignore a partly written last line
+                if not line.endswith(b'\n'):
+                    break
+                if self.offset > 0 or journal_generation(line) is None:
+                    self.insert(json.loads(line.decode()))
+                    self.nlines += 1
+                self.offset += len(line)
+
+    def compact(self):
+        """Rewrite the journal with only the current rows, under a new
+        generation id"""
+        if self.journal is None:
+            return
+        with locked(self.journal + '.lock'):
+            # keep rows written by others
+            self.refresh()
+            generation = uuid.uuid4().hex
+            tmp = self.journal + '.tmp'
+            with open(tmp, 'w') as jnl:
+                jnl.write(json.dumps({'generation': generation}) + '\n')
+                for row in self.table().iterrows():
+                    jnl.write(json.dumps([convert(v, d) for v, d in
+                                          zip(row, DTYPES)]) + '\n')
+                offset = jnl.tell()
+            os.replace(tmp, self.journal)
+            self.offset = offset
+            self.nlines = len(self.rows)
+            self.generation = generation
+
+    def attach(self, tfil):
+        """Start journaling an in-memory table to tfil"""
+        self.tfil = tfil
+        self.journal = tfil + '.jnl'
+        self.compact()
+        open_tables[os.path.abspath(self.journal)] = self
+
+    def save(self, tfil):
+        """Make sure the table is journaled to tfil, compacting if needed"""
+        if self.tfil != tfil:
+            self.attach(tfil)
+        # drop superseded rows from the journal
+        if self.nlines > 2 * len(self) + 100:
+            self.compact()
+
+    def import_ascii(self, tfil):
+        """Add the rows of a fixed-width proc table file"""
+        tab = Table.read(tfil, format='ascii.fixed_width')
+        for row in tab:
+            self.add_row([row[c] for c in COLUMNS])
+
+    def export(self, tfil=None):
+        """Write the table in the fixed-width format, if it has changed"""
+        if tfil is None:
+            tfil = self.tfil
+        if self.dirty or not os.path.isfile(tfil):
+            write_ascii(self.table(), tfil)
+            self.dirty = False
+
+
+class SqliteProcTable(object):
+    """Proc table stored in an SQLite database
+
+    Same interface as ProcTable.  The database uses WAL mode, so readers
+    never block the writer, and every update is a transaction, so several
+    processes can share a table.  Rows are unique on (CID, FRAMENO,
+    STAGE), the last write winning, and the columns queried by the
+    recipes are indexed.
+
+    Args:
+    -----
+        tfil (str): fixed-width table file, next to which the database
+            is kept, or None for a table that is only kept in memory
+    """
+    def __init__(self, tfil=None):
+        self.tfil = tfil
+        self.db = ':memory:' if tfil is None else tfil + '.db'
+        self.conn = sqlite3.connect(self.db, timeout=60.)
+        if tfil is not None:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+        self.exported = None    # table version at last export
+        self.create()
+
+    @classmethod
+    def open(cls, tfil='kcwi.proc'):
+        """Return the proc table for tfil, shared within the process
+
+        A new database is filled from the fixed-width file, if there is
+        one.
+        """
+        path = (os.path.abspath(tfil + '.db'), os.getpid())
+        ptab = open_tables.get(path)
+        if ptab is None:
+            new = not os.path.isfile(tfil + '.db')
+            ptab = cls(tfil)
+            if new and os.path.isfile(tfil):
+                ptab.import_ascii(tfil)
+            open_tables[path] = ptab
+        return ptab
+
+    def create(self):
+        """Create the proc table and its indexes, if they do not exist"""
+        columns = ', '.join('%s %s' % (name, sqltype(dtype))
+                            for name, dtype in zip(COLUMNS, DTYPES))
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS proctab '
+                              '(%s, UNIQUE (%s) ON CONFLICT REPLACE)' %
+                              (columns, ', '.join(KEY)))
+            for cols in INDEXES:
+                self.conn.execute('CREATE INDEX IF NOT EXISTS idx_%s ON '
+                                  'proctab (%s)' % ('_'.join(cols),
+                                                    ', '.join(cols)))
+
+    def __len__(self):
+        return self.conn.execute('SELECT count(*) FROM proctab').fetchone()[0]
+
+    def add_row(self, row):
+        """Add a row, replacing any row with the same (CID, FRAMENO, STAGE)
+        """
+        self.add_rows([row])
+
+    def add_rows(self, rows):
+        """Add rows in a single transaction"""
+        rows = [tuple(convert(v, d) for v, d in zip(row, DTYPES))
+                for row in rows]
+        with self.conn:
+            self.conn.executemany('INSERT INTO proctab VALUES (%s)' %
+                                  ', '.join('?' * len(COLUMNS)), rows)
+
+    def select(self, **criteria):
+        """Rows matching all criteria, as a Table sorted by FRAMENO"""
+        # nothing equals None
+        if any(value is None for value in criteria.values()):
+            return ProcTable.to_table([])
+        names = sorted(criteria)
+        values = [convert(criteria[c], DTYPES[COLUMN[c]]) for c in names]
+        where = ' AND '.join('%s = ?' % c for c in names)
+        return ProcTable.to_table(self.conn.execute(
+            'SELECT * FROM proctab' + (' WHERE ' + where if where else ''),
+            values).fetchall())
+
+    def nearest(self, value, column='FRAMENO', **criteria):
+        """Rows of the frame nearest to value in column, among the rows
+        matching all criteria; see nearest_rows()"""
+        return nearest_rows(self.select(**criteria), value, column=column)
+
+    def table(self):
+        """All rows as a Table sorted by FRAMENO"""
+        return self.select()
+
+    def refresh(self):
+        """Nothing to do: queries always see committed rows"""
+        pass
+
+    def version(self):
+        """Changes with every write, from any process"""
+        return self.conn.execute(
+            'SELECT count(*), max(rowid) FROM proctab').fetchone()
+
+    def save(self, tfil):
+        """Make sure the table is stored in the database for tfil"""
+        if self.tfil != tfil:
+            # copy an in-memory table to the database
+            rows = self.conn.execute('SELECT * FROM proctab').fetchall()
+            self.__init__(tfil)
+            self.add_rows(rows)
+            open_tables[(os.path.abspath(self.db), os.getpid())] = self
+
+    def import_ascii(self, tfil):
+        """Add the rows of a fixed-width proc table file"""
+        tab = Table.read(tfil, format='ascii.fixed_width')
+        self.add_rows([[row[c] for c in COLUMNS] for row in tab])
+
+    def export(self, tfil=None):
+        """Write the table in the fixed-width format, if it has changed"""
+        if tfil is None:
+            tfil = self.tfil
+        version = self.version()
+        if version != self.exported or not os.path.isfile(tfil):
+            write_ascii(self.table(), tfil)
+            self.exported = version
+
+
+def sort_keys(tab, column):
+    """Values of column in tab, sorted, and the FRAMENO of each
+
+    tab must be sorted by FRAMENO, which then increases among equal
+    values.
+    """
+    keys = np.asarray(tab[column], dtype=np.float64)
+    order = np.argsort(keys, kind='mergesort')
+    return keys[order], np.asarray(tab['FRAMENO'])[order]
+
+
+def nearest_frame(keys, framenos, value):
+    """FRAMENO of the frame nearest to value, from sort_keys()
+
+    Binary search on the sorted keys.  Ties go to the lower FRAMENO.
+    """
+    i = np.searchsorted(keys, value)
+    # nearest of the values either side of the insertion point, each
+    # at its first occurrence, which has the lowest frame number
+    near = [np.searchsorted(keys, keys[j]) for j in (i - 1, i)
+            if 0 <= j < len(keys)]
+    best = min(near, key=lambda j: (abs(keys[j] - value), framenos[j]))
+    return framenos[best]
+
+
+def nearest_rows(tab, value, column='FRAMENO'):
+    """Rows of tab for the frame nearest to value in column
+
+    Binary search on the sorted column.  Ties go to the lower FRAMENO,
+    and all rows (stages) of the chosen frame are returned.
+
+    Args:
+    -----
+        tab (Table): proc table rows, sorted by FRAMENO
+        value (float): FRAMENO or MJD of the target frame
+        column (str): 'FRAMENO' or 'MJD'
+
+    Returns:
+    --------
+        Table: rows of the nearest frame (a copy of tab if it has < 2
+            rows)
+    """
+    if len(tab) < 2:
+        return tab.copy()
+    frameno = nearest_frame(*sort_keys(tab, column), value=value)
+    return tab[np.asarray(tab['FRAMENO']) == frameno]
+
+
+def open_proctab(tfil='kcwi.proc', backend='journal'):
+    """Open the proc table for tfil with the given storage backend
+
+    Args:
+    -----
+        backend (str): 'journal' (ProcTable) or 'sqlite' (SqliteProcTable)
+    """
+    if backend == 'sqlite':
+        return SqliteProcTable.open(tfil)
+    return ProcTable.open(tfil)
+
+
+def new_proctab(backend='journal'):
+    """Empty in-memory proc table with the given storage backend"""
+    if backend == 'sqlite':
+        return SqliteProcTable()
+    return ProcTable()
@@ -1,6 +1,6 @@
 from KeckDRP import PrimitivesBASE
-from astropy.table import Table, unique
-import os
+import KeckDRP
+from .proctab import open_proctab, new_proctab
 
 
 class ProctabPrimitives(PrimitivesBASE):
@@ -10,51 +10,24 @@ class ProctabPrimitives(PrimitivesBASE):
         super(ProctabPrimitives, self).__init__()
 
     def new_proctab(self):
-        cnames = ('FRAMENO', 'CID', 'DID', 'TYPE', 'GRPID', 'TTIME', 'CAM',
-                  'IFU', 'GRAT', 'GANG', 'CWAVE', 'BIN', 'FILT', 'MJD',
-                  'STAGE', 'SUFF', 'OFNAME', 'TARGNAME')
-        dtypes = ('int32', 'S24', 'int64', 'S9', 'S12', 'float64', 'S4',
-                  'S6', 'S5', 'float64', 'float64', 'S4', 'S5', 'float64',
-                  'int32', 'S5', 'S25', 'S25')
-        meta = {'KCWI DRP PROC TABLE': 'new table'}
-        self.proctab = Table(names=cnames, dtype=dtypes, meta=meta)
-        # prevent string column truncation
-        for col in self.proctab.itercols():
-            if col.dtype.kind in 'SU':
-                self.proctab.replace_column(col.name, col.astype('object'))
+        self.proctab = new_proctab(backend=KeckDRP.conf.PROCTAB_BACKEND)
 
     def read_proctab(self, tfil='kcwi.proc'):
-        if os.path.isfile(tfil):
-            self.log.info("reading proc table file: %s" % tfil)
-            self.proctab = Table.read(tfil, format='ascii.fixed_width')
-            self.proctab.dtypes = ('int32', 'S24', 'int64', 'S9', 'S12',
-                                   'float64', 'S4', 'S6', 'S5', 'float64',
-                                   'float64', 'S4', 'S5', 'float64', 'int32',
-                                   'S5', 'S25', 'S25')
-        else:
-            self.log.info("proc table file not found: %s" % tfil)
-            self.new_proctab()
+        # tables stay open for the process, so only new journal entries
+        # need reading
+        self.log.info("reading proc table file: %s" % tfil)
+        self.proctab = open_proctab(tfil,
+                                    backend=KeckDRP.conf.PROCTAB_BACKEND)
         if len(self.proctab) == 0:
-            self.new_proctab()
-        # format columns
-        self.proctab['GANG'].format = '7.2f'
-        self.proctab['CWAVE'].format = '8.2f'
-        self.proctab['MJD'].format = '15.6f'
-        # prevent string column truncation
-        for col in self.proctab.itercols():
-            if col.dtype.kind in 'SU':
-                self.proctab.replace_column(col.name, col.astype('object'))
+            self.log.info("proc table is empty: %s" % tfil)
 
     def write_proctab(self, tfil='kcwi.proc'):
         if self.proctab is not None:
-            if os.path.isfile(tfil):
-                over_write = True
-            else:
-                over_write = False
-
-            self.proctab.write(filename=tfil, format='ascii.fixed_width',
-                               overwrite=over_write)
-            self.log.info("writing proc table file: %s" % tfil)
+            # rows are stored as they are added
+            self.proctab.save(tfil)
+            if KeckDRP.conf.PROCTAB_EXPORT:
+                self.proctab.export(tfil)
+                self.log.info("writing proc table file: %s" % tfil)
         else:
             self.log.info("no proc table to write")
 
@@ -100,56 +73,61 @@ class ProctabPrimitives(PrimitivesBASE):
                        suffix,
                        self.frame.header['OFNAME'],
                        self.frame.header['TARGNAME'].replace(" ", "")]
+            # print("Attempting to add %s" % str(new_row))
+            # replaces any row with the same CID, FRAMENO and STAGE
+            self.proctab.add_row(new_row)
         else:
-            new_row = None
-        # print("Attempting to add %s" % str(new_row))
-        self.proctab.add_row(new_row)
-        self.proctab = unique(self.proctab, keys=['CID', 'FRAMENO', 'STAGE'],
-                              keep='last')
-        self.proctab.sort('FRAMENO')
+            self.log.warning("no frame or proc table to update")
+
+    def n_proctab(self, target_type=None, target_group=None, nearest=False,
+                  by_mjd=None):
+        """Proc table rows of target_type that go with the current frame
 
-    def n_proctab(self, target_type=None, target_group=None, nearest=False):
+        Args:
+        -----
+            nearest (bool): only return the frame nearest the current one
+            by_mjd (bool): measure nearness in MJD rather than FRAMENO,
+                defaults to conf.NEAREST_BY_MJD
+        """
         if target_type is not None and self.proctab is not None:
             self.log.info('Looking for %s frames' % target_type)
-            # get relevant camera (blue or red)
-            tab = self.proctab[(self.proctab['CAM'] ==
-                                self.frame.header['CAMERA'].strip())]
-            # get target type images
-            tab = tab[(self.proctab['TYPE'] == target_type)]
+            # get relevant camera (blue or red) and target type images
+            criteria = {'CAM': self.frame.header['CAMERA'].strip(),
+                        'TYPE': target_type}
             # BIASES must have the same CCDCFG
             if 'BIAS' in target_type:
                 self.log.info('Looking for frames with CCDCFG = %s' %
                               self.frame.header['CCDCFG'])
-                tab = tab[(tab['DID'] == int(self.frame.header['CCDCFG']))]
+                criteria['DID'] = int(self.frame.header['CCDCFG'])
                 if target_group is not None:
-                    tab = tab[(tab['GRPID'] == target_group)]
+                    criteria['GRPID'] = target_group
             # raw DARKS must have the same CCDCFG and TTIME
             elif target_type == 'DARK':
                 self.log.info('Looking for frames with CCDCFG = %s and '
                               'TTIME = %f' % (self.frame.header['CCDCFG'],
                                               self.frame.header['TTIME']))
-                tab = tab[tab['DID'] == int(self.frame.header['CCDCFG'])]
-                tab = tab[tab['TTIME'] == float(self.frame.header['TTIME'])]
-                tab = tab[tab['GRPID'] == target_group]
+                criteria['DID'] = int(self.frame.header['CCDCFG'])
+                criteria['TTIME'] = float(self.frame.header['TTIME'])
+                criteria['GRPID'] = target_group
             # MDARKS must have the same CCDCFG, will be scaled to match TTIME
             elif target_type == 'MDARK':
                 self.log.info('Looking for frames with CCDCFG = %s' %
                               self.frame.header['CCDCFG'])
-                tab = tab[(tab['DID'] == int(self.frame.header['CCDCFG']))]
+                criteria['DID'] = int(self.frame.header['CCDCFG'])
             else:
-                tab = tab[(tab['CID'] == self.frame.header['STATEID'])]
+                criteria['CID'] = self.frame.header['STATEID']
             # Check if nearest entry is requested
-            if nearest and len(tab) > 1:
-                tfno = self.frame.header['FRAMENO']
-                minoff = 99999
-                trow = None
-                for row in tab:
-                    off = abs(row['FRAMENO'] - tfno)
-                    if off < minoff:
-                        minoff = off
-                        trow = row
-                if trow is not None:
-                    tab = tab[(tab['FRAMENO'] == trow['FRAMENO'])]
+            if nearest:
+                if by_mjd is None:
+                    by_mjd = KeckDRP.conf.NEAREST_BY_MJD
+                if by_mjd:
+                    tab = self.proctab.nearest(self.frame.header['MJD'],
+                                               column='MJD', **criteria)
+                else:
+                    tab = self.proctab.nearest(self.frame.header['FRAMENO'],
+                                               **criteria)
+            else:
+                tab = self.proctab.select(**criteria)
         else:
             if target_type is None:
                 self.log.warning("No target for proctab")
@@ -158,12 +136,23 @@ class ProctabPrimitives(PrimitivesBASE):
             tab = None
         return tab
 
+    def get_calibrations(self, target_types=('MBIAS', 'MDARK', 'CONTBARS',
+                                             'ARCLAMP'), by_mjd=None):
+        """Nearest calibration frames of each type for the current frame
+
+        Returns:
+        --------
+            dict: proc table rows of the nearest frame, by target type
+        """
+        return dict((target_type, self.n_proctab(target_type=target_type,
+                                                 nearest=True, by_mjd=by_mjd))
+                    for target_type in target_types)
+
     def in_proctab(self):
         # get relevant camera (blue or red)
-        tab = self.proctab[(self.proctab['CAM'] ==
-                            self.frame.header['CAMERA'].strip())]
-        imno_list = tab['FRAMENO']
-        if self.frame.header['FRAMENO'] in imno_list:
+        tab = self.proctab.select(CAM=self.frame.header['CAMERA'].strip(),
+                                  FRAMENO=self.frame.header['FRAMENO'])
+        if len(tab) > 0:
             return True
         else:
             return False
@@ -199,6 +199,15 @@ class KcwiCCD(CCDData):
     def oscanbuf(self):
         return KcwiConf.OSCANBUF
 
+    def float32(self):
+        return KcwiConf.FLOAT32
+
+    def nthreads(self):
+        return KcwiConf.NTHREADS
+
+    def nprocs(self):
+        return KcwiConf.NPROCS
+
     def plotlabel(self):
         lab = "Img # %d " % self.header['FRAMENO']
         lab += "(%s) " % self.illum()
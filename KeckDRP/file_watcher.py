@@ -0,0 +1,210 @@
+"""Watch a directory for new, completely written files
+
+Used by reduce.py --loop to start reducing a frame as soon as it has
+been written.  On Linux the kernel reports, through inotify, every file
+closed after writing (IN_CLOSE_WRITE) or moved into the directory
+(IN_MOVED_TO), so a frame is picked up within milliseconds.  Elsewhere,
+or if inotify is unavailable, the directory is polled: names are kept in
+a set, and a new file is only reported once its size and modification
+time are the same on two successive polls.
+
+Each file is reported once, in the order it was completed.
+"""
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import os
+import select
+import struct
+import time
+
+# inotify constants, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT = struct.Struct('iIII')
+
+
+def load_libc():
+    """The C library, if it provides inotify, or None"""
+    name = ctypes.util.find_library('c')
+    try:
+        libc = ctypes.CDLL(name, use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+    return libc
+
+
+def scan(directory, pattern):
+    """Names of the files in directory matching pattern"""
+    with os.scandir(directory) as entries:
+        return set(e.name for e in entries
+                   if fnmatch.fnmatch(e.name, pattern) and e.is_file())
+
+
+class PollingWatcher(object):
+    """Report new files by listing the directory every interval seconds
+
+    Args:
+    -----
+        directory (str): directory to watch
+        pattern (str): shell pattern of the file names to report
+        interval (float): seconds between listings
+    """
+
+    def __init__(self, directory='.', pattern='*.fits', interval=1.):
+        self.directory = directory
+        self.pattern = pattern
+        self.interval = interval
+        # files present at the start
+        self.existing = sorted(scan(directory, pattern))
+        self.seen = set(self.existing)
+        # new files still being written: name: (size, mtime)
+        self.pending = {}
+
+    def poll(self):
+        """New files whose size and time have not changed since last poll
+        """
+        ready = []
+        for name in scan(self.directory, self.pattern) - self.seen:
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            stamp = (st.st_size, st.st_mtime_ns)
+            if self.pending.get(name) == stamp:
+                del self.pending[name]
+                self.seen.add(name)
+                ready.append(name)
+            else:
+                self.pending[name] = stamp
+        return sorted(ready)
+
+    def wait(self, timeout=None):
+        """Block until new files are ready, or timeout seconds
+
+        Returns:
+        --------
+            list: paths of the new files, empty on timeout
+        """
+        start = time.monotonic()
+        while True:
+            ready = self.poll()
+            if ready:
+                return [os.path.join(self.directory, f) for f in ready]
+            if timeout is not None and \
+                    time.monotonic() - start + self.interval > timeout:
+                return []
+            time.sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Report files as the kernel signals they are closed or moved in
+
+    Raises:
+    -------
+        OSError: inotify is not available
+    """
+
+    def __init__(self, directory='.', pattern='*.fits', libc=None):
+        if libc is None:
+            libc = load_libc()
+        if libc is None:
+            raise OSError(errno.ENOSYS, "inotify not available")
+        self.directory = directory
+        self.pattern = pattern
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = libc.inotify_add_watch(self.fd,
+                                    os.fsencode(os.path.abspath(directory)),
+                                    IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, "inotify_add_watch failed: %s" % directory)
+        # listed after the watch is in place, so no file is missed
+        self.existing = sorted(scan(directory, pattern))
+        self.seen = set(self.existing)
+
+    def events(self):
+        """Names in the queued events, all names again after an overflow
+        """
+        names = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return names
+            pos = 0
+            while pos < len(buf):
+                wd, mask, cookie, length = EVENT.unpack_from(buf, pos)
+                pos += EVENT.size
+                name = buf[pos:pos + length].rstrip(b'\0')
+                pos += length
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost: rescan
+                    names.extend(sorted(scan(self.directory, self.pattern)))
+                elif name:
+                    names.append(os.fsdecode(name))
+
+    def wait(self, timeout=None):
+        """Block until new files are complete, or timeout seconds
+
+        Returns:
+        --------
+            list: paths of the new files, empty on timeout
+        """
+        start = time.monotonic()
+        while True:
+            remaining = None
+            if timeout is not None:
+                remaining = max(0., timeout - (time.monotonic() - start))
+            if not select.select([self.fd], [], [], remaining)[0]:
+                return []
+            ready = []
+            for name in self.events():
+                if name not in self.seen and \
+                        fnmatch.fnmatch(name, self.pattern):
+                    self.seen.add(name)
+                    ready.append(name)
+            if ready:
+                return [os.path.join(self.directory, f) for f in ready]
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def open_watcher(directory='.', pattern='*.fits', backend=None,
+                 interval=None):
+    """Watcher for directory, inotify if available unless backend='poll'
+
+    Args:
+    -----
+        backend (str): 'auto', 'inotify' or 'poll', defaults to
+            conf.WATCH_BACKEND
+        interval (float): polling interval in seconds, defaults to
+            conf.WATCH_INTERVAL
+    """
+    import KeckDRP
+    if backend is None:
+        backend = KeckDRP.conf.WATCH_BACKEND
+    if interval is None:
+        interval = KeckDRP.conf.WATCH_INTERVAL
+    if backend != 'poll':
+        try:
+            return InotifyWatcher(directory, pattern)
+        except OSError:
+            if backend == 'inotify':
+                raise
+    return PollingWatcher(directory, pattern, interval=interval)
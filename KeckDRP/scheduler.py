@@ -0,0 +1,222 @@
+"""Reduce a set of frames concurrently, calibrations before their users
+
+The frames are classified from their headers alone with the instrument
+image types, and each frame waits for the frames its recipe needs:
+
+    bias                    -
+    dark                    biases
+    flatlamp, domeflat,     biases, darks
+    twiflat
+    contbars                -
+    arclamp                 continuum bars
+    object                  biases, darks, flats, continuum bars, arcs
+
+Biases and darks are needed with the same CCDCFG, the other
+calibrations with the same STATEID, always on the same CAMERA.  Frames
+of one calibration type that go into the same master are reduced in
+order, one after the other, and only the last of them stacks the
+master, so each master is made once, before any frame that uses it.
+Frames whose dependencies are done run on a process pool; they share
+the proc table, which must then be the SQLite backend, and the CPUs,
+which init_worker() divides between the inner pools of the workers.
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from astropy import log
+from astropy.io import fits
+
+# image type: ((image type needed, header keyword to match), ...)
+NEEDS = {
+    'dark': (('bias', 'CCDCFG'),),
+    'flatlamp': (('bias', 'CCDCFG'), ('dark', 'CCDCFG')),
+    'domeflat': (('bias', 'CCDCFG'), ('dark', 'CCDCFG')),
+    'twiflat': (('bias', 'CCDCFG'), ('dark', 'CCDCFG')),
+    'arclamp': (('contbars', 'STATEID'),),
+    'object': (('bias', 'CCDCFG'), ('dark', 'CCDCFG'),
+               ('flatlamp', 'STATEID'), ('domeflat', 'STATEID'),
+               ('twiflat', 'STATEID'), ('contbars', 'STATEID'),
+               ('arclamp', 'STATEID'))}
+# image type: header keyword of the frames reduced in sequence
+SEQUENCE = {'bias': 'CCDCFG', 'dark': 'CCDCFG', 'flatlamp': 'STATEID',
+            'domeflat': 'STATEID', 'twiflat': 'STATEID',
+            'contbars': 'STATEID', 'arclamp': 'STATEID'}
+# image type: header keywords of the frames stacked into one master, as
+# n_proctab() selects them
+STACKS = {'bias': ('CCDCFG', 'GROUPID'),
+          'dark': ('CCDCFG', 'GROUPID', 'TTIME'),
+          'flatlamp': ('STATEID',)}
+
+
+def header_ccdcfg(header):
+    """CCDCFG of a raw header, built as reduce.py does when it is missing
+    """
+    if 'CCDCFG' in header:
+        return str(header['CCDCFG']).strip()
+    return header['CCDSUM'].replace(" ", "") + \
+        "%1d" % header['CCDMODE'] + \
+        "%02d" % header['GAINMUL'] + \
+        "%02d" % header['AMPMNUM']
+
+
+def scan_frames(paths, instrument):
+    """Image type and matching keys of each frame, from its header only
+
+    Returns:
+    --------
+        list: one dict per frame: path, imtype, frameno, CAMERA, CCDCFG,
+            STATEID, GROUPID and TTIME
+    """
+    frames = []
+    for path in paths:
+        header = fits.getheader(path)
+        frames.append({'path': path,
+                       'imtype': instrument.get_image_type(
+                           fits.PrimaryHDU(header=header)),
+                       'frameno': header.get('FRAMENO', len(frames)),
+                       'CAMERA': str(header.get('CAMERA', '')).strip(),
+                       'CCDCFG': header_ccdcfg(header),
+                       'STATEID': str(header.get('STATEID', '')).strip(),
+                       'GROUPID': str(header.get('GROUPID', '')).strip(),
+                       'TTIME': float(header.get('TTIME', 0.))})
+    return frames
+
+
+def build_graph(frames):
+    """Frames each frame has to wait for
+
+    Returns:
+    --------
+        dict: path: set of paths
+    """
+    depends = dict((f['path'], set()) for f in frames)
+    last = {}
+    for frame in sorted(frames, key=lambda f: f['frameno']):
+        for imtype, key in NEEDS.get(frame['imtype'], ()):
+            depends[frame['path']].update(
+                f['path'] for f in frames
+                if f['imtype'] == imtype and f['CAMERA'] == frame['CAMERA']
+                and f[key] == frame[key])
+        if frame['imtype'] in SEQUENCE:
+            group = (frame['imtype'], frame['CAMERA'],
+                     frame[SEQUENCE[frame['imtype']]])
+            if group in last:
+                depends[frame['path']].add(last[group])
+            last[group] = frame['path']
+    return depends
+
+
+def stack_frames(frames):
+    """Frames after which a master is stacked: the last of each group
+
+    Returns:
+    --------
+        set: paths
+    """
+    last = {}
+    for frame in sorted(frames, key=lambda f: f['frameno']):
+        if frame['imtype'] in STACKS:
+            group = (frame['imtype'], frame['CAMERA']) + tuple(
+                frame[key] for key in STACKS[frame['imtype']])
+            last[group] = frame['path']
+    return set(last.values())
+
+
+def topological_order(frames, depends):
+    """Paths in an order that puts every frame after its dependencies,
+    otherwise by frame number
+    """
+    done = set()
+    order = []
+    pending = sorted(frames, key=lambda f: f['frameno'])
+    while pending:
+        ready = [f for f in pending if depends[f['path']] <= done]
+        if not ready:
+            raise ValueError("circular frame dependencies")
+        for frame in ready:
+            order.append(frame['path'])
+            done.add(frame['path'])
+        pending = [f for f in pending if f['path'] not in done]
+    return order
+
+
+def init_worker(nprocs):
+    """Configure a worker process of a pool of nprocs reducing frames
+
+    Each worker gets its share of the CPUs for its own process and
+    thread pools, and the proc table backend shared between processes.
+    Done here rather than in the parent, as forked workers only would
+    inherit that.
+    """
+    import KeckDRP
+    from KeckDRP.KCWI import KcwiConf
+    share = max(1, (os.cpu_count() or 1) // nprocs)
+    KcwiConf.NPROCS = share
+    KcwiConf.NTHREADS = share
+    KeckDRP.conf.COMBINE_NPROCS = share
+    KeckDRP.conf.PROCTAB_BACKEND = 'sqlite'
+
+
+def run(paths, func, args=(), instrument=None, nprocs=1, imtype=None):
+    """Call func(path, *args, defer_stack=...) for each frame once its
+    dependencies are done
+
+    defer_stack is True for calibration frames that are not the last of
+    their master, which should then not be stacked yet.
+
+    Args:
+    -----
+        func: module level function reducing one frame
+        nprocs (int): worker processes; 1 reduces in the calling process,
+            in dependency order
+        imtype (str): only reduce frames of this image type
+
+    Returns:
+    --------
+        list: paths in the order they were completed
+    """
+    if instrument is None:
+        from KeckDRP import Instruments
+        instrument = Instruments.KCWI()
+    frames = scan_frames(paths, instrument)
+    if imtype:
+        frames = [f for f in frames if f['imtype'] == imtype]
+    depends = build_graph(frames)
+    stacks = stack_frames(frames)
+    # calibrations stacked by a later frame of their group
+    defer = dict((f['path'], f['imtype'] in STACKS and
+                  f['path'] not in stacks) for f in frames)
+    if nprocs <= 1:
+        order = topological_order(frames, depends)
+        for path in order:
+            func(path, *args, defer_stack=defer[path])
+        return order
+    completed = []
+    done = set()
+    pending = sorted(frames, key=lambda f: f['frameno'])
+    running = {}
+    t0 = time.time()
+    with ProcessPoolExecutor(max_workers=nprocs, initializer=init_worker,
+                             initargs=(nprocs,)) as executor:
+        while pending or running:
+            for frame in [f for f in pending if depends[f['path']] <= done]:
+                pending.remove(frame)
+                future = executor.submit(func, frame['path'], *args,
+                                         defer_stack=defer[frame['path']])
+                running[future] = frame
+            if not running:
+                raise ValueError("circular frame dependencies")
+            finished, unused = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                frame = running.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    # users of the frame still run, as they would serially
+                    log.error("reducing %s failed: %s" % (frame['path'], e))
+                done.add(frame['path'])
+                completed.append(frame['path'])
+    log.info("reduced %d frames with %d processes in %.1f s" %
+             (len(completed), nprocs, time.time() - t0))
+    return completed
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""Arc solution steps, per bar loops vs batched arrays
+
+Times the inter-bar offsets of arc_offsets for 120 synthetic bar arcs,
+one np.correlate per bar as it used to be computed, against one batched
+real FFT cross-correlation of the whole stack; and the bar x dispersion
+grid search of fit_center, one interp1d and one correlation per bar and
+dispersion, against one batched resampling and correlation per
+dispersion; the line measurements of solve_arcs, a curve_fit and a
+1000 point interpolation per line, against the batched linefit kernels;
+and the line windows, get_line_window() per line against
+get_line_windows() per bar.
+
+Usage: python benchmarks/bench_arcs.py [--npix NPIX]
+"""
+import argparse
+import time
+
+import numpy as np
+from astropy import log
+from astropy.io import fits
+from scipy import signal
+from scipy.interpolate import interp1d
+from scipy.optimize import curve_fit
+from scipy.signal import find_peaks
+
+from KeckDRP import KcwiCCD
+from KeckDRP.KCWI import KcwiConf
+from KeckDRP.KCWI import kcwi_primitives
+from KeckDRP.KCWI import linefit
+from KeckDRP.KCWI.xcorr import xcorr_full
+
+
+def synthetic_arcs(nbars, npix, seed=11):
+    """Arc spectra of random lines, each bar shifted by a few pixels"""
+    rng = np.random.RandomState(seed)
+    x = np.arange(npix)
+    lines = rng.uniform(50, npix - 50, size=80)
+    fluxes = rng.uniform(100., 5000., size=80)
+    arcs = []
+    for shift in rng.uniform(-15., 15., size=nbars):
+        arc = rng.normal(scale=5., size=npix)
+        for line, flux in zip(lines, fluxes):
+            arc += flux * np.exp(-0.5 * ((x - line - shift) / 1.5) ** 2)
+        arcs.append(arc)
+    return arcs
+
+
+def loop_offsets(arcs, refbar):
+    """Offsets as arc_offsets used to find them, bar by bar"""
+    refarc = arcs[refbar]
+    nsamp = len(refarc[10:-10])
+    offar = np.arange(1 - nsamp, nsamp)
+    return [offar[np.correlate(refarc[10:-10], arc[10:-10],
+                               mode='full').argmax()] for arc in arcs]
+
+
+def central_arcs(p, npix, disp=0.25, seed=5):
+    """Atlas and bar arcs drawn from it with a known dispersion"""
+    rng = np.random.RandomState(seed)
+    hdr = fits.Header()
+    hdr['CAMERA'] = 'BLUE'
+    hdr['BGRATNAM'] = 'BM'
+    hdr['BCWAVE'] = 4500.
+    hdr['BINNING'] = '2,2'
+    p.set_frame(KcwiCCD(np.zeros((2, 2)), unit='adu', meta=hdr))
+    half = npix * disp
+    p.refdisp = 0.2
+    p.refwave = np.arange(4500. - half, 4500. + half, p.refdisp)
+    lines = rng.uniform(4500. - 0.8 * half, 4500. + 0.8 * half, size=150)
+    fluxes = rng.uniform(100., 5000., size=150)
+    p.reflux = np.sum(fluxes * np.exp(-0.5 * (
+        (p.refwave[:, np.newaxis] - lines) / 1.2) ** 2), axis=1)
+    p.xvals = np.arange(npix) - int(npix / 2)
+    p.x0 = int(npix / 2)
+    p.minrow = int(npix / 3)
+    p.maxrow = int(2. * npix / 3)
+    p.baroffs = list(rng.randint(-10, 10, size=p.NBARS))
+    p.prelim_disp = disp * 1.02
+    p.offset_wave = 0.
+    atlas = interp1d(p.refwave, p.reflux, kind='cubic')
+    p0 = 4500. + np.array(p.baroffs) * p.prelim_disp
+    p.arcs = [atlas(np.polyval(p.disp_coeff(c, disp), p.xvals))
+              for c in p0]
+    return p0
+
+
+def loop_dispersions(p, disps, p0):
+    """fit_center grid as it used to be searched, bar by bar"""
+    subxvals = p.xvals[p.minrow:p.maxrow]
+    maxima = np.zeros((len(p.arcs), len(disps)))
+    shifts = np.zeros((len(p.arcs), len(disps)))
+    for b, bs in enumerate(p.arcs):
+        for di, disp in enumerate(disps):
+            coeff = p.disp_coeff(p0[b], disp)
+            wl0 = np.polyval(coeff, p.xvals[p.minrow])
+            wl1 = np.polyval(coeff, p.xvals[p.maxrow])
+            minrw = [i for i, v in enumerate(p.refwave)
+                     if v >= min(wl0, wl1)][0]
+            maxrw = [i for i, v in enumerate(p.refwave)
+                     if v <= max(wl0, wl1)][-1]
+            tkwgt = signal.windows.tukey(maxrw - minrw,
+                                         alpha=p.frame.taperfrac())
+            intspec = interp1d(np.polyval(coeff, subxvals),
+                               bs[p.minrow:p.maxrow], kind='cubic',
+                               bounds_error=False, fill_value='extrapolate')(
+                                   p.refwave[minrw:maxrw]) * tkwgt
+            xcorr = xcorr_full(intspec, p.reflux[minrw:maxrw] * tkwgt)
+            offar = np.arange(1 - len(tkwgt), len(tkwgt))
+            x0c = int(len(xcorr) / 3)
+            x1c = int(2 * (len(xcorr) / 3))
+            imax = xcorr[x0c:x1c].argmax()
+            maxima[b, di] = xcorr[x0c:x1c][imax]
+            shifts[b, di] = offar[x0c:x1c][imax]
+    return maxima, shifts
+
+
+def loop_lines(spec, x0, x1):
+    """Line measurements as solve_arcs used to make them, line by line"""
+    xsvals = np.arange(len(spec))
+    out = []
+    for lo, hi in zip(x0, x1):
+        xvec = xsvals[lo:hi + 1]
+        yvec = spec[lo:hi + 1]
+        fit, _ = curve_fit(kcwi_primitives.gaus, xvec, yvec,
+                           p0=[yvec.max(), xvec[len(xvec) // 2], 1.])
+        xplot = np.linspace(min(xvec), max(xvec), num=1000)
+        plt_line = interp1d(xvec, yvec, kind='cubic')(xplot)
+        out.append((fit[1], xplot[plt_line.argmax()],
+                    np.sum(xvec * yvec) / np.sum(yvec)))
+    return np.array(out)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Arc solution benchmarks")
+    parser.add_argument('--npix', type=int, default=4112,
+                        help='samples per bar arc')
+    args = parser.parse_args()
+    log.setLevel('WARNING')
+    KcwiConf.INTER = 0
+    p = kcwi_primitives.KcwiPrimitives()
+    p.set_frame(KcwiCCD(np.zeros((2, 2)), unit='adu', meta=fits.Header()))
+    p.arcs = synthetic_arcs(p.NBARS, args.npix)
+    print("inter-bar offsets, %d bars of %d px" % (p.NBARS, args.npix))
+    t0 = time.perf_counter()
+    expected = loop_offsets(p.arcs, p.REFBAR)
+    t_loop = time.perf_counter() - t0
+    print("  np.correlate loop : %8.1f ms" % (t_loop * 1.e3))
+    t0 = time.perf_counter()
+    p.arc_offsets()
+    dt = time.perf_counter() - t0
+    assert list(p.baroffs) == expected
+    print("  batched rfft      : %8.1f ms  (x%.0f)" % (dt * 1.e3, t_loop / dt))
+    p0 = central_arcs(p, args.npix)
+    disps = p.prelim_disp * np.linspace(0.95, 1.05, 26)
+    print("central fit grid, %d bars x %d dispersions" % (p.NBARS,
+                                                          len(disps)))
+    t0 = time.perf_counter()
+    expected = loop_dispersions(p, disps, p0)
+    t_loop = time.perf_counter() - t0
+    print("  per bar, per disp : %8.1f ms" % (t_loop * 1.e3))
+    t0 = time.perf_counter()
+    maxima, shifts = p.xcorr_dispersions(disps, p0)
+    dt = time.perf_counter() - t0
+    assert np.array_equal(shifts, expected[1])
+    assert np.allclose(maxima, expected[0], rtol=1.e-9)
+    print("  batched           : %8.1f ms  (x%.0f)" % (dt * 1.e3, t_loop / dt))
+    # windows of +-3 px around the lines of every bar
+    bars = []
+    for arc in p.arcs:
+        pks = find_peaks(arc, height=500., distance=10)[0]
+        pks = pks[(pks > 5) & (pks < len(arc) - 5)]
+        bars.append((arc, pks - 3, pks + 3))
+    nlines = sum(len(b[1]) for b in bars)
+    print("line measurements, %d lines in %d bars" % (nlines, len(bars)))
+    t0 = time.perf_counter()
+    expected = [loop_lines(*b) for b in bars]
+    t_loop = time.perf_counter() - t0
+    print("  curve_fit loop    : %8.1f ms" % (t_loop * 1.e3))
+    t0 = time.perf_counter()
+    for (arc, x0, x1), exp in zip(bars, expected):
+        xw, yw, mask = linefit.pad_windows(arc, np.arange(len(arc)), x0, x1)
+        fits, ok = linefit.fit_gaussians(xw, yw, mask)
+        peaks, unused = linefit.spline_peaks(xw, yw, mask)
+        cents = linefit.centroids(xw, yw, mask)
+        assert ok.all() and np.allclose(fits[:, 1], exp[:, 0])
+        assert np.allclose(peaks, exp[:, 1], atol=0.01)
+    dt = time.perf_counter() - t0
+    print("  batched linefit   : %8.1f ms  (x%.0f)" % (dt * 1.e3, t_loop / dt))
+    print("line windows, %d lines in %d bars" % (nlines, len(bars)))
+    t0 = time.perf_counter()
+    expected = [[kcwi_primitives.get_line_window(arc, c, thresh=50.)
+                 for c in x0 + 3] for arc, x0, x1 in bars]
+    t_loop = time.perf_counter() - t0
+    print("  scalar loop       : %8.1f ms" % (t_loop * 1.e3))
+    t0 = time.perf_counter()
+    windows = [kcwi_primitives.get_line_windows(arc, x0 + 3, thresh=50.)
+               for arc, x0, x1 in bars]
+    dt = time.perf_counter() - t0
+    for exp, win in zip(expected, windows):
+        assert [w[2] for w in exp] == list(win[2])
+    print("  get_line_windows  : %8.1f ms  (x%.0f)" % (dt * 1.e3, t_loop / dt))
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""Micro-benchmarks for the basic CCD reduction primitives
+
+Builds a synthetic 4-amp, 4k x 4k KCWI-like raw frame and times the CCD
+stages against the column-by-column reference implementation.
+
+Usage: python benchmarks/bench_ccd.py [--repeat N]
+"""
+import argparse
+import time
+
+import numpy as np
+from astropy import log
+from astropy.io import fits
+
+from KeckDRP import KcwiCCD
+from KeckDRP.KCWI import KcwiConf
+from KeckDRP.KCWI import kcwi_primitives
+
+# synthetic CCD layout (unbinned, 4 amps)
+NXAMP = 2048    # data columns per amp
+NYAMP = 2056    # data rows per amp
+NOSCAN = 100    # overscan columns per amp
+
+
+def synthetic_header(ampmode='ALL'):
+    """Header describing a 4-amp raw frame
+
+    Amp layout follows map_ccd():
+
+    | 3 | 4 |
+    ---------
+    | 1 | 2 |
+    """
+    hdr = fits.Header()
+    hdr['NVIDINP'] = 4
+    hdr['FRAMENO'] = 1
+    hdr['AMPMODE'] = ampmode
+    hdr['CCDCFG'] = '1121004'
+    nx = 2 * (NXAMP + NOSCAN)
+    for ia in range(4):
+        # left amps read forward, right amps read backward
+        left = ia in (0, 2)
+        y0 = 1 if ia < 2 else NYAMP + 1
+        y1 = y0 + NYAMP - 1
+        if left:
+            dx0, dx1 = 1, NXAMP
+            bx0, bx1 = NXAMP + 1, NXAMP + NOSCAN
+        else:
+            dx0, dx1 = nx, nx - NXAMP + 1
+            bx0, bx1 = nx - NXAMP - NOSCAN + 1, nx - NXAMP
+        hdr['GAIN%d' % (ia + 1)] = 0.145 + 0.01 * ia
+        hdr['BSEC%d' % (ia + 1)] = '[%d:%d,%d:%d]' % (bx0, bx1, y0, y1)
+        hdr['DSEC%d' % (ia + 1)] = '[%d:%d,%d:%d]' % (dx0, dx1, y0, y1)
+        hdr['ASEC%d' % (ia + 1)] = hdr['DSEC%d' % (ia + 1)]
+        hdr['CSEC%d' % (ia + 1)] = hdr['DSEC%d' % (ia + 1)]
+    return hdr
+
+
+def synthetic_frame(ampmode='ALL', seed=123):
+    """Raw frame with a bias level, a row ramp and read noise"""
+    rng = np.random.RandomState(seed)
+    ny = 2 * NYAMP
+    nx = 2 * (NXAMP + NOSCAN)
+    data = 1000. + rng.normal(scale=3.5, size=(ny, nx))
+    data += np.linspace(0., 5., ny)[:, np.newaxis]
+    # same working precision as reduce.py
+    if KcwiConf.FLOAT32:
+        data = data.astype(np.float32)
+    return KcwiCCD(data, unit='adu', meta=synthetic_header(ampmode))
+
+
+def subtract_oscan_columns(data, osfit, y0, y1, x0, x1):
+    """Reference: column-by-column overscan subtraction"""
+    for ix in range(x0, x1 + 1):
+        data[y0:y1, ix] = data[y0:y1, ix] - osfit
+
+
+def timeit(func, repeat, setup=None):
+    """Best wall-clock time of func(), running setup() untimed before each"""
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        t0 = time.perf_counter()
+        func()
+        dt = time.perf_counter() - t0
+        if best is None or dt < best:
+            best = dt
+    return best
+
+
+def bench_subtract_oscan(repeat):
+    p = kcwi_primitives.KcwiPrimitives()
+    p.set_frame(synthetic_frame())
+    bsec, dsec, tsec, direc = p.map_ccd()
+    osfits = [np.linspace(1000., 1005., bsec[ia][1] - bsec[ia][0] + 1)
+              for ia in range(len(bsec))]
+
+    def columns():
+        data = p.frame.data
+        for ia, osfit in enumerate(osfits):
+            subtract_oscan_columns(data, osfit, bsec[ia][0], bsec[ia][1] + 1,
+                                   dsec[ia][2], dsec[ia][3])
+
+    def broadcast():
+        data = p.frame.data
+        for ia, osfit in enumerate(osfits):
+            data[bsec[ia][0]:bsec[ia][1] + 1,
+                 dsec[ia][2]:dsec[ia][3] + 1] -= osfit[:, np.newaxis]
+
+    def new_frame():
+        p.set_frame(synthetic_frame())
+
+    t_col = timeit(columns, repeat)
+    t_bro = timeit(broadcast, repeat)
+    t_prim = timeit(p.subtract_oscan, repeat, setup=new_frame)
+    print("overscan subtraction, 4 amps, %d x %d raw frame" %
+          p.frame.data.shape)
+    print("  column loop      : %8.1f ms" % (t_col * 1.e3))
+    print("  broadcast        : %8.1f ms  (x%.1f)" % (t_bro * 1.e3,
+                                                       t_col / t_bro))
+    print("  subtract_oscan() : %8.1f ms" % (t_prim * 1.e3))
+    KcwiConf.FLOAT32 = True
+    t_prim32 = timeit(p.subtract_oscan, repeat, setup=new_frame)
+    KcwiConf.FLOAT32 = False
+    print("  ... with FLOAT32 : %8.1f ms" % (t_prim32 * 1.e3))
+
+
+def bench_threaded_amps(repeat):
+    p = kcwi_primitives.KcwiPrimitives()
+
+    def new_frame():
+        p.set_frame(synthetic_frame())
+
+    def basic_ccd():
+        p.subtract_oscan()
+        p.trim_oscan()
+        p.correct_gain()
+
+    print("subtract_oscan + trim_oscan + correct_gain, 4 amps")
+    nthreads = KcwiConf.NTHREADS
+    for nt in (1, 2, 4):
+        KcwiConf.NTHREADS = nt
+        t = timeit(basic_ccd, repeat, setup=new_frame)
+        print("  NTHREADS = %d     : %8.1f ms" % (nt, t * 1.e3))
+    KcwiConf.NTHREADS = nthreads
+
+
+def bench_basic_ccd_reduce(repeat):
+    p = kcwi_primitives.KcwiPrimitives()
+
+    def new_frame():
+        p.set_frame(synthetic_frame(ampmode='__B'))
+
+    def sequential():
+        p.subtract_oscan()
+        p.trim_oscan()
+        p.correct_gain()
+        # rectify_image also rotates the uncertainty
+        p.frame.uncertainty = np.zeros_like(p.frame.data)
+        p.rectify_image()
+
+    t_seq = timeit(sequential, repeat, setup=new_frame)
+    t_fus = timeit(p.basic_ccd_reduce, repeat, setup=new_frame)
+    print("oscan + trim + gain + rectify, 4 amps, AMPMODE __B")
+    print("  sequential       : %8.1f ms" % (t_seq * 1.e3))
+    print("  basic_ccd_reduce : %8.1f ms  (x%.1f)" % (t_fus * 1.e3,
+                                                       t_seq / t_fus))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="CCD stage benchmarks")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of timing repeats (best is reported)')
+    args = parser.parse_args()
+    # no plots or per-amp logging during benchmarks
+    KcwiConf.INTER = 0
+    log.setLevel('WARNING')
+    bench_subtract_oscan(args.repeat)
+    bench_threaded_amps(args.repeat)
+    bench_basic_ccd_reduce(args.repeat)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""Time and peak memory of image stacking, in memory vs streamed from disk
+
+Writes a stack of synthetic float32 frames to a temporary directory and
+combines them with ImgmathPrimitives.image_combine, once with the whole
+stack in memory (COMBINE_TILE_ROWS = 0), once per tile size and once per
+process count (COMBINE_NPROCS, capped at the number of CPUs).
+
+Usage: python benchmarks/bench_combine.py [--nimg N] [--size NPIX]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from astropy import log
+from astropy.io import fits
+from astropy.table import Table
+
+import KeckDRP
+from KeckDRP.KCWI import kcwi_primitives
+
+
+def write_stack(outdir, nimg, size, seed=123):
+    """Write nimg size x size float32 frames, return a proc-table like Table"""
+    rng = np.random.RandomState(seed)
+    names = []
+    for i in range(nimg):
+        data = (100. + rng.normal(scale=3.5, size=(size, size)))
+        hdu = fits.PrimaryHDU(data.astype(np.float32))
+        hdu.header['BUNIT'] = 'electron'
+        hdu.header['CCDCFG'] = '1121004'
+        name = 'kb%05d_int.fits' % (i + 1)
+        hdu.writeto(os.path.join(outdir, name))
+        names.append('kb%05d.fits' % (i + 1))
+    return Table([names, list(range(1, nimg + 1))],
+                 names=('OFNAME', 'FRAMENO'))
+
+
+def run(tab, outdir, method, tile_rows, nprocs=1):
+    """Wall-clock time and peak traced memory of one combine
+
+    Memory allocated in pool worker processes is not traced.
+    """
+    KeckDRP.conf.COMBINE_TILE_ROWS = tile_rows
+    KeckDRP.conf.COMBINE_NPROCS = nprocs
+    p = kcwi_primitives.KcwiPrimitives()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    p.image_combine(tab, combine_type='flat', in_directory=outdir,
+                    suffix='int', method=method, unit=None)
+    dt = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return dt, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Stacking benchmarks")
+    parser.add_argument('--nimg', type=int, default=10,
+                        help='number of frames to stack')
+    parser.add_argument('--size', type=int, default=1024,
+                        help='frame size in pixels (square)')
+    args = parser.parse_args()
+    log.setLevel('WARNING')
+    outdir = tempfile.mkdtemp()
+    try:
+        tab = write_stack(outdir, args.nimg, args.size)
+        print("stack of %d %d x %d float32 frames" % (args.nimg, args.size,
+                                                      args.size))
+        for method in ('average', 'median'):
+            for tile_rows in (0, 512, 128):
+                dt, peak = run(tab, outdir, method, tile_rows)
+                label = 'in memory' if tile_rows == 0 else \
+                    '%d row tiles' % tile_rows
+                print("  %-7s %-14s: %8.1f ms  peak %8.1f MB" % (
+                    method, label, dt * 1.e3, peak / 2.**20))
+            for nprocs in (2, 4):
+                dt, peak = run(tab, outdir, method, 128, nprocs=nprocs)
+                print("  %-7s %-14s: %8.1f ms" % (
+                    method, '%d processes' % nprocs, dt * 1.e3))
+    finally:
+        shutil.rmtree(outdir)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""Per-frame slice resampling cost of make_cube
+
+Builds a synthetic 24-slice geometry and times the resampling part of
+make_cube: warping each slice through its transform and copying it into
+the cube pixel by pixel, as make_cube used to, against interpolating on
+the precomputed, memory-mapped coordinate maps, and against the
+flux-conserving drizzle matrices (data, variance and coverage), and
+with the slices spread over a process pool (KcwiPrimitives.warp_cube).
+
+Also times reading the geometry for a frame, from the FITS geometry
+file against unpickling the transforms as make_cube used to.
+
+Usage: python benchmarks/bench_cube.py [--ny NROWS] [--width NCOLS]
+"""
+import argparse
+import os
+import pickle
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from astropy import log
+from skimage import transform as tf
+
+from KeckDRP.KCWI import drizzle
+from KeckDRP.KCWI import kcwi_primitives
+from KeckDRP.KCWI.geometry import SCALARS, write_geom, read_geom
+
+
+def synthetic_geometry(ny, width, xsize, geom_file):
+    """24 slices of curved transforms, slice to image and back"""
+    tforms = []
+    invtfs = []
+    for isl in range(24):
+        xo, yo = np.meshgrid(np.linspace(0., xsize, 8),
+                             np.linspace(0., ny, 12))
+        xo, yo = xo.ravel(), yo.ravel()
+        # slice (x, wavelength) to image (x - xl0, y)
+        xi = 10. + xo * (width - 20.) / xsize - \
+            2.e-4 * (yo - ny / 2.) ** 2 / ny
+        yi = yo - 1.e-3 * xi ** 2
+        tforms.append(tf.estimate_transform(
+            'polynomial', np.column_stack((xo, yo)),
+            np.column_stack((xi, yi)), order=3))
+        invtfs.append(tf.estimate_transform(
+            'polynomial', np.column_stack((xi, yi)),
+            np.column_stack((xo, yo)), order=3))
+    return {'geom_file': geom_file, 'tform': tforms, 'invtf': invtfs,
+            'xl0': [isl * width for isl in range(24)],
+            'xl1': [(isl + 1) * width for isl in range(24)],
+            'xsize': xsize, 'ysize': ny}
+
+
+def warp_cube(data, geom):
+    """Slices warped through the transforms, copied pixel by pixel"""
+    xsize, ysize = geom['xsize'], geom['ysize']
+    out_cube = np.zeros((ysize, xsize, 24))
+    for isl in range(0, 24):
+        slice_img = data[:, geom['xl0'][isl]:geom['xl1'][isl]]
+        warped = tf.warp(slice_img, geom['tform'][isl], order=3,
+                         output_shape=(ysize, xsize))
+        for iy in range(ysize):
+            for ix in range(xsize):
+                out_cube[iy, ix, isl] = warped[iy, ix]
+    return out_cube
+
+
+def map_cube(data, geom, coords):
+    """Slices interpolated on precomputed coordinates"""
+    out_cube = np.zeros((geom['ysize'], geom['xsize'], 24))
+    for isl in range(0, 24):
+        slice_img = data[:, geom['xl0'][isl]:geom['xl1'][isl]]
+        out_cube[:, :, isl] = tf.warp(slice_img, coords[isl], order=3)
+    return out_cube
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Cube resampling benchmarks")
+    parser.add_argument('--ny', type=int, default=2056,
+                        help='image rows')
+    parser.add_argument('--width', type=int, default=170,
+                        help='image columns per slice')
+    args = parser.parse_args()
+    log.setLevel('WARNING')
+    outdir = tempfile.mkdtemp()
+    try:
+        geom_file = os.path.join(outdir, 'kb00001_geom.fits')
+        geom = synthetic_geometry(args.ny, args.width, 140, geom_file)
+        # parameters resampling does not use
+        for key, kwd in SCALARS:
+            geom.setdefault(key, 0)
+        write_geom(geom_file, geom)
+        pkl_file = os.path.join(outdir, 'kb00001_geom.pkl')
+        with open(pkl_file, 'wb') as ofile:
+            pickle.dump(geom, ofile)
+        data = np.random.RandomState(1).normal(
+            100., 5., size=(args.ny, 24 * args.width))
+        p = kcwi_primitives.KcwiPrimitives()
+        t0 = time.perf_counter()
+        p.write_coord_maps(geom)
+        t_maps = time.perf_counter() - t0
+        print("cube of 24 %d x %d slices" % (geom['ysize'], geom['xsize']))
+        t0 = time.perf_counter()
+        for i in range(10):
+            with open(pkl_file, 'rb') as ifile:
+                pickle.load(ifile)
+        t_pkl = (time.perf_counter() - t0) / 10.
+        t0 = time.perf_counter()
+        for i in range(10):
+            read_geom(geom_file)
+        t_fits = (time.perf_counter() - t0) / 10.
+        print("  geometry, pickle              : %8.1f ms" % (t_pkl * 1.e3))
+        print("  geometry, FITS + hash check   : %8.1f ms" % (t_fits * 1.e3))
+        print("  coordinate maps, once per arc : %8.1f ms" % (t_maps * 1.e3))
+        t0 = time.perf_counter()
+        ref = warp_cube(data, geom)
+        t_warp = time.perf_counter() - t0
+        print("  warp + pixel copy, per frame  : %8.1f ms" % (t_warp * 1.e3))
+        t0 = time.perf_counter()
+        coords = p.read_coord_maps(geom, geom_file)
+        cube = map_cube(data, geom, coords)
+        t_map = time.perf_counter() - t0
+        print("  precomputed maps, per frame   : %8.1f ms  (x%.1f)" % (
+            t_map * 1.e3, t_warp / t_map))
+        assert np.array_equal(cube, ref)
+        for nprocs in (2, 4):
+            t0 = time.perf_counter()
+            cube = p.warp_cube(data, geom, geom_file, nprocs)
+            dt = time.perf_counter() - t0
+            print("  %-30s: %8.1f ms  (x%.1f)" % (
+                '%d processes, per frame' % nprocs, dt * 1.e3, t_warp / dt))
+            assert np.array_equal(cube, ref)
+        t0 = time.perf_counter()
+        matrices = p.read_drizzle_matrices(geom, geom_file, args.ny)
+        t_mat = time.perf_counter() - t0
+        nnz = sum(m[0].nnz for m in matrices)
+        print("  drizzle matrices, once per arc: %8.1f ms  (%d MB)" % (
+            t_mat * 1.e3, nnz * 8 // 2**20))
+        var = np.abs(data)
+        t0 = time.perf_counter()
+        for isl in range(24):
+            sl = slice(geom['xl0'][isl], geom['xl1'][isl])
+            drizzle.drizzle_slice(matrices[isl], data[:, sl], var[:, sl],
+                                  shape=(geom['ysize'], geom['xsize']))
+        t_drz = time.perf_counter() - t0
+        print("  drizzle + variance + coverage : %8.1f ms  (x%.1f)" % (
+            t_drz * 1.e3, t_warp / t_drz))
+    finally:
+        shutil.rmtree(outdir)
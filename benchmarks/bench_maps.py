@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""Wavelength, position and slice map generation, pixel loop vs batched
+
+Builds a synthetic 24-slice geometry file and times
+KcwiPrimitives.generate_maps against the pixel-by-pixel loop it replaced,
+then with a thread pool of each size (KcwiConf.NTHREADS).
+
+Usage: python benchmarks/bench_maps.py [--ny NROWS] [--width NCOLS]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from astropy import log
+from skimage import transform as tf
+
+from KeckDRP import KcwiCCD
+from KeckDRP.KCWI import KcwiConf
+from KeckDRP.KCWI import kcwi_primitives
+from KeckDRP.KCWI.geometry import SCALARS, write_geom
+
+
+def synthetic_geometry(ny, width, xsize):
+    """24 slices of curved inverse transforms, width image columns each"""
+    xl0s, xl1s, invtfs = [], [], []
+    for isl in range(24):
+        xi, yi = np.meshgrid(np.linspace(0., width, 8),
+                             np.linspace(0., ny, 12))
+        xi, yi = xi.ravel(), yi.ravel()
+        # image (x - xl0, y) to slice (x, wavelength)
+        xo = (xi - 10.) * xsize / (width - 20.) + \
+            2.e-4 * (yi - ny / 2.) ** 2 / ny
+        yo = yi + 1.e-3 * xi ** 2
+        invtfs.append(tf.estimate_transform(
+            'polynomial', np.column_stack((xi, yi)),
+            np.column_stack((xo, yo)), order=3))
+        xl0s.append(isl * width)
+        xl1s.append((isl + 1) * width)
+    return {'xl0': xl0s, 'xl1': xl1s, 'invtf': invtfs, 'xsize': xsize,
+            'wave0out': 3500., 'dwout': 0.5}
+
+
+def loop_maps(geom, ny, nx):
+    """Pixel by pixel maps, as generate_maps used to make them"""
+    wave_map = np.full((ny, nx), -1.)
+    xpos_map = np.full((ny, nx), -1.)
+    slice_map = np.full((ny, nx), -1.)
+    for isl in range(0, 24):
+        itrf = geom['invtf'][isl]
+        xl0 = geom['xl0'][isl]
+        for ix in range(xl0, geom['xl1'][isl]):
+            coords = np.zeros((ny, 2))
+            for iy in range(0, ny):
+                coords[iy, 0] = ix - xl0
+                coords[iy, 1] = iy
+            ncoo = itrf(coords)
+            for iy in range(0, ny):
+                if 0 <= ncoo[iy, 0] <= geom['xsize']:
+                    slice_map[iy, ix] = isl
+                    xpos_map[iy, ix] = ncoo[iy, 0]
+                    wave_map[iy, ix] = ncoo[iy, 1] * geom['dwout'] + \
+                        geom['wave0out']
+    return wave_map, xpos_map, slice_map
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Map generation benchmarks")
+    parser.add_argument('--ny', type=int, default=2056,
+                        help='image rows')
+    parser.add_argument('--width', type=int, default=170,
+                        help='image columns per slice')
+    args = parser.parse_args()
+    log.setLevel('WARNING')
+    nx = 24 * args.width
+    geom = synthetic_geometry(args.ny, args.width, xsize=140)
+    outdir = tempfile.mkdtemp()
+    try:
+        p = kcwi_primitives.KcwiPrimitives()
+        p.geom_file = os.path.join(outdir, 'kb00001_geom.fits')
+        # parameters and transforms the maps do not use
+        for key, kwd in SCALARS:
+            geom.setdefault(key, 0)
+        geom['tform'] = geom['invtf']
+        write_geom(p.geom_file, geom)
+        p.set_frame(KcwiCCD(np.zeros((args.ny, nx)), unit='electron'))
+        # time the map computation only
+        p.write_image = lambda suffix=None: None
+        print("maps for %d x %d image, 24 slices" % (args.ny, nx))
+        t0 = time.perf_counter()
+        loop_maps(geom, args.ny, nx)
+        t_loop = time.perf_counter() - t0
+        print("  pixel loop     : %8.1f ms" % (t_loop * 1.e3))
+        for nthreads in (1, 2, 4):
+            KcwiConf.NTHREADS = nthreads
+            t0 = time.perf_counter()
+            p.generate_maps()
+            dt = time.perf_counter() - t0
+            print("  %d thread(s)    : %8.1f ms  (x%.0f)" % (
+                nthreads, dt * 1.e3, t_loop / dt))
+    finally:
+        shutil.rmtree(outdir)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""Per-frame proc table overhead, fixed-width file vs journal vs SQLite,
+and nearest-frame association, row loop vs binary search
+
+For a table of N rows, times one frame's worth of proc table work: a
+read, an update and a lookup, as in the recipes.  The fixed-width path
+re-reads, de-duplicates, sorts and rewrites kcwi.proc each time, as the
+proc table primitives used to.
+
+Usage: python benchmarks/bench_proctab.py [--nrows N]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from astropy import log
+from astropy.table import Table, unique
+
+import KeckDRP
+from KeckDRP.core import proctab
+from KeckDRP.core.proctab import ProcTable, SqliteProcTable
+
+
+def row(fno):
+    """A proc table row for frame fno"""
+    return [fno, 'state%d' % (fno // 20), 1121004, 'OBJECT', 'NONE', 600.,
+            'BLUE', 'Medium', 'BL', 10.5, 4500., '2,2', 'KBlue',
+            58000. + fno / 1000., 1, 'int', 'kb%05d.fits' % fno, 'target']
+
+
+def fixed_width_frame(tfil, fno):
+    """Read, update, look up and write the whole fixed-width file"""
+    tab = Table.read(tfil, format='ascii.fixed_width')
+    tab.add_row(row(fno))
+    tab = unique(tab, keys=['CID', 'FRAMENO', 'STAGE'], keep='last')
+    tab.sort('FRAMENO')
+    tab = tab[(tab['CAM'] == 'BLUE') & (tab['CID'] == 'state1')]
+    Table.read(tfil, format='ascii.fixed_width')
+    tab.write(tfil, format='ascii.fixed_width', overwrite=True)
+
+
+def loop_nearest(tab, tfno):
+    """Nearest frame as n_proctab used to find it, row by row"""
+    minoff = 99999
+    trow = None
+    for entry in tab:
+        off = abs(entry['FRAMENO'] - tfno)
+        if off < minoff:
+            minoff = off
+            trow = entry
+    return tab[(tab['FRAMENO'] == trow['FRAMENO'])]
+
+
+def service_frame(cls, tfil, fno):
+    """Refresh, append, look up; export disabled"""
+    ptab = cls.open(tfil)
+    ptab.add_row(row(fno))
+    ptab.select(CAM='BLUE', CID='state1')
+    cls.open(tfil)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Proc table benchmarks")
+    parser.add_argument('--nrows', type=int, default=2000,
+                        help='rows already in the table')
+    parser.add_argument('--nframes', type=int, default=20,
+                        help='frames to time')
+    args = parser.parse_args()
+    log.setLevel('WARNING')
+    KeckDRP.conf.PROCTAB_EXPORT = False
+    outdir = tempfile.mkdtemp()
+    try:
+        tfil = os.path.join(outdir, 'kcwi.proc')
+        ptab = ProcTable()
+        for fno in range(args.nrows):
+            ptab.add_row(row(fno))
+        ptab.export(tfil)
+        t0 = time.perf_counter()
+        for fno in range(args.nrows, args.nrows + args.nframes):
+            fixed_width_frame(tfil, fno)
+        t_fw = (time.perf_counter() - t0) / args.nframes
+        print("proc table overhead per frame, %d rows" % args.nrows)
+        print("  fixed-width file : %8.2f ms" % (t_fw * 1.e3))
+        for label, cls in (('indexed journal', ProcTable),
+                           ('sqlite (WAL)', SqliteProcTable)):
+            # imported from the fixed-width file on first open
+            os.remove(tfil)
+            ptab.export(tfil)
+            proctab.open_tables.clear()
+            cls.open(tfil)
+            t0 = time.perf_counter()
+            for fno in range(args.nrows, args.nrows + args.nframes):
+                service_frame(cls, tfil, fno)
+            dt = (time.perf_counter() - t0) / args.nframes
+            print("  %-16s : %8.2f ms  (x%.0f)" % (label, dt * 1.e3,
+                                                   t_fw / dt))
+        # nearest-frame association on a group of the table
+        tab = ptab.select(CAM='BLUE')
+        t0 = time.perf_counter()
+        for fno in range(args.nframes):
+            loop_nearest(tab, fno * 97)
+        t_loop = (time.perf_counter() - t0) / args.nframes
+        t0 = time.perf_counter()
+        for fno in range(args.nframes):
+            proctab.nearest_rows(tab, fno * 97)
+        t_bin = (time.perf_counter() - t0) / args.nframes
+        print("nearest frame among %d rows" % len(tab))
+        print("  row loop         : %8.2f ms" % (t_loop * 1.e3))
+        print("  binary search    : %8.2f ms  (x%.0f)" % (t_bin * 1.e3,
+                                                          t_loop / t_bin))
+    finally:
+        shutil.rmtree(outdir)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""Master bias subtraction per frame, read and CCDData.subtract vs pool
+
+Writes a full-size master bias and times img_subtract as it used to
+work, reading the master and subtracting into a new frame, against the
+master pool, which keeps the master loaded and subtracts in place.
+
+Usage: python benchmarks/bench_subtract.py [--ny NROWS] [--nx NCOLS]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from astropy import log
+from astropy.io import fits
+from astropy.nddata import StdDevUncertainty
+from astropy.table import Table
+
+import KeckDRP
+from KeckDRP import KcwiCCD
+from KeckDRP.KCWI import kcwi_primitives
+
+
+def read_and_subtract(frame, infile):
+    """Subtraction as img_subtract used to do it"""
+    master = KcwiCCD.read(infile, unit='adu')
+    [master.header['BIASRN%d' % (ia + 1)]
+     for ia in range(master.header['NVIDINP'])]
+    return frame.subtract(master, handle_meta="first_found")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Subtraction benchmarks")
+    parser.add_argument('--ny', type=int, default=4112, help='image rows')
+    parser.add_argument('--nx', type=int, default=4096, help='image columns')
+    parser.add_argument('--nframes', type=int, default=5,
+                        help='frames to time')
+    args = parser.parse_args()
+    log.setLevel('WARNING')
+    # the pool is what is timed, not the calibration cache behind it
+    KeckDRP.conf.CALIB_CACHE_DISK_MB = 0.
+    outdir = tempfile.mkdtemp()
+    try:
+        rng = np.random.RandomState(1)
+        hdr = fits.Header()
+        hdr['NVIDINP'] = 4
+        for ia in range(4):
+            hdr['BIASRN%d' % (ia + 1)] = 3.2
+        infile = os.path.join(outdir, 'kb00001_master_bias.fits')
+        shape = (args.ny, args.nx)
+        KcwiCCD(rng.normal(size=shape), unit='adu', meta=hdr,
+                uncertainty=StdDevUncertainty(np.ones(shape))).write(infile)
+        tab = Table([['kb00001.fits']], names=('OFNAME',))
+        frame = KcwiCCD(rng.normal(loc=1000., size=shape), unit='adu')
+        print("master bias subtraction, %d x %d" % shape)
+        t0 = time.perf_counter()
+        for i in range(args.nframes):
+            read_and_subtract(frame, infile)
+        t_old = (time.perf_counter() - t0) / args.nframes
+        print("  read + subtract : %8.1f ms" % (t_old * 1.e3))
+        p = kcwi_primitives.KcwiPrimitives()
+        # first frame loads the master
+        p.set_frame(frame.copy())
+        p.img_subtract(tab, indir=outdir, suffix='master_bias')
+        frames = [frame.copy() for i in range(args.nframes)]
+        t0 = time.perf_counter()
+        for fr in frames:
+            p.set_frame(fr)
+            p.img_subtract(tab, indir=outdir, suffix='master_bias')
+        dt = (time.perf_counter() - t0) / args.nframes
+        print("  pool, in place  : %8.1f ms  (x%.0f)" % (dt * 1.e3,
+                                                         t_old / dt))
+    finally:
+        shutil.rmtree(outdir)
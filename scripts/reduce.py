@@ -3,11 +3,12 @@ import KeckDRP
 import argparse
 import importlib
 import os
-import glob
-import time
 import sys
 from KeckDRP import conf
 from KeckDRP import Instruments
+from KeckDRP import file_watcher
+from KeckDRP import scheduler
+from KeckDRP.KCWI import KcwiConf
 from astropy import log
 import numpy as np
 
@@ -18,43 +19,67 @@ import numpy as np
 log.setLevel('INFO')
 
 
-def main_loop(frames=None, recipe=None, loop=False, imlist=None, imtype=None):
+def main_loop(frames=None, recipe=None, loop=False, imlist=None, imtype=None,
+              nproc=1, batch=False):
     # case 1: one one image is specified
     if frames:
+        if batch or nproc > 1:
+            reduce_batch(frames, recipe, imtype, nproc)
+            return
         for frame in frames:
             go(frame, recipe, imtype)
         return
     # case 2: infinite loop
     if loop:
-        # step 1: build a list of files already in the directory
-        input_files_before = glob.glob('*.fits')
-        for input_file in input_files_before:
+        # step 1: watch the directory, then reduce the files already there
+        watcher = file_watcher.open_watcher('.', '*.fits')
+        log.info("watching for new frames with %s" %
+                 type(watcher).__name__)
+        for input_file in watcher.existing:
             go(input_file, recipe, imtype)
         while True:
-            # step 2: start infinite loop waiting for new files
-            input_files_now = glob.glob('*.fits')
-            new_files = [f for f in input_files_now
-                         if f not in input_files_before]
-            for input_file in new_files:
-                go(input_file, recipe, imtype)
-            input_files_before = input_files_now
-            time.sleep(10)
+            # step 2: reduce new files as they are completely written
+            for input_file in watcher.wait():
+                go(os.path.basename(input_file), recipe, imtype)
     # case 3: a list of files is provided
     if imlist:
         if os.path.isfile(imlist):
             with open(imlist) as file_list:
-                for file in file_list:
-                    go(file.rstrip('\n'), recipe, imtype)
+                files = [file.rstrip('\n') for file in file_list]
+            if batch or nproc > 1:
+                reduce_batch(files, recipe, imtype, nproc)
+                return
+            for file in files:
+                go(file, recipe, imtype)
         return
 
 
-def go(image, rcp, imtype=None):
+def reduce_batch(files, recipe, imtype, nproc):
+    # calibrations first, each master stacked once, independent frames
+    # at the same time if nproc > 1, sharing the proc table with sqlite
+    missing = [f for f in files if not os.path.isfile(f)]
+    if missing:
+        log.error("The specified files (%s) do not exist" % missing)
+        sys.exit(1)
+    scheduler.run(files, go_batch, args=(recipe, imtype), nprocs=nproc,
+                  imtype=imtype)
+
+
+def go_batch(image, rcp, imtype=None, defer_stack=False):
+    # the whole batch is known, so a master is complete once stacked
+    go(image, rcp, imtype, defer_stack=defer_stack, final_stack=True)
+
+
+def go(image, rcp, imtype=None, defer_stack=False, final_stack=False):
 
     # load the frame and instantiate the object
     if os.path.isfile(image):
         frame = KeckDRP.KcwiCCD.read(image, unit='adu')
         # prepare for floating point operations
-        frame.data = frame.data.astype(np.float64)
+        if KcwiConf.FLOAT32:
+            frame.data = frame.data.astype(np.float32)
+        else:
+            frame.data = frame.data.astype(np.float64)
         # handle missing CCDCFG
         if 'CCDCFG' not in frame.header:
             ccdcfg = frame.header['CCDSUM'].replace(" ", "")
@@ -99,6 +124,8 @@ def go(image, rcp, imtype=None):
     log.info("\n---  Reducing frame %s with recipe: %s ---" %
              (image, myrecipe.__name__))
     p = Instrument.get_primitives_class()
+    p.defer_stack = defer_stack
+    p.final_stack = final_stack
     myrecipe(p, frame)
 
 
@@ -126,6 +153,11 @@ if __name__ == '__main__':
                         help='reduce all frames of the specified image type')
     parser.add_argument('--overwrite', action='store_true',
                         help='Reprocess images, ignore proctab information')
+    parser.add_argument('--nproc', type=int, default=conf.REDUCE_NPROCS,
+                        help='Frames to reduce at once, implies --batch')
+    parser.add_argument('--batch', action='store_true',
+                        help='Reduce calibrations first, stacking each '
+                             'master once')
     parser.add_argument('frames', nargs='*', type=str, help='input image file')
 
     args = parser.parse_args()
@@ -137,12 +169,14 @@ if __name__ == '__main__':
 
     if args.frames:
         log.info("reducing image(s) %s" % args.frames)
-        main_loop(frames=args.frames, recipe=args.recipe, imtype=args.imtype)
+        main_loop(frames=args.frames, recipe=args.recipe, imtype=args.imtype,
+                  nproc=args.nproc, batch=args.batch)
     elif args.loop:
         log.info("reducing in a loop")
         main_loop(loop=args.loop, recipe=args.recipe, imtype=args.imtype)
     elif args.imlist:
         log.info("reducing images in list in %s" % args.imlist)
-        main_loop(imlist=args.imlist, recipe=args.recipe, imtype=args.imtype)
+        main_loop(imlist=args.imlist, recipe=args.recipe, imtype=args.imtype,
+                  nproc=args.nproc, batch=args.batch)
     else:
         log.info("Must supply an image or a list, or loop")